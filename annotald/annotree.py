@@ -1,9 +1,10 @@
-import nltk.tree
+from collections import namedtuple
 from pprint import pprint
-from xml.etree import ElementTree as ET
 from annotald import util
 import io
 from pathlib import Path
+import re
+import sys
 
 
 HTML_LPAREN = "&#40;"
@@ -95,15 +96,322 @@ def tree_spans_from_text(text):
             yield start, idx + 1
 
 
-class AnnoTree(nltk.tree.Tree):
-    def __init__(self, *args, **kwargs):
-        super(AnnoTree, self).__init__(*args, **kwargs)
+# A token is an open paren together with the label following it, a close
+# paren or a run of characters that are neither whitespace nor unescaped
+# parens.  Escaped parens stay inside the run and are transliterated when
+# the token is turned into a label or leaf.
+_TOKEN_RE = re.compile(r"\((?:\s*(?:\\[()]|[^\s()])+)?|\)|(?:\\[()]|[^\s()])+")
+
+
+def iter_trees(chunks, cls=None):
+    """
+    Read bracketed trees from an iterable of text chunks in a single pass.
+
+    Each chunk must end on a token boundary (lines of a file do, since
+    tokens never contain whitespace).  Trees are yielded as soon as their
+    closing paren has been read, so a file handle is consumed lazily.
+    Text outside of the outermost parens is ignored, as it is by
+    tree_spans_from_text.
+    """
+    cls = cls or AnnoTree
+    findall = _TOKEN_RE.findall
+    stack = []
+    children = None
+    # An open paren whose label has not been seen yet, either because it
+    # is empty or because it is on the next line
+    want_label = False
+    for chunk in chunks:
+        for token in findall(chunk):
+            first = token[0]
+            if first == ")":
+                if want_label:
+                    stack.append(("", children))
+                    children = []
+                    want_label = False
+                if not stack:
+                    raise ValueError("Illegal parentheses")
+                label, parent = stack.pop()
+                node = cls(label, children)
+                if parent is None:
+                    yield node
+                else:
+                    parent.append(node)
+                children = parent
+                continue
+            if "\\" in token:
+                token = escaped_parens_to_html_parens(token)
+            if first == "(":
+                if want_label:
+                    stack.append(("", children))
+                    children = []
+                label = token[1:].lstrip()
+                if label:
+                    stack.append((label, children))
+                    children = []
+                    want_label = False
+                else:
+                    want_label = True
+            elif want_label:
+                stack.append((token, children))
+                children = []
+                want_label = False
+            elif children is not None:
+                children.append(token)
+    if stack or want_label:
+        raise ValueError("Unbalanced parentheses at end of input")
+
+
+def iter_tree_spans(text, cls=None):
+    """
+    The trees iter_trees reads from text, each with the offsets of its
+    text: (start, end, tree).  The spans come from the same tokens as
+    the trees, so they always agree.
+    """
+    # (offset of the next tree's opening paren, offset after its last token)
+    span = [None, None]
+
+    def tokens():
+        for match in _TOKEN_RE.finditer(text):
+            token = match.group()
+            if span[0] is None and token[0] == "(":
+                span[0] = match.start()
+            span[1] = match.end()
+            # Each token is a chunk of its own, so a tree is yielded
+            # right after its closing paren
+            yield token
+
+    for tree in iter_trees(tokens(), cls):
+        yield (span[0], span[1], tree)
+        span[0] = None
+
+
+# Children of a terminal that are stored as fields of the terminal node
+TERMINAL_EXTRAS = ("lemma", "exp_seg", "exp_abbrev")
+
+
+def _is_extra(node, labels):
+    return (
+        isinstance(node, AnnoTree)
+        and node._label in labels
+        and len(node) == 1
+        and type(node[0]) is str
+    )
+
+
+class AnnoTree(list):
+    """
+    A compact tree node: a list of children (nodes or leaf strings) with a
+    label.
+
+    Labels are interned.  A terminal whose children are token text followed
+    by a (lemma ...) node and an (exp_seg ...) or (exp_abbrev ...) node
+    keeps those as the string fields lemma, exp_seg and exp_abbrev instead
+    of as child nodes; iterating over the terminal only yields its text.
+    They are put back in place whenever the tree is printed or compared,
+    so the bracketed form of a tree is unchanged.
+
+    The part of the nltk.tree.Tree API that Annotald uses (label,
+    set_label, subtrees, leaves, pos, pformat, fromstring) is provided, and
+    trees compare equal to nltk trees with the same structure.
+    """
+
+    __slots__ = ("_label", "lemma", "exp_seg", "exp_abbrev")
+
+    def __init__(self, label, children=None):
+        if children is None:
+            raise TypeError(
+                "%s: Expected a node value and child list " % type(self).__name__
+            )
+        elif isinstance(children, str):
+            raise TypeError(
+                "%s() argument 2 should be a list, not a string"
+                % type(self).__name__
+            )
+        list.__init__(self, children)
+        self._label = sys.intern(label)
+        self.lemma = self.exp_seg = self.exp_abbrev = None
+        if label.islower() and len(self) > 1 and type(self[-1]) is not str:
+            self._fold_extras()
+
+    def _fold_extras(self):
+        end = len(self)
+        seg = self[end - 1]
+        if _is_extra(seg, ("exp_seg", "exp_abbrev")):
+            end -= 1
+        else:
+            seg = None
+        lemma = self[end - 1]
+        if end > 1 and _is_extra(lemma, ("lemma",)):
+            end -= 1
+        else:
+            lemma = None
+        if end == len(self) or not all(type(child) is str for child in self[:end]):
+            # Not in the canonical order; leave the children alone
+            return
+        if lemma is not None:
+            self.lemma = lemma[0]
+        if seg is not None:
+            setattr(self, seg._label, seg[0])
+        del self[end:]
+
+    def __reduce__(self):
+        return (
+            _make_tree,
+            (type(self), self._label, list(self), self.lemma, self.exp_seg,
+             self.exp_abbrev),
+        )
+
+    def __copy__(self):
+        return _make_tree(type(self), self._label, list(self), self.lemma,
+                          self.exp_seg, self.exp_abbrev)
+
+    def __deepcopy__(self, memo):
+        children = [
+            child.__deepcopy__(memo) if isinstance(child, AnnoTree) else child
+            for child in self
+        ]
+        return _make_tree(type(self), self._label, children, self.lemma,
+                          self.exp_seg, self.exp_abbrev)
+
+    def copy(self, deep=False):
+        return self.__deepcopy__({}) if deep else self.__copy__()
+
+    def label(self):
+        return self._label
+
+    def set_label(self, label):
+        self._label = sys.intern(label)
+
+    def terminal_extras(self):
+        """ A dict from lemma, exp_seg and exp_abbrev to their text """
+        extras = {}
+        for name in TERMINAL_EXTRAS:
+            value = getattr(self, name)
+            if value is not None:
+                extras[name] = value
+        for child in self:
+            if isinstance(child, AnnoTree):
+                extras[child._label] = self.leaf_text(child)
+        return extras
+
+    def expanded(self):
+        """ The children of this node, with terminal fields as child nodes """
+        if self.lemma is None and self.exp_seg is None and self.exp_abbrev is None:
+            return list(self)
+        children = list(self)
+        for name in TERMINAL_EXTRAS:
+            value = getattr(self, name)
+            if value is not None:
+                children.append(AnnoTree(name, [value]))
+        return children
+
+    def __eq__(self, other):
+        if isinstance(other, AnnoTree):
+            return (
+                self._label == other._label
+                and list.__eq__(self, other)
+                and self.lemma == other.lemma
+                and self.exp_seg == other.exp_seg
+                and self.exp_abbrev == other.exp_abbrev
+            )
+        if isinstance(other, list) and callable(getattr(other, "label", None)):
+            # e.g. an nltk.tree.Tree
+            return self._label == other.label() and self.expanded() == list(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __lt__(self, other):
+        if not isinstance(other, AnnoTree):
+            return NotImplemented
+        return (self._label, self.expanded()) < (other._label, other.expanded())
+
+    def __gt__(self, other):
+        if not isinstance(other, AnnoTree):
+            return NotImplemented
+        return (self._label, self.expanded()) > (other._label, other.expanded())
+
+    def __le__(self, other):
+        if not isinstance(other, AnnoTree):
+            return NotImplemented
+        return (self._label, self.expanded()) <= (other._label, other.expanded())
+
+    def __ge__(self, other):
+        if not isinstance(other, AnnoTree):
+            return NotImplemented
+        return (self._label, self.expanded()) >= (other._label, other.expanded())
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "{0}({1!r}, {2!r})".format(
+            type(self).__name__, self._label, self.expanded()
+        )
+
+    def __str__(self):
+        return self.pformat()
+
+    def subtrees(self, filter=None):
+        """ Yield this node and all nodes below it, in pre-order """
+        if not filter or filter(self):
+            yield self
+        for child in self:
+            if isinstance(child, AnnoTree):
+                yield from child.subtrees(filter)
+
+    def leaves(self):
+        leaves = []
+        for child in self:
+            if isinstance(child, AnnoTree):
+                leaves.extend(child.leaves())
+            else:
+                leaves.append(child)
+        return leaves
+
+    def pos(self):
+        pos = []
+        for child in self:
+            if isinstance(child, AnnoTree):
+                pos.extend(child.pos())
+            else:
+                pos.append((child, self._label))
+        return pos
+
+    def _pformat_flat(self):
+        childstrs = [
+            child._pformat_flat() if isinstance(child, AnnoTree) else child
+            for child in self.expanded()
+        ]
+        return "({0} {1})".format(self._label, " ".join(childstrs))
+
+    def pformat(self, margin=70, indent=0):
+        """ Format the tree the way nltk.tree.Tree.pformat does """
+        flat = self._pformat_flat()
+        if len(flat) + indent < margin:
+            return flat
+        parts = ["(", self._label]
+        for child in self.expanded():
+            parts.append("\n" + " " * (indent + 2))
+            if isinstance(child, AnnoTree):
+                parts.append(child.pformat(margin, indent + 2))
+            else:
+                parts.append(child)
+        parts.append(")")
+        return "".join(parts)
+
+    def pprint(self, **kwargs):
+        print(self.pformat(**kwargs))
 
     @classmethod
     def fromstring(cls, tree_str):
-        transliterated = escaped_parens_to_html_parens(tree_str)
-        tree = super(AnnoTree, cls).fromstring(transliterated)
-        return tree
+        trees = cls.fromstring_many(tree_str)
+        if len(trees) != 1:
+            raise ValueError(
+                "Expected exactly one tree, got {0}".format(len(trees))
+            )
+        return trees[0]
 
     @classmethod
     def is_terminal(cls, tree):
@@ -124,7 +432,6 @@ class AnnoTree(nltk.tree.Tree):
         top_level_nodes = {child.label(): child for child in self}
         _ = top_level_nodes.pop("META", None)
         real_root = next(iter(top_level_nodes.values()))
-        print(real_root)
         return {"tree": self._to_json_inner(real_root), "meta": metadata}
 
     def get_metadata(self):
@@ -142,24 +449,22 @@ class AnnoTree(nltk.tree.Tree):
 
     @classmethod
     def read_from_file(cls, obj):
+        return list(cls.iter_from_file(obj))
+
+    @classmethod
+    def iter_from_file(cls, obj):
+        """ Lazily yield the trees of a file handle or path, in file order """
         if isinstance(obj, io.TextIOBase):
-            text = obj.read()
+            yield from iter_trees(obj, cls)
         elif isinstance(obj, str) or isinstance(obj, Path):
             with open(obj, "r", encoding="utf-8") as handle:
-                text = handle.read()
+                yield from iter_trees(handle, cls)
         else:
             raise ValueError("Illegal file or path object")
 
-        return cls.fromstring_many(text)
-
     @classmethod
     def fromstring_many(cls, text):
-        trees = []
-        for (start, end) in tree_spans_from_text(text):
-            tree_str = text[start:end]
-            tree = cls.fromstring(tree_str)
-            trees.append(tree)
-        return trees
+        return list(iter_trees((text,), cls))
 
     @classmethod
     def write_to_file(cls, obj, trees):
@@ -193,21 +498,16 @@ class AnnoTree(nltk.tree.Tree):
     @classmethod
     def _terminal_to_json(cls, tree):
         flat_terminal = tree.label()
-        terminal_extra = {
-            child.label(): child for child in tree if isinstance(child, AnnoTree)
-        }
+        terminal_extra = tree.terminal_extras()
 
-        variants = split_flat_terminal(flat_terminal)
+        info = terminal_codec.decode(flat_terminal)
         obj = {}
         obj["text"] = html_parens_to_parens(cls.leaf_text(tree))
-        obj["cat"] = variants["cat"]
-        del variants["cat"]
-        obj["variants"] = variants
-        obj["lemma"] = html_parens_to_parens(
-            cls.leaf_text(terminal_extra.get("lemma", []))
-        )
-        obj["exp_seg"] = cls.leaf_text(terminal_extra.get("exp_seg", []))
-        obj["exp_abbrev"] = cls.leaf_text(terminal_extra.get("exp_abbrev", []))
+        obj["cat"] = info.cat
+        obj["variants"] = info.variants
+        obj["lemma"] = html_parens_to_parens(terminal_extra.get("lemma", ""))
+        obj["exp_seg"] = terminal_extra.get("exp_seg", "")
+        obj["exp_abbrev"] = terminal_extra.get("exp_abbrev", "")
         obj["terminal"] = flat_terminal
 
         return obj
@@ -219,160 +519,84 @@ class AnnoTree(nltk.tree.Tree):
         meta_node = top_level_nodes.pop("META", None)
 
         real_root = next(iter(top_level_nodes.values()))
-        snode = cls.to_html_inner(real_root)
-
+        root_attrib = ()
+        root_prefix = ""
         if meta_node:
             meta_children = {child.label(): child for child in meta_node}
-            id_node = ET.Element(
-                "span", attrib={"class": " ".join(["wnode", "tree-id-node"])}
-            )
             id_str = cls.leaf_text(meta_children["ID-LOCAL"])
-            id_node.text = id_str
-            snode.insert(0, id_node)
-
-            snode.attrib["data-tree_id"] = id_str
-            snode.attrib["data-corpus_id"] = cls.leaf_text(meta_children["ID-CORPUS"])
-            snode.attrib["data-comment"] = cls.leaf_text(meta_children["COMMENT"]) or ""
-            snode.attrib["data-url"] = cls.leaf_text(meta_children["URL"])
-
-        result = ET.tostring(snode, encoding="utf8", method="html").decode("utf8")
-
-        return result
-
-    @classmethod
-    def to_html_inner(cls, tree):
-        if cls.is_terminal(tree):
-            return cls.terminal_to_html(tree)
-
-        nonterminal = tree.label()
-
-        parts = nonterminal.split("-")
-        nonterminal_class = "nonterminal-{0}".format(parts[0]).lower()
-
-        attrib = {
-            "class": " ".join(["snode", nonterminal_class]),
-            "data-nonterminal": nonterminal,
-        }
-
-        snode = ET.Element("div", attrib=attrib)
-        snode.text = nonterminal
-        snode.extend(list(cls.to_html_inner(x) for x in tree))
+            root_prefix = '<span class="wnode tree-id-node">{0}</span>'.format(
+                _escape_html_text(id_str)
+            )
+            root_attrib = (
+                ("data-tree_id", id_str),
+                ("data-corpus_id", cls.leaf_text(meta_children["ID-CORPUS"])),
+                ("data-comment", cls.leaf_text(meta_children["COMMENT"]) or ""),
+                ("data-url", cls.leaf_text(meta_children["URL"])),
+            )
 
-        return snode
+        parts = []
+        write_html(real_root, parts.append, root_attrib, root_prefix)
+        return "".join(parts)
 
     @classmethod
-    def terminal_to_html(cls, tree):
+    def terminal_to_html(cls, tree, extra_attrib=(), prefix=""):
+        """
+        The HTML of a terminal: a div carrying the terminal's variants and
+        fields as data- attributes, holding spans for its token text,
+        lemma and exp_seg or exp_abbrev.
+        """
         flat_terminal = tree.label()
-        token_text = cls.leaf_text(tree)
-        lemma = None
-        seg = None
-        exp_attrib = None
-        terminal_extra = {
-            child.label(): child for child in tree if isinstance(child, AnnoTree)
-        }
-
-        if "lemma" in terminal_extra:
-            lemma = cls.leaf_text(terminal_extra["lemma"])
+        token_text = html_parens_to_parens(cls.leaf_text(tree))
+        terminal_extra = tree.terminal_extras()
+        lemma = terminal_extra.get("lemma")
+        lemma = html_parens_to_parens(lemma) if lemma else lemma
         if "exp_abbrev" in terminal_extra:
-            seg = {
-                "type": "exp_abbrev",
-                "text": cls.leaf_text(terminal_extra["exp_abbrev"]),
-            }
-            exp_attrib = {"data-abbrev": seg["text"]}
+            (seg_class, seg) = ("exp-abbrev-node", terminal_extra["exp_abbrev"])
+            (data_seg, data_abbrev) = ("", seg)
         elif "exp_seg" in terminal_extra:
-            seg = {"type": "exp_seg", "text": cls.leaf_text(terminal_extra["exp_seg"])}
-            exp_attrib = {"data-seg": seg["text"]}
-
-        parts = split_flat_terminal(flat_terminal)
-        terminal_class = "terminal-{0}".format(parts["cat"]).lower()
-
-        lemma = html_parens_to_parens(lemma) if lemma else lemma
-        token_text = html_parens_to_parens(token_text)
-
-        attrib = {("data-" + key): value for (key, value) in parts.items()}
-        attrib.update(
-            {
-                "class": " ".join(["snode", terminal_class]),
-                "data-text": token_text,
-                "data-lemma": lemma if lemma else "",
-                "data-seg": "",
-                "data-abbrev": "",
-                "data-terminal": flat_terminal,
-            }
-        )
-        if exp_attrib is not None:
-            attrib.update(exp_attrib)
-
-        snode = ET.Element("div", attrib=attrib)
-        snode.text = flat_terminal
-
-        wnode = ET.SubElement(snode, "span", attrib={"class": "wnode"})
-        wnode.text = token_text
-
+            (seg_class, seg) = ("exp-seg-node", terminal_extra["exp_seg"])
+            (data_seg, data_abbrev) = (seg, "")
+        else:
+            seg = None
+            data_seg = data_abbrev = ""
+
+        parts = [
+            terminal_codec.decode(flat_terminal).html_start,
+            ' data-text="', _escape_html_attrib(token_text),
+            '" data-lemma="', _escape_html_attrib(lemma) if lemma else "",
+            '" data-seg="', _escape_html_attrib(data_seg),
+            '" data-abbrev="', _escape_html_attrib(data_abbrev),
+            '" data-terminal="', _escape_html_attrib(flat_terminal), '"',
+            _html_attrib(extra_attrib), ">",
+            _escape_html_text(flat_terminal), prefix,
+            '<span class="wnode">', _escape_html_text(token_text), "</span>",
+        ]
         if lemma:
-            lemma_node = ET.SubElement(
-                snode, "span", attrib={"class": "wnode lemma-node"}
-            )
-            lemma_node.text = lemma
-
-        if seg:
-            seg_class = (
-                "exp-seg-node" if seg["type"] == "exp_seg" else "exp-abbrev-node"
-            )
-            seg_node = ET.SubElement(
-                snode, "span", attrib={"class": " ".join(["wnode", seg_class])}
-            )
-            seg_node.text = seg["text"]
-
-        return snode
+            parts.extend(['<span class="wnode lemma-node">',
+                          _escape_html_text(lemma), "</span>"])
+        if seg is not None:
+            parts.extend(['<span class="wnode ', seg_class, '">',
+                          _escape_html_text(seg), "</span>"])
+        parts.append("</div>")
+        return "".join(parts)
 
     def pretty(self, padding=0):
         """
         node     = lparen label space children rparen
 
         children = node nl padding children | node
-        """
-        left = "({0} ".format(self.label())
-        def_child_padding = len(left) + padding
-        extra_child_padding = def_child_padding
-        parts = [left]
-        num = len(self)
-
-        first_is_str = None
-        if 0 < num:
-            first_is_str = isinstance(self[0], str)
-        if first_is_str:
-            # for placing lemma on same line as token text
-            extra_child_padding = def_child_padding + len(self[0]) + 1
-
-        for (idx, child) in enumerate(self):
-            if idx == 1 and first_is_str:
-                parts.append(" ")
-            elif 0 < idx:
-                parts.append(" " * extra_child_padding)
-
-            if isinstance(child, AnnoTree):
-                if self.label() != "COMMENT":
-                    parts.append(child.pretty(padding=def_child_padding))
-                else:
-                    # flatten comment line
-                    parts.extend(["(", child._print_comment_line(), ")"])
-            else:
-                # str
-                parts.append(child)
-
-            if idx == 0 and first_is_str and 1 < num:
-                # place lemma on same line as token text
-                pass
-            elif idx < (num - 1):
-                parts.append("\n")
 
-        parts.append(")")
+        The token text of a terminal is followed by its first child on the
+        same line, and the children of a COMMENT node are flattened into a
+        single line.
+        """
+        parts = []
+        write_pretty(self, parts.append, padding)
         return "".join(parts)
 
     def _print_comment_line(self):
         parts = [self.label()]
-        parts.extend([str(c) for c in self])
+        parts.extend([str(c) for c in self.expanded()])
         comment = " ".join(parts)
         transliterated = html_parens_to_parens(comment)
         return transliterated
@@ -427,98 +651,333 @@ class AnnoTree(nltk.tree.Tree):
         return anno_aug
 
 
-def split_flat_terminal(term_tok):
-    parts = term_tok.split("_")
-    if len(parts) <= 1:
-        pass
+_INDENTS = [" " * num for num in range(256)]
+
+
+def _indent(num):
+    if num < len(_INDENTS):
+        return _INDENTS[num]
+    return " " * num
+
+
+def _pretty_terminal(node, padding):
+    """ write_pretty for a node whose only child is its token text """
+    text = node[0]
+    head = "(" + node._label + " " + text
+    if node.lemma is None and node.exp_seg is None and node.exp_abbrev is None:
+        return head + ")"
+    fields = [
+        "(" + name + " " + getattr(node, name) + ")"
+        for name in TERMINAL_EXTRAS
+        if getattr(node, name) is not None
+    ]
+    sep = "\n" + _indent(padding + len(node._label) + len(text) + 3)
+    return head + " " + sep.join(fields) + ")"
+
+
+def write_pretty(tree, write, padding=0):
+    """
+    Write the pretty-printed form of tree (see AnnoTree.pretty) in pieces
+    to the callable write, e.g. the append method of a list.
+
+    Nodes waiting to be printed are kept on an explicit stack, so deep
+    trees do not recurse, and every piece is written once instead of being
+    joined again at each level.
+    """
+    stack = [(tree, padding)]
+    pop = stack.pop
+    while stack:
+        item = pop()
+        if item.__class__ is not tuple:
+            write(item)
+            continue
+        (node, padding) = item
+        label = node._label
+        write("(" + label + " ")
+        if node.lemma is None and node.exp_seg is None and node.exp_abbrev is None:
+            children = node
+        else:
+            # Terminal fields are printed like (lemma ...) children; they
+            # are never the first child, so they can be written as text
+            children = list(node)
+            for name in TERMINAL_EXTRAS:
+                value = getattr(node, name)
+                if value is not None:
+                    children.append("(" + name + " " + value + ")")
+        num = len(children)
+        child_padding = padding + len(label) + 2
+        first_is_str = num > 0 and isinstance(children[0], str)
+        if first_is_str:
+            # Later children line up after the token text, which shares its
+            # line with the first of them
+            extra_indent = _indent(child_padding + len(children[0]) + 1)
+        else:
+            extra_indent = _indent(child_padding)
+        flatten = label == "COMMENT"
+
+        items = []
+        add = items.append
+        for (idx, child) in enumerate(children):
+            if idx == 1 and first_is_str:
+                add(" ")
+            elif idx:
+                add(extra_indent)
+            if not isinstance(child, AnnoTree):
+                add(child)
+            elif flatten:
+                add("(" + child._print_comment_line() + ")")
+            elif len(child) == 1 and child[0].__class__ is str:
+                add(_pretty_terminal(child, child_padding))
+            else:
+                add((child, child_padding))
+            if idx < num - 1 and not (idx == 0 and first_is_str):
+                add("\n")
+        add(")")
+        stack.extend(reversed(items))
+
+
+def _escape_html_text(text):
+    # As ElementTree escapes text
+    if "&" in text:
+        text = text.replace("&", "&amp;")
+    if "<" in text:
+        text = text.replace("<", "&lt;")
+    if ">" in text:
+        text = text.replace(">", "&gt;")
+    return text
+
+
+def _escape_html_attrib(text):
+    # As ElementTree escapes attribute values in HTML
+    if "&" in text:
+        text = text.replace("&", "&amp;")
+    if ">" in text:
+        text = text.replace(">", "&gt;")
+    if '"' in text:
+        text = text.replace('"', "&quot;")
+    return text
+
+
+def _html_attrib(items):
+    return "".join(
+        [
+            ' {0}="{1}"'.format(key, _escape_html_attrib(value))
+            for (key, value) in items
+        ]
+    )
 
+
+# Nonterminal label -> the start of its div tag, and the whole div tag
+# followed by the label
+_NONTERMINAL_HTML = {}
+
+
+def _nonterminal_html(label):
+    html = _NONTERMINAL_HTML.get(label)
+    if html is None:
+        if len(_NONTERMINAL_HTML) >= 2 ** 16:
+            _NONTERMINAL_HTML.clear()
+        nonterminal_class = "nonterminal-{0}".format(label.split("-")[0]).lower()
+        start = '<div class="snode {0}" data-nonterminal="{1}"'.format(
+            _escape_html_attrib(nonterminal_class), _escape_html_attrib(label)
+        )
+        html = (start, start + ">" + _escape_html_text(label))
+        _NONTERMINAL_HTML[label] = html
+    return html
+
+
+def write_html(tree, write, root_attrib=(), root_prefix=""):
+    """
+    Write the HTML of tree for the annotation view in pieces to the
+    callable write.
+
+    Nonterminals become div.snode elements holding their label and the
+    HTML of their children, terminals are rendered by
+    AnnoTree.terminal_to_html.  root_attrib (pairs of attribute name and
+    value) are added to the element of the root and the HTML root_prefix
+    is put right after its label.  The markup is what ElementTree used to
+    produce for the same elements, written directly.
+    """
+    stack = [tree]
+    pop = stack.pop
+    (attrib, prefix) = (root_attrib, root_prefix)
+    while stack:
+        node = pop()
+        if node is None:
+            write("</div>")
+            continue
+        label = node._label
+        if label.islower():
+            write(AnnoTree.terminal_to_html(node, attrib, prefix))
+        else:
+            if attrib or prefix:
+                (start, _) = _nonterminal_html(label)
+                write(start + _html_attrib(attrib) + ">"
+                      + _escape_html_text(label) + prefix)
+            else:
+                write(_nonterminal_html(label)[1])
+            stack.append(None)
+            stack.extend(reversed(node))
+        (attrib, prefix) = ((), "")
+
+
+def _make_tree(cls, label, children, lemma=None, exp_seg=None, exp_abbrev=None):
+    tree = cls(label, children)
+    tree.lemma = lemma
+    tree.exp_seg = exp_seg
+    tree.exp_abbrev = exp_abbrev
+    return tree
+
+
+_VARIANT_NAMES = (
+    "article",
+    "case",
+    "gender",
+    "number",
+    "person",
+    "tense",
+    "degree",
+    "strength",
+    "voice",
+    "mood",
+    "clitic",
+    "lo_obj",
+    "fs_obj",
+)
+
+
+class TerminalInfo(
+    namedtuple("TerminalInfo", "tag, cat, data, css_class, html_attrib, html_start")
+):
+    """
+    What a flat terminal tag such as so_1_þf_et_fh_gm_nt_p3 encodes.
+
+    data holds (name, value) pairs: the category first, then the verb
+    valence and the variants present in the tag.  css_class and
+    html_attrib are what terminal_to_html puts on the terminal's node, and
+    html_start is the start of that node's tag with them.
+    """
+
+    __slots__ = ()
+
+    @property
+    def variants(self):
+        """ A new dict of the variants, without the category """
+        return dict(self.data[1:])
+
+
+def _decode_terminal(tag):
+    parts = tag.split("_")
     cat = parts[0]
 
     # Extract valence
     variants_start = 1
     data = dict(cat=cat)
-    if cat == "so":
-        first_variant = parts[1]
-        num_control = 0
-        if first_variant in "012":
-            num_control = int(first_variant)
+    if cat == "so" and len(parts) > 1:
+        if parts[1] in ("0", "1", "2"):
+            num_control = int(parts[1])
             variants_start += 1
             # so_0_þt_vh_p1           færi
             # so_1_þf_þt_vh_p1        tæki mat
             # so_2_þgf_þf_þt_vh_p1    gæfi honum mat
             for idx in range(num_control):
-                var = parts[2 + idx]
+                var = parts[2 + idx] if 2 + idx < len(parts) else None
                 if var in VARIANT.CASE:
                     variants_start += 1
                     data["obj" + str(idx + 1)] = var
 
         if "subj" in parts:
             # so_1_þgf_op_subj_nf_þt_fh_p1_mm | mér gafst ekki tækifæri
-            parts.pop(parts.index("subj"))
+            parts.remove("subj")
             data["impersonal"] = "subj"
             subj = [var for var in parts[variants_start:] if var in VARIANT.CASE]
             if subj:
-                subj = subj.pop()
-                data["subj"] = subj
-                parts.pop(parts.index(subj))
+                data["subj"] = subj[-1]
+                parts.remove(subj[-1])
             if "op" in parts:
-                parts.pop(parts.index("op"))
+                parts.remove("op")
         elif "op" in parts and "es" in parts:
             # so_0_op_es_nt_fh_p3 | það rignir
             data["impersonal"] = "es"
-            parts.pop(parts.index("op"))
-            parts.pop(parts.index("es"))
-            pass
+            parts.remove("op")
+            parts.remove("es")
         elif "op" in parts:
             data["impersonal"] = "none"
-            parts.pop(parts.index("op"))
-            pass
+            parts.remove("op")
 
         if "lh" in parts and "þt" in parts:
-            parts.pop(parts.index("lh"))
-            parts.pop(parts.index("þt"))
+            parts.remove("lh")
+            parts.remove("þt")
             parts.append("lhþt")
-            pass
         elif "lh" in parts and "nt" in parts:
-            parts.pop(parts.index("lh"))
-            parts.pop(parts.index("nt"))
+            parts.remove("lh")
+            parts.remove("nt")
             parts.append("lhnt")
 
-    variants = set(parts[variants_start:])
-
-    try:
-        from icecream import ic
-        ic.configureOutput(includeContext=True)
-    except ImportError:  # Graceful fallback if IceCream isn't installed.
-        ic = lambda *a: None if not a else (a[0] if len(a) == 1 else a)  # noqa
-
-    variant_names = (
-        "article",
-        "case",
-        "gender",
-        "number",
-        "person",
-        "tense",
-        "degree",
-        "strength",
-        "voice",
-        "mood",
-        "clitic",
-        "lo_obj",
-        "fs_obj"
+    variants = parts[variants_start:]
+    category_variants = CATEGORY_TO_VARIANT.get(cat, ())
+    for variant_name in _VARIANT_NAMES:
+        if variant_name in category_variants:
+            values = getattr(VARIANT, variant_name.upper())
+            # The first of the tag's variants of this kind, if any
+            data[variant_name] = next((var for var in variants if var in values), None)
+
+    data = tuple(
+        (sys.intern(key), sys.intern(value)) for (key, value) in data.items() if value
     )
-    data_rest = dict()
-    for variant_name in variant_names:
-        if cat in CATEGORY_TO_VARIANT and variant_name in CATEGORY_TO_VARIANT[cat]:
-            all_subvariants = getattr(VARIANT, variant_name.upper())
-            data_rest[variant_name] = all_subvariants & variants
+    css_class = sys.intern(" ".join(["snode", "terminal-{0}".format(cat).lower()]))
+    html_attrib = tuple(("data-" + key, value) for (key, value) in data)
+    return TerminalInfo(
+        tag=sys.intern(tag),
+        cat=sys.intern(cat),
+        data=data,
+        css_class=css_class,
+        html_attrib=html_attrib,
+        html_start="<div" + _html_attrib(html_attrib + (("class", css_class),)),
+    )
+
+
+class TerminalCodec(object):
+    """
+    Decodes flat terminal tags into TerminalInfo records, decoding each
+    distinct tag only once.
+
+    A corpus has a few thousand distinct tags, so the records are kept in a
+    plain dict; should it ever hold maxsize of them (e.g. from garbage
+    labels) it is emptied and filled again.
+    """
+
+    def __init__(self, maxsize=2 ** 16):
+        self.maxsize = maxsize
+        self._records = {}
+        self.hits = 0
+        self.misses = 0
+
+    def decode(self, tag):
+        record = self._records.get(tag)
+        if record is not None:
+            self.hits += 1
+            return record
+        self.misses += 1
+        record = _decode_terminal(tag)
+        if len(self._records) >= self.maxsize:
+            self._records.clear()
+        self._records[record.tag] = record
+        return record
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._records),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
 
-    for (k, v) in list(data_rest.items()):
-        data_rest[k] = v.pop() if v else None
+terminal_codec = TerminalCodec()
 
-    data.update(data_rest)
-    for k in list(data.keys()):
-        if not data[k]:
-            del data[k]
 
-    return data
+def split_flat_terminal(term_tok):
+    """ The category and variants of a flat terminal tag, as a new dict """
+    return dict(terminal_codec.decode(term_tok).data)
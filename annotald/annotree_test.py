@@ -0,0 +1,326 @@
+import io, unittest
+from xml.etree import ElementTree as ET
+
+import nltk.tree as T
+
+from annotald import annotree
+from annotald.annotree import AnnoTree
+
+SAMPLE = r"""
+( (META (ID-CORPUS abc.1)
+        (ID-LOCAL test.psd,.1)
+        (URL greynir.is)
+        (COMMENT (ANNO hello world)))
+  (S0 (S-MAIN (NP-SUBJ (pfn_et_nf_p1 Ég (lemma ég)))
+              (VP (so_1_þf_et_fh_gm_nt_p1 sé (lemma sjá))
+                  (NP-OBJ (entity \(AB\) (lemma \(AB\))))))
+      (grm .)))
+
+( (META (ID-CORPUS abc.2)
+        (ID-LOCAL test.psd,.2)
+        (URL greynir.is)
+        (COMMENT ))
+  (S0 (S-HEADING (no_et_nf_kk maður (lemma maður) (exp_seg mann-ur)))))
+"""
+
+
+def _old_fromstring_many(text):
+    return [T.Tree.fromstring(annotree.escaped_parens_to_html_parens(text[s:e]))
+            for (s, e) in annotree.tree_spans_from_text(text)]
+
+
+def _recursive_pretty(tree, padding=0):
+    """ AnnoTree.pretty as it was before it was made iterative """
+    left = "({0} ".format(tree.label())
+    def_child_padding = len(left) + padding
+    extra_child_padding = def_child_padding
+    parts = [left]
+    children = tree.expanded()
+    num = len(children)
+
+    first_is_str = None
+    if 0 < num:
+        first_is_str = isinstance(children[0], str)
+    if first_is_str:
+        extra_child_padding = def_child_padding + len(children[0]) + 1
+
+    for (idx, child) in enumerate(children):
+        if idx == 1 and first_is_str:
+            parts.append(" ")
+        elif 0 < idx:
+            parts.append(" " * extra_child_padding)
+
+        if isinstance(child, AnnoTree):
+            if tree.label() != "COMMENT":
+                parts.append(_recursive_pretty(child, padding=def_child_padding))
+            else:
+                parts.extend(["(", child._print_comment_line(), ")"])
+        else:
+            parts.append(child)
+
+        if idx == 0 and first_is_str and 1 < num:
+            pass
+        elif idx < (num - 1):
+            parts.append("\n")
+
+    parts.append(")")
+    return "".join(parts)
+
+
+class _EtreeHtml(AnnoTree):
+    """ AnnoTree.to_html as it was when it built ElementTree elements """
+
+    __slots__ = ()
+
+    @classmethod
+    def to_html(cls, tree, version, extra_data=None):
+        top_level_nodes = {child.label(): child for child in tree}
+
+        meta_node = top_level_nodes.pop("META", None)
+
+        real_root = next(iter(top_level_nodes.values()))
+        snode = cls.to_html_inner(real_root)
+
+        if meta_node:
+            meta_children = {child.label(): child for child in meta_node}
+            id_node = ET.Element(
+                "span", attrib={"class": " ".join(["wnode", "tree-id-node"])}
+            )
+            id_str = cls.leaf_text(meta_children["ID-LOCAL"])
+            id_node.text = id_str
+            snode.insert(0, id_node)
+
+            snode.attrib["data-tree_id"] = id_str
+            snode.attrib["data-corpus_id"] = cls.leaf_text(meta_children["ID-CORPUS"])
+            snode.attrib["data-comment"] = cls.leaf_text(meta_children["COMMENT"]) or ""
+            snode.attrib["data-url"] = cls.leaf_text(meta_children["URL"])
+
+        result = ET.tostring(snode, encoding="utf8", method="html").decode("utf8")
+
+        return result
+
+    @classmethod
+    def to_html_inner(cls, tree):
+        if cls.is_terminal(tree):
+            return cls.terminal_to_html(tree)
+
+        nonterminal = tree.label()
+
+        parts = nonterminal.split("-")
+        nonterminal_class = "nonterminal-{0}".format(parts[0]).lower()
+
+        attrib = {
+            "class": " ".join(["snode", nonterminal_class]),
+            "data-nonterminal": nonterminal,
+        }
+
+        snode = ET.Element("div", attrib=attrib)
+        snode.text = nonterminal
+        snode.extend(list(cls.to_html_inner(x) for x in tree))
+
+        return snode
+
+    @classmethod
+    def terminal_to_html(cls, tree):
+        flat_terminal = tree.label()
+        token_text = cls.leaf_text(tree)
+        lemma = None
+        seg = None
+        exp_attrib = None
+        terminal_extra = tree.terminal_extras()
+
+        if "lemma" in terminal_extra:
+            lemma = terminal_extra["lemma"]
+        if "exp_abbrev" in terminal_extra:
+            seg = {
+                "type": "exp_abbrev",
+                "text": terminal_extra["exp_abbrev"],
+            }
+            exp_attrib = {"data-abbrev": seg["text"]}
+        elif "exp_seg" in terminal_extra:
+            seg = {"type": "exp_seg", "text": terminal_extra["exp_seg"]}
+            exp_attrib = {"data-seg": seg["text"]}
+
+        info = annotree.terminal_codec.decode(flat_terminal)
+
+        lemma = annotree.html_parens_to_parens(lemma) if lemma else lemma
+        token_text = annotree.html_parens_to_parens(token_text)
+
+        attrib = dict(info.html_attrib)
+        attrib.update(
+            {
+                "class": info.css_class,
+                "data-text": token_text,
+                "data-lemma": lemma if lemma else "",
+                "data-seg": "",
+                "data-abbrev": "",
+                "data-terminal": flat_terminal,
+            }
+        )
+        if exp_attrib is not None:
+            attrib.update(exp_attrib)
+
+        snode = ET.Element("div", attrib=attrib)
+        snode.text = flat_terminal
+
+        wnode = ET.SubElement(snode, "span", attrib={"class": "wnode"})
+        wnode.text = token_text
+
+        if lemma:
+            lemma_node = ET.SubElement(
+                snode, "span", attrib={"class": "wnode lemma-node"}
+            )
+            lemma_node.text = lemma
+
+        if seg:
+            seg_class = (
+                "exp-seg-node" if seg["type"] == "exp_seg" else "exp-abbrev-node"
+            )
+            seg_node = ET.SubElement(
+                snode, "span", attrib={"class": " ".join(["wnode", seg_class])}
+            )
+            seg_node.text = seg["text"]
+
+        return snode
+
+
+class AnnoTreeTest(unittest.TestCase):
+    maxDiff = None
+
+    def test_fromstring_many_parity(self):
+        trees = AnnoTree.fromstring_many(SAMPLE)
+        self.assertEqual(len(trees), 2)
+        self.assertEqual(trees, _old_fromstring_many(SAMPLE))
+        self.assertEqual([str(t) for t in trees],
+                         [str(t) for t in _old_fromstring_many(SAMPLE)])
+
+    def test_escaped_parens(self):
+        tree = AnnoTree.fromstring_many(SAMPLE)[0]
+        entity = tree[1][0][1][1][0]
+        self.assertEqual(entity.label(), "entity")
+        self.assertEqual(entity[0], "&#40;AB&#41;")
+
+    def test_iter_tree_spans(self):
+        text = "junk \\( " + SAMPLE + " (NP a) (NP b)"
+        spans = list(annotree.iter_tree_spans(text))
+        self.assertEqual([tree for (_, _, tree) in spans],
+                         AnnoTree.fromstring_many(text))
+        self.assertEqual([text[start:end] for (start, end, _) in spans],
+                         [SAMPLE.split("\n\n")[0].strip(),
+                          SAMPLE.split("\n\n")[1].strip(), "(NP a)", "(NP b)"])
+
+    def test_iter_from_file_is_lazy(self):
+        handle = io.StringIO(SAMPLE + "\n\n( (BROKEN")
+        trees = AnnoTree.iter_from_file(handle)
+        self.assertEqual(next(trees).get_metadata()["tree_id"], "test.psd,.1")
+        self.assertEqual(next(trees).get_metadata()["tree_id"], "test.psd,.2")
+        self.assertRaises(ValueError, next, trees)
+
+    def test_label_on_next_line(self):
+        self.assertEqual(AnnoTree.fromstring_many("(\nNP (D a))\n()"),
+                         [AnnoTree("NP", [AnnoTree("D", ["a"])]),
+                          AnnoTree("", [])])
+
+    def test_illegal_parens(self):
+        self.assertRaises(ValueError, AnnoTree.fromstring_many, "(NP a))")
+        self.assertRaises(ValueError, AnnoTree.fromstring_many, "((NP a)")
+
+    def test_terminal_fields(self):
+        tree = AnnoTree.fromstring(
+            "(no_et_nf_kk maður (lemma maður) (exp_seg mann-ur))")
+        self.assertEqual(list(tree), ["maður"])
+        self.assertEqual(tree.lemma, "maður")
+        self.assertEqual(tree.exp_seg, "mann-ur")
+        self.assertIsNone(tree.exp_abbrev)
+        self.assertEqual(tree.pretty(),
+                         "(no_et_nf_kk maður (lemma maður)\n"
+                         "                   (exp_seg mann-ur))")
+        self.assertEqual(tree, T.Tree.fromstring(
+            "(no_et_nf_kk maður (lemma maður) (exp_seg mann-ur))"))
+
+    def test_terminal_fields_noncanonical(self):
+        # Children in an unexpected order are kept as nodes
+        text = "(no_et_nf_kk maður (exp_seg mann-ur) (lemma maður))"
+        tree = AnnoTree.fromstring(text)
+        self.assertEqual(len(tree), 3)
+        self.assertIsNone(tree.lemma)
+        self.assertEqual(tree.terminal_extras(),
+                         {"lemma": "maður", "exp_seg": "mann-ur"})
+        self.assertEqual(str(tree), text)
+
+    def test_labels_are_interned(self):
+        (first, second) = AnnoTree.fromstring_many(SAMPLE)
+        self.assertIs(first[1].label(), second[1].label())
+
+    def test_pickle_and_copy(self):
+        import copy, pickle
+        tree = AnnoTree.fromstring_many(SAMPLE)[1]
+        self.assertEqual(pickle.loads(pickle.dumps(tree)), tree)
+        clone = copy.deepcopy(tree)
+        self.assertEqual(clone, tree)
+        self.assertIsNot(clone[1], tree[1])
+        self.assertEqual(clone.pretty(), tree.pretty())
+
+    def test_ordering(self):
+        (a, b) = (AnnoTree("N", ["a"]), AnnoTree("N", ["b"]))
+        self.assertTrue(a < b and a <= b and b > a and b >= a and a <= a >= a)
+        self.assertFalse(b <= a or a >= b)
+        for compare in [lambda: a <= "N", lambda: a >= 1, lambda: a < None]:
+            with self.assertRaises(TypeError):
+                compare()
+
+    def test_nltk_api(self):
+        tree = AnnoTree.fromstring("( (IP-MAT (NP-SBJ (D This)) (BEP is)))")
+        self.assertEqual(tree.leaves(), ["This", "is"])
+        self.assertEqual(tree.pos(), [("This", "D"), ("is", "BEP")])
+        self.assertEqual([t.label() for t in tree.subtrees()],
+                         ["", "IP-MAT", "NP-SBJ", "D", "BEP"])
+        self.assertEqual(str(tree), "( (IP-MAT (NP-SBJ (D This)) (BEP is)))")
+        self.assertEqual(
+            tree.pformat(margin=20),
+            str(T.Tree.fromstring(str(tree)).pformat(margin=20)))
+
+    def test_pretty_matches_recursive(self):
+        trees = AnnoTree.fromstring_many(
+            SAMPLE + "\n\n( (COMMENT (ANNO a \\(b\\)) c) (NP (N x) ( )))")
+        for tree in trees:
+            self.assertEqual(tree.pretty(), _recursive_pretty(tree))
+            self.assertEqual(tree.pretty(padding=3), _recursive_pretty(tree, 3))
+        self.assertIn("(COMMENT (ANNO a (b))", trees[-1].pretty())
+
+    def test_pretty_deep_tree(self):
+        tree = AnnoTree("N", ["x"])
+        for _ in range(5000):
+            tree = AnnoTree("NP", [tree])
+        text = tree.pretty()
+        self.assertEqual(text.count("("), 5001)
+        self.assertEqual(AnnoTree.fromstring(text).pretty(), text)
+
+    def test_terminal_codec(self):
+        codec = annotree.TerminalCodec(maxsize=2)
+        info = codec.decode("so_1_þgf_op_subj_nf_þt_fh_p1_mm")
+        self.assertEqual(dict(info.data), {
+            "cat": "so", "obj1": "þgf", "impersonal": "subj", "subj": "nf",
+            "person": "p1", "mood": "fh", "tense": "þt", "voice": "mm"})
+        self.assertEqual(info.variants["obj1"], "þgf")
+        self.assertNotIn("cat", info.variants)
+        self.assertEqual(info.css_class, "snode terminal-so")
+        self.assertIs(codec.decode("so_1_þgf_op_subj_nf_þt_fh_p1_mm"), info)
+        self.assertEqual(dict(codec.decode("so_lh_þt_hk").data),
+                         {"cat": "so", "mood": "lhþt"})
+        self.assertEqual(dict(codec.decode("grm").data), {"cat": "grm"})
+        self.assertEqual(codec.stats()["size"], 1)
+        self.assertEqual((codec.hits, codec.misses), (1, 3))
+        self.assertEqual(annotree.split_flat_terminal("no_et_nf_kk_gr"),
+                         {"cat": "no", "article": "gr", "case": "nf",
+                          "gender": "kk", "number": "et"})
+
+    def test_to_html_matches_elementtree(self):
+        trees = AnnoTree.fromstring_many(
+            SAMPLE + '\n\n( (META (ID-LOCAL a&b<c>"d") (ID-CORPUS x) (COMMENT )'
+            ' (URL u)) (NP-SBJ (no_et_nf_kk "a&b<c>" (lemma a>b))'
+            ' (grm x (exp_abbrev y&z)) (lo_x q (lemma l) (exp_seg s))))'
+            '\n\n( (no_ft_þf_hk tré (lemma tré)))')
+        for tree in trees:
+            self.assertEqual(AnnoTree.to_html(tree, None),
+                             _EtreeHtml.to_html(tree, None))
@@ -0,0 +1,115 @@
+# This Python file uses the following encoding: utf-8
+
+"""
+The page's scripts and style sheets, each concatenated into one bundle.
+
+A bundle is named after the hash of its contents (``annotald-<hash>.js``)
+and is gzipped once when it is built, so it can be served with a far
+future, immutable Cache-Control: a changed bundle is a new URL, and a
+browser that has loaded the page before needs no request for it at all.
+
+Bundles are built when the server starts and rebuilt when one of their
+source files changes (the user's settings.js, say), which is checked
+with a stat of each file on every page load.  Scripts are minified with
+rjsmin and style sheets with rcssmin when those are installed; files
+that are minified already are left alone.
+"""
+
+from collections import namedtuple
+import gzip
+import os
+
+from annotald.treeindex import tree_digest
+
+try:
+    import rjsmin
+except ImportError:
+    rjsmin = None
+
+try:
+    import rcssmin
+except ImportError:
+    rcssmin = None
+
+
+ASSET_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+Asset = namedtuple("Asset", ["name", "content_type", "data", "gzipped", "digest"])
+
+
+def _is_minified(filename):
+    name = os.path.basename(filename)
+    return name.endswith(".min.js") or name == "jquery.js"
+
+
+def _minify_js(text, filename):
+    if rjsmin is None or _is_minified(filename):
+        return text
+    return rjsmin.jsmin(text)
+
+
+def _minify_css(text, filename):
+    if rcssmin is None:
+        return text
+    return rcssmin.cssmin(text)
+
+
+class AssetBundle(object):
+    def __init__(self, scripts, styles, minify=True):
+        """
+        scripts and styles are lists of file names, in the order they
+        are to be loaded in
+        """
+        self.scripts = list(scripts)
+        self.styles = list(styles)
+        self.minify = minify
+        # Every asset built, by name; pages loaded before a rebuild may
+        # still ask for the older ones
+        self._assets = {}
+        self._stamps = None
+        self.script_name = None
+        self.style_name = None
+
+    def _sources_stamp(self):
+        stamps = []
+        for filename in self.scripts + self.styles:
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                stamps.append((filename, None))
+            else:
+                stamps.append((filename, stat.st_size, stat.st_mtime_ns))
+        return stamps
+
+    def refresh(self):
+        """ Build the bundles if a source file changed since they were built """
+        stamps = self._sources_stamp()
+        if stamps == self._stamps:
+            return
+        self.script_name = self._build(
+            self.scripts, "js", "application/javascript", _minify_js, ";\n"
+        ).name
+        self.style_name = self._build(
+            self.styles, "css", "text/css", _minify_css, "\n"
+        ).name
+        self._stamps = stamps
+
+    def _build(self, filenames, suffix, content_type, minify, separator):
+        parts = []
+        for filename in filenames:
+            with open(filename, encoding="utf-8") as fh:
+                text = fh.read()
+            if self.minify:
+                text = minify(text, filename)
+            parts.append(text)
+        data = separator.join(parts).encode("utf-8")
+        digest = tree_digest(data)
+        name = "annotald-%s.%s" % (digest[:16], suffix)
+        if name not in self._assets:
+            self._assets[name] = Asset(
+                name, content_type, data, gzip.compress(data, 9, mtime=0), digest
+            )
+        return self._assets[name]
+
+    def get(self, name):
+        return self._assets.get(name)
@@ -0,0 +1,43 @@
+import gzip, os, shutil, tempfile, unittest
+
+from annotald.assets import AssetBundle
+
+
+class AssetBundleTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, text):
+        path = os.path.join(self.dir, name)
+        with open(path, "w", encoding="utf-8") as fh:
+            fh.write(text)
+        return path
+
+    def test_bundle(self):
+        one = self.write("one.js", "var one = 1;")
+        two = self.write("two.js", "var two = one + 1;")
+        style = self.write("a.css", "div { color: red; }")
+        bundle = AssetBundle([one, two], [style], minify=False)
+        bundle.refresh()
+        script = bundle.get(bundle.script_name)
+        self.assertTrue(bundle.script_name.endswith(".js"))
+        self.assertEqual(script.data, b"var one = 1;;\nvar two = one + 1;")
+        self.assertEqual(gzip.decompress(script.gzipped), script.data)
+        self.assertEqual(bundle.get(bundle.style_name).content_type, "text/css")
+        self.assertIsNone(bundle.get("annotald-0.js"))
+
+    def test_rebuilt_when_a_source_changes(self):
+        settings = self.write("settings.js", "var a = 1;")
+        bundle = AssetBundle([settings], [], minify=False)
+        bundle.refresh()
+        old_name = bundle.script_name
+        bundle.refresh()
+        self.assertEqual(bundle.script_name, old_name)
+        self.write("settings.js", "var a = 2; // edited")
+        bundle.refresh()
+        self.assertNotEqual(bundle.script_name, old_name)
+        # Pages loaded before the edit can still fetch the old bundle
+        self.assertEqual(bundle.get(old_name).data, b"var a = 1;")
@@ -0,0 +1,478 @@
+# This Python file uses the following encoding: utf-8
+
+"""
+The server's model of the corpus being edited.
+
+A Corpus holds a TreeRecord for each tree, in file order, and is the only
+place the server reads trees from.  A record starts out as a position in
+the memory-mapped CorpusFile; its text, version (the md5 of the text),
+parse and JSON are worked out the first time they are asked for and kept
+for the MAX_WARM_TREES trees used most recently.  Giving a tree a new
+text drops its other forms and marks it dirty until it is saved.
+
+Saves of single trees go to the write-ahead Journal, whose trees the
+records take their text from until it is compacted into the file; a full
+save writes only the trees that differ from the file.  Files that cannot
+be indexed (CorpusSearch output) are held as a list of texts instead.
+
+The server reads and changes the corpus from many threads at once.
+Changes are copy-on-write: a published list of records, and the text of
+a record in it, is never changed; writers build a new list, with new
+records for the trees they change, and publish it with one assignment.
+A reader that takes the list once (or a snapshot()) thus sees one state
+of the corpus throughout, and never waits for a writer.  Writers are
+serialized by the corpus's lock, which callers also hold around their
+own read-check-write sequences (the version check of a save, say).
+"""
+
+import bisect
+from collections import OrderedDict
+import copy
+import threading
+
+from annotald import util
+from annotald.annotree import AnnoTree
+from annotald.corpusfile import CorpusFile
+from annotald.journal import Journal
+from annotald.searchindex import SearchIndex, is_indexable
+from annotald.treeindex import tree_digest, tree_id_from_bytes
+
+
+# Trees whose parse and JSON are kept in memory
+MAX_WARM_TREES = 4096
+# Rough sizes for estimating the memory a corpus takes: a record (and
+# its index entry), and a warm tree's parse and JSON per byte of text
+RECORD_BYTES = 400
+WARM_BYTES_PER_BYTE = 15
+
+
+class TreeRecord(object):
+    """
+    One tree of a Corpus.  entry is the tree's position in the CorpusFile
+    file, or None if it is not in a file; text is None as long as the
+    tree is as in the file.  Only the memoized forms (version, tree and
+    json) of a published record are ever set.
+    """
+
+    __slots__ = ("file", "entry", "tree_id", "text", "version", "tree", "json",
+                 "dirty")
+
+    def __init__(self, file=None, entry=None, tree_id=None, text=None,
+                 version=None, dirty=False):
+        self.file = file
+        self.entry = entry
+        self.tree_id = tree_id
+        self.text = text
+        self.version = version
+        self.tree = None
+        self.json = None
+        self.dirty = dirty
+
+    def changed(self, text, dirty=True):
+        """ A copy of the record with a new text """
+        return TreeRecord(self.file, self.entry, self.tree_id, text, dirty=dirty)
+
+    def forget(self):
+        """ Drop the forms worked out from the text """
+        self.tree = None
+        self.json = None
+
+
+class Corpus(object):
+    def __init__(self, filename, corpus_file=None, journal=None,
+                 version_cookie=""):
+        self.filename = str(filename)
+        self.file = corpus_file
+        self.journal = journal
+        self.version_cookie = version_cookie
+        self.records = []
+        # Whether trees were added or removed since the file was loaded,
+        # so that records no longer line up with the file's trees
+        self.restructured = False
+        # Counts the commits after which a position may hold another tree
+        # (loads, and trees replaced by more or fewer trees)
+        self.generation = 0
+        # Held by writers; reentrant, so callers can hold it around calls
+        self.lock = threading.RLock()
+        # (records, {tree_id: position}) for the records it was built for
+        self._positions = (None, None)
+        self._warm = OrderedDict()
+        self._warm_lock = threading.Lock()
+        # Built on the first search, and kept up to date by writers
+        self._search = None
+        # The corpus whose search index snapshots share: copies of this
+        # one keep pointing to it
+        self._live = self
+        if corpus_file is not None:
+            self._load()
+
+    @classmethod
+    def open(cls, filename, cache=None, workers=1):
+        """ The corpus of an Annotald file, with its journal replayed """
+        return cls(filename, CorpusFile(filename, cache=cache, workers=workers),
+                   Journal.for_file(filename))
+
+    @classmethod
+    def read(cls, filename):
+        """ The corpus of a file read as plain text (CorpusSearch output) """
+        with open(filename, "r", encoding="utf-8") as fh:
+            text = util.scrubText(fh.read())
+        return cls.from_text(text, filename)
+
+    @classmethod
+    def from_text(cls, text, filename=""):
+        trees = [tree for tree in text.strip().split("\n\n") if tree.strip()]
+        version_cookie = ""
+        if trees and trees[0][0:10] == "( (VERSION":
+            version_cookie = trees.pop(0)
+        corpus = cls(filename, version_cookie=version_cookie)
+        corpus.records = [TreeRecord(text=tree) for tree in trees]
+        corpus.restructured = True
+        return corpus
+
+    def snapshot(self):
+        """
+        A read-only view of the corpus as it is now, which later changes
+        do not show through
+        """
+        return copy.copy(self)
+
+    def _load(self):
+        records = [
+            TreeRecord(self.file, idx, entry.tree_id, version=entry.digest)
+            for (idx, entry) in enumerate(self.file.index.entries)
+        ]
+        if self.journal is not None:
+            for (tree_id, text) in self.journal.trees.items():
+                idx = self.file.index.position(tree_id)
+                if idx is not None:
+                    records[idx] = records[idx].changed(text, dirty=False)
+        self.version_cookie = self.file.version_cookie
+        self.restructured = False
+        self._publish(records, None)
+
+    def _commit(self, records, changed, spliced=None):
+        """
+        Make records the corpus's trees; the trees at the positions in
+        changed have new texts, and if changed is None any may have.
+        spliced, if given, is (start, old texts, new texts) when trees
+        were replaced by more or fewer trees.  Callers hold the lock.
+        """
+        if changed is None or spliced is not None:
+            self.generation += 1
+        index = self._search
+        if index is not None:
+            if spliced is not None:
+                index.splice(*spliced, records)
+            elif changed is None:
+                self._search = None
+            else:
+                index.update([
+                    (idx, self._text(self.records[idx]), self._text(records[idx]))
+                    for idx in changed
+                ], records)
+        self.records = records
+
+    def _publish(self, records, changed):
+        """ Commit records, which hold none of the warm trees """
+        self._commit(records, changed)
+        with self._warm_lock:
+            self._warm.clear()
+
+    def refresh(self):
+        """
+        Reload the file if it was changed on disk, and drop the changes
+        that were not saved
+        """
+        if self.file is None:
+            return
+        with self.lock:
+            if not self.file.is_current():
+                self.file = CorpusFile(self.filename, cache=self.file.cache,
+                                       workers=self.file.workers)
+                self._load()
+            elif self.restructured:
+                self._load()
+            elif self.is_dirty():
+                records = list(self.records)
+                changed = []
+                for (idx, record) in enumerate(records):
+                    if record.dirty:
+                        text = None
+                        if self.journal is not None:
+                            text = self.journal.get(record.tree_id)
+                        records[idx] = record.changed(text, dirty=False)
+                        changed.append(idx)
+                self._commit(records, changed)
+
+    def __len__(self):
+        return len(self.records)
+
+    def position(self, tree_id):
+        """ The position of the tree with the given ID-LOCAL, or None """
+        records = self.records
+        (indexed, positions) = self._positions
+        if indexed is not records:
+            positions = {}
+            for (idx, record) in enumerate(records):
+                if record.tree_id is None and record.text is not None:
+                    record.tree_id = tree_id_from_bytes(record.text.encode("utf-8"))
+                if record.tree_id is not None:
+                    positions.setdefault(record.tree_id, idx)
+            self._positions = (records, positions)
+        return positions.get(tree_id)
+
+    def _window(self, start, end):
+        """ The records in positions start:end, as one state of the corpus """
+        records = self.records
+        return records[max(0, start) : len(records) if end is None else end]
+
+    @staticmethod
+    def _text(record):
+        if record.text is None:
+            return record.file.text(record.entry)
+        return record.text
+
+    @classmethod
+    def _version(cls, record):
+        if record.version is None:
+            record.version = tree_digest(cls._text(record).encode("utf-8"))
+        return record.version
+
+    def text(self, idx):
+        return self._text(self.records[idx])
+
+    def texts(self, start=0, end=None):
+        return [self._text(record) for record in self._window(start, end)]
+
+    def version(self, idx):
+        """ The md5 of the text of a tree, by which clients address it """
+        return self._version(self.records[idx])
+
+    def versions(self, start=0, end=None):
+        return [self._version(record) for record in self._window(start, end)]
+
+    def trees(self, start=0, end=None):
+        """ The parsed trees in positions start:end; do not modify them """
+        return self._trees(self._window(start, end))
+
+    def _trees(self, records):
+        trees = [record.tree for record in records]
+        from_file = OrderedDict()
+        for (i, record) in enumerate(records):
+            if trees[i] is not None:
+                continue
+            if record.text is None:
+                from_file.setdefault(record.file, []).append(i)
+            else:
+                trees[i] = record.tree = AnnoTree.fromstring(record.text)
+        for (corpus_file, missing) in from_file.items():
+            parsed = corpus_file.trees_at([records[i].entry for i in missing])
+            for (i, tree) in zip(missing, parsed):
+                trees[i] = records[i].tree = tree
+        for record in records:
+            self._touch(record)
+        return trees
+
+    def json(self, start=0, end=None):
+        """
+        The trees in positions start:end as the JSON sent to the client,
+        each with its version; do not modify them
+        """
+        records = self._window(start, end)
+        aug_trees = [record.json for record in records]
+        missing = [i for (i, aug_tree) in enumerate(aug_trees) if aug_tree is None]
+        if missing:
+            trees = self._trees([records[i] for i in missing])
+            for (i, tree) in zip(missing, trees):
+                aug_tree = tree.to_json()
+                aug_tree["version"] = self._version(records[i])
+                aug_trees[i] = records[i].json = aug_tree
+                # Parsing may have pushed it out of the warm trees already
+                self._touch(records[i])
+        return aug_trees
+
+    def _touch(self, record):
+        with self._warm_lock:
+            self._warm[record] = None
+            self._warm.move_to_end(record)
+            if len(self._warm) > MAX_WARM_TREES:
+                self._warm.popitem(last=False)[0].forget()
+
+    def set_text(self, idx, text):
+        """ Give the tree at idx a new text; it is dirty until saved """
+        self.replace(idx, idx + 1, [text])
+
+    def replace(self, start, end, texts):
+        """ Replace the trees in positions start:end by texts """
+        texts = list(texts)
+        with self.lock:
+            records = list(self.records)
+            end = min(end, len(records))
+            if len(texts) == end - start:
+                changed = []
+                for (idx, text) in enumerate(texts, start):
+                    if text != self._text(records[idx]):
+                        records[idx] = records[idx].changed(text)
+                        changed.append(idx)
+            else:
+                old_texts = [self._text(record) for record in records[start:end]]
+                records[start:end] = [TreeRecord(text=text, dirty=True)
+                                      for text in texts]
+                self.restructured = True
+                # Trees after them moved
+                self._commit(records, None, (start, old_texts, texts))
+                return
+            self._commit(records, changed)
+
+    def memory_estimate(self):
+        """ A rough estimate of the memory the corpus takes, in bytes """
+        with self._warm_lock:
+            warm = list(self._warm)
+        text_bytes = 0
+        for record in warm:
+            if record.text is None:
+                text_bytes += record.file.index[record.entry].length
+            else:
+                text_bytes += len(record.text)
+        return len(self.records) * RECORD_BYTES + text_bytes * WARM_BYTES_PER_BYTE
+
+    def _indexed_positions(self, text, records):
+        """
+        The positions of the trees of records that contain text, in
+        order, or None if the search index cannot answer
+        """
+        if not is_indexable(text):
+            return None
+        live = self._live
+        index = live._search
+        if index is None:
+            with live.lock:
+                index = live._search
+                if index is None:
+                    index = live._search = SearchIndex(live.texts(), live.records)
+        # None for a snapshot the corpus has moved on from
+        return index.positions(text, records)
+
+    def search(self, text, start=0, end=None):
+        """ The positions in start:end of the trees whose text contains text """
+        records = self.records
+        (start, end) = (max(0, start), len(records) if end is None else end)
+        positions = self._indexed_positions(text, records)
+        if positions is None:
+            return [idx for idx in range(start, min(end, len(records)))
+                    if text in self._text(records[idx])]
+        return list(positions[bisect.bisect_left(positions, start) :
+                              bisect.bisect_left(positions, end)])
+
+    def find(self, text, start=0, end=None):
+        """ The first position in start:end of a tree containing text, or None """
+        records = self.records
+        (start, end) = (max(0, start), len(records) if end is None else end)
+        positions = self._indexed_positions(text, records)
+        if positions is None:
+            for idx in range(start, min(end, len(records))):
+                if text in self._text(records[idx]):
+                    return idx
+            return None
+        i = bisect.bisect_left(positions, start)
+        if i < len(positions) and positions[i] < end:
+            return positions[i]
+        return None
+
+    def count(self, text, start=0, end=None):
+        """ The number of trees in positions start:end that contain text """
+        records = self.records
+        (start, end) = (max(0, start), len(records) if end is None else end)
+        positions = self._indexed_positions(text, records)
+        if positions is None:
+            return sum(1 for idx in range(start, min(end, len(records)))
+                       if text in self._text(records[idx]))
+        return (bisect.bisect_left(positions, end)
+                - bisect.bisect_left(positions, start))
+
+    def is_dirty(self):
+        return any(record.dirty for record in self.records)
+
+    def save_trees(self, texts):
+        """
+        Durably save new texts of some trees, a dict keyed by ID-LOCAL,
+        to the journal.  Returns the new versions of the trees.
+        """
+        with self.lock:
+            self.journal.append(texts)
+            records = list(self.records)
+            versions = {}
+            changed = []
+            for (tree_id, text) in texts.items():
+                idx = self.position(tree_id)
+                records[idx] = records[idx].changed(text, dirty=False)
+                versions[tree_id] = self._version(records[idx])
+                changed.append(idx)
+            self._commit(records, changed)
+            if self.journal.needs_compaction():
+                self.compact()
+            return versions
+
+    def compact(self):
+        """ Write the journaled trees to the corpus file """
+        with self.lock:
+            if self.journal is None or not len(self.journal):
+                return
+            self.file = self.journal.compact(self.file)
+            # Every record moves to the new file, so that the old one is
+            # unmapped once no snapshot holds it
+            self._rebase(keep_dirty=True)
+
+    def _rebase(self, keep_dirty):
+        """
+        Point the records at self.file, which holds every tree whose
+        text is held apart from the file except the dirty ones (if
+        keep_dirty is true)
+        """
+        records = []
+        for record in self.records:
+            if record.entry is None:
+                # Added since the file was loaded
+                records.append(record)
+                continue
+            if record.dirty and keep_dirty:
+                text = record.text
+            else:
+                text = None
+            moved = TreeRecord(self.file, record.entry, record.tree_id, text,
+                               dirty=text is not None)
+            if text is None:
+                moved.version = self.file.index[record.entry].digest
+            records.append(moved)
+        # The texts are the same, only held elsewhere
+        self._publish(records, [])
+
+    def write(self):
+        """
+        Write every tree to the file.  When the trees still line up with
+        the file's, only the ones that differ from it are written.
+        """
+        with self.lock:
+            if self.file is not None and not self.restructured:
+                texts = {
+                    record.entry: record.text
+                    for record in self.records
+                    if record.text is not None
+                }
+                if texts:
+                    self.file = self.file.replace_trees(texts)
+                    self._rebase(keep_dirty=False)
+            else:
+                util.writeTreesToFile(self.version_cookie, "\n\n".join(self.texts()),
+                                      self.filename)
+                if self.file is None:
+                    self._commit([record.changed(record.text, dirty=False)
+                                  for record in self.records], [])
+            if self.journal is not None:
+                # Everything journaled is in the file now
+                self.journal.clear()
+            if self.file is not None and self.restructured:
+                self.file = CorpusFile(self.filename, cache=self.file.cache,
+                                       workers=self.file.workers)
+                self._load()
@@ -0,0 +1,174 @@
+import os, shutil, tempfile, threading, unittest
+
+from annotald import corpus as corpus_module
+from annotald.corpus import Corpus
+from annotald.treeindex import tree_digest
+
+TEXT = """( (VERSION (FORMAT dash)))
+
+( (META (ID-LOCAL t.psd,.1) (COMMENT )) (S0 (grm a)))
+
+( (META (ID-LOCAL t.psd,.2) (COMMENT )) (S0 (grm b)))
+
+( (META (ID-LOCAL t.psd,.3) (COMMENT )) (S0 (grm c)))
+"""
+
+EDITED = "( (META (ID-LOCAL t.psd,.2) (COMMENT )) (S0 (grm edited)))"
+
+
+class CorpusTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "t.psd")
+        with open(self.path, "w", encoding="utf-8") as fh:
+            fh.write(TEXT)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def read(self):
+        with open(self.path, encoding="utf-8") as fh:
+            return fh.read()
+
+    def test_records(self):
+        corpus = Corpus.open(self.path)
+        self.assertEqual(corpus.version_cookie, "( (VERSION (FORMAT dash)))")
+        self.assertEqual(len(corpus), 3)
+        self.assertEqual(corpus.position("t.psd,.3"), 2)
+        self.assertEqual(corpus.text(1), "( (META (ID-LOCAL t.psd,.2) (COMMENT )) (S0 (grm b)))")
+        self.assertEqual(corpus.version(1), tree_digest(corpus.text(1).encode("utf-8")))
+        (aug_tree,) = corpus.json(1, 2)
+        self.assertEqual(aug_tree["meta"]["tree_id"], "t.psd,.2")
+        self.assertEqual(aug_tree["version"], corpus.version(1))
+        # Memoized until the tree changes
+        self.assertIs(corpus.json(1, 2)[0], aug_tree)
+        corpus.set_text(1, EDITED)
+        self.assertIsNot(corpus.json(1, 2)[0], aug_tree)
+        self.assertTrue(corpus.is_dirty())
+
+    def test_refresh_drops_unsaved_changes(self):
+        corpus = Corpus.open(self.path)
+        corpus.set_text(1, EDITED)
+        corpus.replace(0, 1, [])
+        self.assertEqual(len(corpus), 2)
+        corpus.refresh()
+        self.assertEqual(len(corpus), 3)
+        self.assertFalse(corpus.is_dirty())
+        self.assertEqual(corpus.texts(), Corpus.from_text(TEXT).texts())
+
+    def test_save_trees_journals(self):
+        corpus = Corpus.open(self.path)
+        versions = corpus.save_trees({"t.psd,.2": EDITED})
+        self.assertEqual(versions, {"t.psd,.2": tree_digest(EDITED.encode("utf-8"))})
+        self.assertEqual(self.read(), TEXT)
+        self.assertFalse(corpus.is_dirty())
+        # A corpus opened after a crash replays the journal
+        reopened = Corpus.open(self.path)
+        self.assertEqual(reopened.text(1), EDITED)
+        self.assertEqual(reopened.version(1), versions["t.psd,.2"])
+        corpus.compact()
+        self.assertEqual(self.read(), TEXT.replace("(grm b)", "(grm edited)"))
+        self.assertEqual(corpus.text(1), EDITED)
+
+    def test_write(self):
+        corpus = Corpus.open(self.path)
+        corpus.save_trees({"t.psd,.2": EDITED})
+        corpus.set_text(2, "( (META (ID-LOCAL t.psd,.3) (COMMENT )) (S0 (grm d)))")
+        corpus.write()
+        self.assertEqual(self.read(), TEXT.replace("(grm b)", "(grm edited)")
+                         .replace("(grm c)", "(grm d)"))
+        self.assertFalse(os.path.exists(self.path + ".journal"))
+        self.assertFalse(corpus.is_dirty())
+        # Trees added or removed are written out whole
+        corpus.replace(0, 1, [])
+        corpus.write()
+        self.assertEqual(self.read(), "\n\n".join(corpus.texts()))
+        self.assertEqual(len(Corpus.open(self.path)), 2)
+        self.assertFalse(corpus.restructured)
+
+    def test_warm_trees_are_bounded(self):
+        corpus = Corpus.open(self.path)
+        old_max = corpus_module.MAX_WARM_TREES
+        corpus_module.MAX_WARM_TREES = 2
+        try:
+            corpus.json()
+        finally:
+            corpus_module.MAX_WARM_TREES = old_max
+        self.assertIsNone(corpus.records[0].json)
+        self.assertIsNotNone(corpus.records[2].json)
+
+    def test_from_text(self):
+        corpus = Corpus.from_text(TEXT)
+        self.assertEqual(corpus.version_cookie, "( (VERSION (FORMAT dash)))")
+        self.assertEqual(len(corpus), 3)
+        self.assertEqual(corpus.position("t.psd,.2"), 1)
+        self.assertEqual(corpus.trees(2, 3)[0][1].label(), "S0")
+
+    def test_snapshot(self):
+        corpus = Corpus.open(self.path)
+        snapshot = corpus.snapshot()
+        corpus.set_text(1, EDITED)
+        self.assertEqual(corpus.generation, snapshot.generation)
+        corpus.replace(0, 1, [])
+        # Positions now hold other trees
+        self.assertGreater(corpus.generation, snapshot.generation)
+        self.assertEqual(len(snapshot), 3)
+        self.assertEqual(snapshot.texts(), Corpus.from_text(TEXT).texts())
+        self.assertEqual(snapshot.position("t.psd,.3"), 2)
+        self.assertEqual(corpus.position("t.psd,.3"), 1)
+        # Snapshots outlive the file they read from
+        corpus.refresh()
+        corpus.save_trees({"t.psd,.2": EDITED})
+        corpus.compact()
+        self.assertEqual(snapshot.text(1), Corpus.from_text(TEXT).text(1))
+        self.assertEqual(corpus.text(1), EDITED)
+
+    def test_concurrent_saves(self):
+        corpus = Corpus.open(self.path)
+        texts = [TEXT.split("\n\n")[2].replace("(grm b)", "(grm b%d)" % i)
+                 for i in range(20)]
+        threads = [
+            threading.Thread(target=corpus.save_trees, args=({"t.psd,.2": text},))
+            for text in texts
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertIn(corpus.text(1), texts)
+        self.assertEqual(Corpus.open(self.path).text(1), corpus.text(1))
+
+    def test_search(self):
+        corpus = Corpus.open(self.path)
+        self.assertEqual(corpus.search("grm"), [0, 1, 2])
+        self.assertEqual(corpus.find("t.psd,.2"), 1)
+        self.assertEqual(corpus.count("grm", 1), 2)
+        self.assertIsNone(corpus.find("edited"))
+        # Searches that span atoms scan the texts
+        self.assertEqual(corpus.search("(grm b)"), [1])
+        # The index follows saved and edited trees
+        corpus.save_trees({"t.psd,.2": EDITED})
+        self.assertEqual(corpus.search("edited"), [1])
+        corpus.set_text(2, "( (META (ID-LOCAL t.psd,.3) (COMMENT )) (S0 (grm edits)))")
+        self.assertEqual(corpus.search("edit"), [1, 2])
+        self.assertEqual(corpus.count("edit", 2, 3), 1)
+        corpus.replace(0, 1, [])
+        self.assertEqual(corpus.search("edit"), [0, 1])
+        corpus.refresh()
+        self.assertEqual(corpus.search("edit"), [1])
+
+    def test_snapshots_share_the_search_index(self):
+        corpus = Corpus.open(self.path)
+        snapshot = corpus.snapshot()
+        self.assertEqual(snapshot.search("grm"), [0, 1, 2])
+        index = corpus._search
+        self.assertIsNotNone(index)
+        self.assertEqual(corpus.snapshot().count("grm"), 3)
+        # Trees added or removed are spliced into the same index
+        corpus.replace(0, 1, [EDITED, EDITED])
+        self.assertIs(corpus._search, index)
+        self.assertEqual(corpus.search("edited"), [0, 1])
+        self.assertEqual(corpus.search("grm"), [0, 1, 2, 3])
+        self.assertEqual(corpus.find("t.psd,.3"), 3)
+        # A stale snapshot scans its own texts
+        self.assertEqual(snapshot.search("edited"), [])
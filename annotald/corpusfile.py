@@ -0,0 +1,189 @@
+# This Python file uses the following encoding: utf-8
+
+"""
+Memory-mapped, read-only access to the trees of a corpus file.
+
+The file is mapped into memory instead of being read into a Python string,
+so the operating system page cache holds the only copy of it, shared by all
+Annotald processes on the host that have the file open.  Tree boundaries
+come from the sidecar TreeIndex, which is built on the raw bytes of the
+mapping; a tree is only decoded (and parsed) when it is asked for.
+
+Files are never written in place while mapped; the writers in util replace
+the file with a new one, so a mapping always sees a consistent file.
+replace_trees writes such a new file by copying the unchanged byte ranges
+straight from the mapping, so saving a few edited trees costs no parsing or
+formatting of the others.
+"""
+
+import mmap
+import os
+
+from annotald import parallel, util
+from annotald.annotree import AnnoTree
+from annotald.treecache import gc_paused
+from annotald.treeindex import TreeIndex
+
+
+class CorpusFile(object):
+    """
+    A corpus file mapped into memory.
+
+    If a TreeCache is given, parsed trees are taken from it and trees that
+    are not in it yet are added to it.  When many trees have to be parsed
+    at once, up to workers processes are used (None for one per CPU).
+    """
+
+    def __init__(self, filename, cache=None, index=None, workers=1):
+        self.filename = str(filename)
+        self.cache = cache
+        self.workers = workers
+        self._handle = open(self.filename, "rb")
+        if os.fstat(self._handle.fileno()).st_size:
+            self._map = mmap.mmap(
+                self._handle.fileno(), 0, access=mmap.ACCESS_READ
+            )
+        else:
+            # Zero-length files cannot be mapped
+            self._map = b""
+        if index is None:
+            index = TreeIndex.for_file(self.filename, data=self._map)
+        self.index = index
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+        self._handle.close()
+
+    def is_current(self):
+        """ Whether the file on disk is still the one that was mapped """
+        return self.index.is_current()
+
+    @property
+    def version_cookie(self):
+        entry = self.index.version_cookie
+        if entry is None:
+            return ""
+        return self._map[entry.offset : entry.offset + entry.length].decode("utf-8")
+
+    def __len__(self):
+        return len(self.index)
+
+    def raw(self, idx):
+        entry = self.index[idx]
+        return self._map[entry.offset : entry.offset + entry.length]
+
+    def text(self, idx):
+        return self.raw(idx).decode("utf-8")
+
+    def texts(self, start=0, end=None):
+        end = len(self) if end is None else min(end, len(self))
+        return [self.text(idx) for idx in range(start, end)]
+
+    def _tree(self, idx):
+        if self.cache is None:
+            return AnnoTree.fromstring_many(self.text(idx))[0]
+        digest = self.index[idx].digest
+        tree = self.cache.get(digest)
+        if tree is None:
+            tree = AnnoTree.fromstring_many(self.text(idx))[0]
+            self.cache.put(digest, tree)
+        return tree
+
+    def tree(self, idx):
+        tree = self._tree(idx)
+        if self.cache is not None:
+            self.cache.flush()
+        return tree
+
+    def trees(self, start=0, end=None):
+        """ Parse (or fetch from the cache) the trees in positions start:end """
+        end = len(self) if end is None else min(end, len(self))
+        trees = self.trees_at(range(start, end), flush=False)
+        if self.cache is not None:
+            if start == 0 and end == len(self):
+                self.cache.sync(self.index)
+            else:
+                self.cache.flush()
+        return trees
+
+    def trees_at(self, positions, flush=True):
+        """ Parse (or fetch from the cache) the trees at some positions """
+        positions = list(positions)
+        with gc_paused():
+            trees = []
+            missing = []
+            for (i, idx) in enumerate(positions):
+                tree = None
+                if self.cache is not None:
+                    tree = self.cache.get(self.index[idx].digest)
+                if tree is None:
+                    missing.append(i)
+                trees.append(tree)
+            parsed = parallel.parse_spans(
+                self._map,
+                [
+                    (self.index[positions[i]].offset, self.index[positions[i]].length)
+                    for i in missing
+                ],
+                self.workers,
+            )
+            for (i, tree) in zip(missing, parsed):
+                trees[i] = tree
+                if self.cache is not None:
+                    self.cache.put(self.index[positions[i]].digest, tree)
+        if flush and self.cache is not None:
+            self.cache.flush()
+        return trees
+
+    def iter_trees(self):
+        for idx in range(len(self)):
+            yield self.tree(idx)
+
+    def replace_trees(self, texts):
+        """
+        Replace the trees at some positions in the file on disk.
+
+        texts maps positions to the new tree strings.  A new file is written
+        from the mapping with only those trees changed and renamed into
+        place; the index is shifted rather than rebuilt.  This CorpusFile
+        keeps mapping the old file; a CorpusFile for the new one is returned.
+        """
+        replacements = {
+            idx: text.encode("utf-8") for (idx, text) in texts.items()
+        }
+        tmp_name = self.filename + ".tmp"
+        with open(tmp_name, "wb") as fh, memoryview(self._map) as view:
+            pos = 0
+            for idx in sorted(replacements):
+                entry = self.index[idx]
+                fh.write(view[pos : entry.offset])
+                fh.write(replacements[idx])
+                pos = entry.offset + entry.length
+            fh.write(view[pos:])
+            fh.flush()
+            os.fsync(fh.fileno())
+        util.replaceFile(tmp_name, self.filename)
+
+        index = TreeIndex(
+            self.filename,
+            entries=self.index.entries,
+            version_cookie=self.index.version_cookie,
+        )
+        index.splice(replacements)
+        index.save()
+        if self.cache is not None:
+            for idx in replacements:
+                if index[idx].digest not in self.cache:
+                    self.cache.put(index[idx].digest,
+                                   AnnoTree.fromstring_many(texts[idx])[0])
+            self.cache.sync(index)
+        return CorpusFile(self.filename, cache=self.cache, index=index,
+                          workers=self.workers)
+
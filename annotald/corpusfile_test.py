@@ -0,0 +1,64 @@
+import os, shutil, tempfile, unittest
+
+from annotald import util
+from annotald.corpusfile import CorpusFile
+
+TEXT = """( (VERSION (FORMAT dash)))
+
+( (META (ID-LOCAL t.psd,.1)) (S0 (X a)))
+
+( (META (ID-LOCAL t.psd,.2)) (S0 (X b)))
+"""
+
+
+class CorpusFileTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "t.psd")
+        with open(self.path, "w", encoding="utf-8") as fh:
+            fh.write(TEXT)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_corpus_file(self):
+        with CorpusFile(self.path) as corpus:
+            self.assertEqual(corpus.version_cookie, "( (VERSION (FORMAT dash)))")
+            self.assertEqual(len(corpus), 2)
+            self.assertEqual(corpus.text(1), "( (META (ID-LOCAL t.psd,.2)) (S0 (X b)))")
+            self.assertEqual(corpus.tree(0)[1].label(), "S0")
+
+    def test_mapping_survives_replacement(self):
+        corpus = CorpusFile(self.path)
+        texts = [corpus.text(0), "(S0 (X c))", "(S0 (X d))"]
+        # The file is replaced, not truncated, so the mapping stays valid
+        util.writeTreesToFile("", "\n\n".join(texts), self.path)
+        self.assertFalse(corpus.is_current())
+        self.assertEqual(corpus.text(0), "( (META (ID-LOCAL t.psd,.1)) (S0 (X a)))")
+        with CorpusFile(self.path) as new_corpus:
+            self.assertEqual(new_corpus.texts(), texts)
+        corpus.close()
+
+    def test_empty_file(self):
+        open(self.path, "w").close()
+        with CorpusFile(self.path) as corpus:
+            self.assertEqual(len(corpus), 0)
+            self.assertEqual(corpus.version_cookie, "")
+
+    def test_replace_trees(self):
+        corpus = CorpusFile(self.path)
+        new_corpus = corpus.replace_trees(
+            {0: "( (META (ID-LOCAL t.psd,.1))\n  (S0 (X longer)))"})
+        self.assertTrue(new_corpus.is_current())
+        self.assertEqual(corpus.text(0), "( (META (ID-LOCAL t.psd,.1)) (S0 (X a)))")
+        with open(self.path, encoding="utf-8") as fh:
+            self.assertEqual(fh.read(), TEXT.replace(
+                " (S0 (X a))", "\n  (S0 (X longer))"))
+        self.assertEqual(new_corpus.text(1), "( (META (ID-LOCAL t.psd,.2)) (S0 (X b)))")
+        # The shifted index is the one a rescan of the file gives
+        with CorpusFile(self.path) as rescanned:
+            os.unlink(self.path + ".idx")
+            rescanned.index.update()
+            self.assertEqual(rescanned.index.entries, new_corpus.index.entries)
+        corpus.close()
+        new_corpus.close()
@@ -0,0 +1,193 @@
+# This Python file uses the following encoding: utf-8
+
+"""
+A pool of long-lived CorpusSearch processes, for validation queries that
+annotald.query cannot run.
+
+Starting a JVM for every validation costs seconds.  Instead, each worker
+is a JVM running data/java/CorpusSearchWorker.java, which runs one search
+after another: the query file and the trees go to it over its standard
+input and the trees CorpusSearch writes come back over its standard
+output.  Validations wait in a queue for a free worker.  A worker that
+does not answer within the timeout is killed, and one that has answered
+MAX_REQUESTS_PER_WORKER requests is stopped (CorpusSearch keeps some
+state between searches); a fresh worker takes the place of these, and of
+any worker that exits, when it is next needed.
+
+A reply is sent, and read, whole rather than streamed: CorpusSearch
+writes its output file only as the search ends, and a validator gives
+back its trees as one string, so there is nothing to hand on earlier.
+The length sent ahead of a reply lets it be read in one call.
+"""
+
+import atexit
+import queue
+import subprocess
+import threading
+
+import pkg_resources
+
+from annotald.util import AnnotaldException
+
+
+WORKERS = 2
+TIMEOUT = 60
+MAX_REQUESTS_PER_WORKER = 500
+
+
+class CorpusSearchError(AnnotaldException):
+    pass
+
+
+def worker_command():
+    return [
+        "java",
+        "-classpath",
+        pkg_resources.resource_filename("annotald", "data/CS_Tony_oct19.jar"),
+        pkg_resources.resource_filename(
+            "annotald", "data/java/CorpusSearchWorker.java"
+        ),
+    ]
+
+
+class Worker(object):
+    def __init__(self, command):
+        self.process = subprocess.Popen(
+            command, stdin=subprocess.PIPE, stdout=subprocess.PIPE
+        )
+        self.requests = 0
+        self.timed_out = False
+
+    def run(self, queryFile, trees, timeout):
+        """
+        The trees CorpusSearch writes for the query file queryFile run on
+        trees; the worker is killed if it takes longer than timeout seconds
+        """
+        data = trees.encode("utf-8")
+        timer = threading.Timer(timeout, self._time_out)
+        timer.start()
+        try:
+            self.process.stdin.write(
+                ("%s\n%d\n" % (queryFile, len(data))).encode("utf-8") + data
+            )
+            self.process.stdin.flush()
+            header = self.process.stdout.readline().decode("utf-8").split()
+            if len(header) != 2:
+                raise OSError("no reply")
+            (status, length) = header
+            body = self.process.stdout.read(int(length)).decode("utf-8")
+        except (OSError, ValueError):
+            self.kill()
+            if self.timed_out:
+                raise CorpusSearchError(
+                    "CorpusSearch took longer than %ds on %s" % (timeout, queryFile)
+                )
+            raise CorpusSearchError(
+                "CorpusSearch exited while running %s" % queryFile
+            )
+        finally:
+            timer.cancel()
+        self.requests += 1
+        if status != "OK":
+            raise CorpusSearchError("CorpusSearch failed on %s: %s" % (queryFile, body))
+        return body
+
+    def _time_out(self):
+        self.timed_out = True
+        self.process.kill()
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def close(self):
+        self.process.stdin.close()
+        try:
+            self.process.wait(TIMEOUT)
+        except subprocess.TimeoutExpired:
+            self.kill()
+        self.process.stdout.close()
+
+    def kill(self):
+        self.process.kill()
+        self.process.wait()
+        self.process.stdin.close()
+        self.process.stdout.close()
+
+
+class WorkerPool(object):
+    def __init__(self, workers=WORKERS, timeout=TIMEOUT, command=None):
+        self.timeout = timeout
+        self.command = command or worker_command()
+        # Workers that are started and free, and places for ones that
+        # are not started yet (None)
+        self._free = queue.LifoQueue()
+        for _ in range(workers):
+            self._free.put(None)
+        self._lock = threading.Lock()
+        self._workers = set()
+
+    def run(self, queryFile, trees):
+        """ Run the query file queryFile on trees; waits for a free worker """
+        worker = self._free.get()
+        if worker is not None and not worker.alive():
+            self._retire(worker, replace=False)
+            worker = None
+        try:
+            if worker is None:
+                worker = self._start()
+            result = worker.run(queryFile, trees, self.timeout)
+        except Exception as e:
+            if (isinstance(e, CorpusSearchError) and worker is not None
+                    and worker.alive()
+                    and worker.requests < MAX_REQUESTS_PER_WORKER):
+                # CorpusSearch reported an error; the worker is fine
+                self._free.put(worker)
+            else:
+                self._retire(worker)
+            raise
+        if worker.requests >= MAX_REQUESTS_PER_WORKER:
+            self._retire(worker)
+        else:
+            self._free.put(worker)
+        return result
+
+    def _start(self):
+        try:
+            worker = Worker(self.command)
+        except OSError as e:
+            raise CorpusSearchError("Cannot start CorpusSearch: %s" % e)
+        with self._lock:
+            self._workers.add(worker)
+        return worker
+
+    def _retire(self, worker, replace=True):
+        """ Stop worker and (if replace) free its place for a new one """
+        if worker is not None:
+            with self._lock:
+                self._workers.discard(worker)
+            if worker.alive():
+                worker.close()
+        if replace:
+            self._free.put(None)
+
+    def close(self):
+        with self._lock:
+            workers = list(self._workers)
+            self._workers.clear()
+        for worker in workers:
+            if worker.alive():
+                worker.close()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def pool():
+    """ The pool shared by the validators, started when first needed """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = WorkerPool()
+            atexit.register(_pool.close)
+        return _pool
@@ -0,0 +1,72 @@
+import sys, textwrap, unittest
+
+from annotald.corpussearch import CorpusSearchError, WorkerPool
+
+# Speaks the protocol of CorpusSearchWorker.java; the "query" says what
+# to do with the trees
+FAKE_WORKER = textwrap.dedent("""
+    import os, sys, time
+    requests = 0
+    while True:
+        query = sys.stdin.buffer.readline()
+        length = sys.stdin.buffer.readline()
+        if not length:
+            break
+        trees = sys.stdin.buffer.read(int(length))
+        requests += 1
+        query = query.decode("utf-8").strip()
+        if query == "hang":
+            time.sleep(60)
+        elif query == "exit":
+            sys.exit(1)
+        if query == "fail":
+            (status, body) = ("ERROR", b"bad query")
+        elif query == "pid":
+            (status, body) = ("OK", ("%d %d" % (os.getpid(), requests)).encode())
+        else:
+            (status, body) = ("OK", trees.decode("utf-8").upper().encode("utf-8"))
+        sys.stdout.buffer.write(("%s %d\\n" % (status, len(body))).encode())
+        sys.stdout.buffer.write(body)
+        sys.stdout.buffer.flush()
+""")
+
+
+class WorkerPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.pool = WorkerPool(workers=1, timeout=5,
+                               command=[sys.executable, "-c", FAKE_WORKER])
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_run(self):
+        self.assertEqual(self.pool.run("upper", "( (ná (N þú)))"), "( (NÁ (N ÞÚ)))")
+        # The same worker answers again
+        (pid, requests) = self.pool.run("pid", "").split()
+        self.assertEqual(requests, "2")
+        self.assertEqual(self.pool.run("pid", "").split()[0], pid)
+
+    def test_errors(self):
+        pid = self.pool.run("pid", "").split()[0]
+        with self.assertRaises(CorpusSearchError):
+            self.pool.run("fail", "")
+        self.assertEqual(self.pool.run("pid", "").split()[0], pid)
+        # Workers that exit are replaced
+        with self.assertRaises(CorpusSearchError):
+            self.pool.run("exit", "")
+        self.assertNotEqual(self.pool.run("pid", "").split()[0], pid)
+
+    def test_timeout(self):
+        self.pool.timeout = 0.5
+        pid = self.pool.run("pid", "").split()[0]
+        with self.assertRaisesRegex(CorpusSearchError, "longer than"):
+            self.pool.run("hang", "")
+        self.assertNotEqual(self.pool.run("pid", "").split()[0], pid)
+
+    def test_no_worker(self):
+        pool = WorkerPool(workers=1, command=["/nonexistent/java"])
+        with self.assertRaises(CorpusSearchError):
+            pool.run("upper", "")
+        # The place of the worker is not lost
+        with self.assertRaises(CorpusSearchError):
+            pool.run("upper", "")
@@ -10,29 +10,9 @@ any later version.  See the LICENSE file for more information. -->
   <head>
     <title>Annotald</title>
     <meta http-equiv="Content-Type" content="text/html; charset=UTF-8" />
-    <link rel="stylesheet" type="text/css" href="css/treedrawing.css" />
-%if colorCSS:
-    <style type="text/css">
-    ${open(colorPath).read()}
-    </style>
-%endif
-%if debugJs:
-    <script type= "application/javascript" src="scripts/jquery-debug.js"></script>
-%else:
-    <script type= "application/javascript" src="scripts/jquery.js"></script>
-%endif
-    <script type= "application/javascript" src="scripts/jquery.mousewheel.min.js"></script>
-    <script type= "application/javascript" src="scripts/treedrawing.utils.js"></script>
-    <script type= "application/javascript" src="scripts/treedrawing.js"></script>
-    <script type= "application/javascript" src="scripts/underscore-min.js"></script>
+    <link rel="stylesheet" type="text/css" href="assets/${styleBundle}" />
     <script type="application/javascript">var startTime = ${startTime};</script>
-%for script in extraScripts:
-    <script type="application/javascript">
-      ${open(script).read()}
-    </script>
-%endfor
-    <script type= "application/javascript">  ${currentSettings} </script>
-    <script type= "application/javascript" src="scripts/treedrawing.contextMenu.js"></script>
+    <script type="application/javascript" src="assets/${scriptBundle}"></script>
 
   </head>
   <body oncontextmenu="return false;">
@@ -120,5 +100,6 @@ any later version.  See the LICENSE file for more information. -->
   </body>
   <script>
   var annotrees = ${annotrees} ;
+  var annotree_page = ${annotreePage} ;
   </script>
 </html>
@@ -0,0 +1,91 @@
+// A CorpusSearch process that runs one search after another, for
+// annotald.corpussearch.  It is run from source (Java 11 or later):
+//
+//     java -classpath CS_Tony_oct19.jar CorpusSearchWorker.java
+//
+// Each request on standard input is the path of a query file on a line,
+// the length in bytes of the trees on the next line, and then the trees,
+// in UTF-8.  Each reply on standard output is "OK" or "ERROR" and the
+// length of what follows on a line, and then the trees CorpusSearch wrote
+// or the error.  Replies are not streamed, as CorpusSearch writes its
+// output file only when the search is done.  CorpusSearch's own messages
+// to standard output are dropped.  The worker exits when its standard
+// input is closed.
+
+import csearch.CorpusSearch;
+
+import java.io.BufferedInputStream;
+import java.io.BufferedOutputStream;
+import java.io.ByteArrayOutputStream;
+import java.io.FileDescriptor;
+import java.io.FileOutputStream;
+import java.io.IOException;
+import java.io.InputStream;
+import java.io.OutputStream;
+import java.io.PrintStream;
+import java.nio.charset.StandardCharsets;
+import java.nio.file.Files;
+import java.nio.file.Path;
+
+public class CorpusSearchWorker {
+    private static String readLine(InputStream in) throws IOException {
+        ByteArrayOutputStream line = new ByteArrayOutputStream();
+        int c;
+        while ((c = in.read()) != '\n') {
+            if (c < 0) {
+                return null;
+            }
+            line.write(c);
+        }
+        return new String(line.toByteArray(), StandardCharsets.UTF_8);
+    }
+
+    private static void reply(OutputStream out, String status, byte[] body)
+        throws IOException {
+        out.write((status + " " + body.length + "\n")
+                  .getBytes(StandardCharsets.UTF_8));
+        out.write(body);
+        out.flush();
+    }
+
+    public static void main(String[] args) throws IOException {
+        InputStream in = new BufferedInputStream(System.in);
+        OutputStream out = new BufferedOutputStream(
+            new FileOutputStream(FileDescriptor.out));
+        PrintStream stdout = System.out;
+        PrintStream quiet = new PrintStream(OutputStream.nullOutputStream());
+        Path dir = Files.createTempDirectory("annotald-cs");
+        Path source = dir.resolve("trees.psd");
+        Path result = dir.resolve("trees.out");
+        try {
+            while (true) {
+                String query = readLine(in);
+                String length = readLine(in);
+                if (query == null || length == null) {
+                    break;
+                }
+                Files.write(source, in.readNBytes(Integer.parseInt(length)));
+                Files.deleteIfExists(result);
+                String status = "OK";
+                byte[] body;
+                System.setOut(quiet);
+                try {
+                    CorpusSearch.main(new String[] {
+                        query, source.toString(), "-out", result.toString()
+                    });
+                    body = Files.readAllBytes(result);
+                } catch (Throwable e) {
+                    status = "ERROR";
+                    body = String.valueOf(e).getBytes(StandardCharsets.UTF_8);
+                } finally {
+                    System.setOut(stdout);
+                }
+                reply(out, status, body);
+            }
+        } finally {
+            Files.deleteIfExists(source);
+            Files.deleteIfExists(result);
+            Files.deleteIfExists(dir);
+        }
+    }
+}
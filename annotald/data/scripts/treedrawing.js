@@ -161,6 +161,14 @@ function assignEvents(mgr) {
     // $("#butprevtree").unbind("click").click(prevTree);
     // $("#butgototree").unbind("click").click(goToTree);
     $("#editpane").mousedown(mgr.clear_selection);
+    $(window).scroll(function () {
+        if (mgr.virtual) {
+            mgr.schedule_viewport();
+        }
+    });
+    $(window).resize(function () {
+        $(window).trigger("scroll");
+    });
     // $(document).mousewheel(handleMouseWheel);
     window.onbeforeunload = navigationWarning;
     window.onunload = logUnload;
@@ -185,6 +193,7 @@ function documentReadyHandler() {
     });
 
     lastsavedstate = $("#editpane").html();
+    $(window).trigger("scroll");
 }
 
 $(document).ready(function () {
@@ -1740,7 +1749,7 @@ function request_parse(text, success_cb) {
                 type: "POST",
                 contentType : "application/json",
                 dataType: "json",
-                url: "/parse_single",
+                url: "parse_single",
                 async: true,
                 traditional: true,
                 data: JSON.stringify(payload),
@@ -1936,37 +1945,81 @@ function coIndex() {
 
 var is_save_in_progress = false;
 
-function save(e) {
-    let trees = tree_manager.get_all_trees();
+// Save bodies at least this long are gzipped, where the browser can
+var saveGzipMinLength = 4096;
+
+function postSave(data, onResult) {
+    let body = JSON.stringify(data);
+    let settings = {
+        type: "POST",
+        contentType : "application/json",
+        dataType: "json",
+        url: "doSave",
+        async: true,
+        traditional: true,
+        data: body,
+        success: onResult,
+        error: function (args) {
+            onResult({result: "failure", reason: args.statusText});
+        }
+    };
+    if (typeof CompressionStream === "undefined" || body.length < saveGzipMinLength) {
+        $.ajax(settings);
+        return;
+    }
+    let stream = new Blob([body]).stream().pipeThrough(new CompressionStream("gzip"));
+    new Response(stream).arrayBuffer().then(function (compressed) {
+        settings.data = compressed;
+        settings.processData = false;
+        settings.headers = {"Content-Encoding": "gzip"};
+        $.ajax(settings);
+    }, function () {
+        $.ajax(settings);
+    });
+}
 
-    let data = {trees: trees};
-    console.log("saved", trees);
-    if (!is_save_in_progress) {
-        displayInfo("Saving...");
-        is_save_in_progress = true;
-        setTimeout(function () {
-            $.ajax({
-                type: "POST",
-                contentType : "application/json",
-                dataType: "json",
-                url: "/doSave",
-                async: true,
-                traditional: true,
-                data: JSON.stringify(data),
-                success: function (args) {
-                    console.log("sucess", args);
-                    displayInfo("Save complete");
-                },
-                error: function (args) {
-                    displayInfo("Error occurred during saving");
-                    console.error(args);
-                },
-                complete: function (args) {
-                    is_save_in_progress = false;
-                }
+/*
+ * Only the trees changed since the last acknowledged save are sent, each with
+ * the version it was based on; the server falls back to "unsupported" when it
+ * can only save the whole file.
+ */
+function save(e) {
+    if (is_save_in_progress) {
+        return;
+    }
+    if (!tree_manager.has_changes()) {
+        displayInfo("No changes to save");
+        return;
+    }
+    let changes = tree_manager.take_changes();
+    displayInfo("Saving...");
+    is_save_in_progress = true;
+    postSave({changes: changes}, function (args) {
+        if (args.result === "unsupported") {
+            postSave({trees: tree_manager.get_all_trees()}, function (full) {
+                saveDone(changes, full);
             });
-        }, 0);
+            return;
+        }
+        saveDone(changes, args);
+    });
+}
+
+function saveDone(changes, args) {
+    is_save_in_progress = false;
+    if (args.result === "success") {
+        tree_manager.save_succeeded(args.versions || {});
+        displayInfo("Save complete");
+        return;
+    }
+    tree_manager.save_failed(changes);
+    if (args.result === "conflict") {
+        displayError("Not saved: trees were changed on disk: " +
+                     args.conflicts.join(", "));
+    } else {
+        displayError("Error occurred during saving: " + args.reason);
     }
+    console.error(args);
 }
 
 // ========== Validating
@@ -1984,7 +2037,7 @@ function logEvent(type, data) {
     data.type = type;
     payload = { eventData: data };
     $.ajax({
-               url: "/doLogEvent",
+               url: "doLogEvent",
                async: true,
                dataType: "json",
                type: "POST",
@@ -2090,7 +2143,7 @@ function quitServer(e, force) {
         displayError("Cannot exit, unsaved changes exist.  <a href='#' " +
                     "onclick='quitServer(null, true);return false;'>Force</a>");
     } else {
-        $.post("/doExit");
+        $.post("doExit");
         window.onbeforeunload = undefined;
         setTimeout(function(res) {
                        // I have no idea why this works, but it does
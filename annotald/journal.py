@@ -0,0 +1,134 @@
+# This Python file uses the following encoding: utf-8
+
+"""
+A write-ahead journal of saved trees, kept next to the corpus file.
+
+Saving edited trees appends their new texts to the journal
+(``foo.psd.journal``) and fsyncs it, so a save costs only as much as the
+edit.  The corpus file is rewritten when the journal is compacted: a new
+file with the journaled trees spliced in is written, fsynced and renamed
+over the old one, and only then is the journal removed.  A crash at any
+point therefore leaves every save either in the corpus file or in the
+journal, which is replayed when the file is opened again.
+
+Each line of the journal is a JSON object with the trees of one save,
+keyed by ID-LOCAL.  Entries hold whole trees, so replaying a journal that
+was already (partly) applied is harmless.
+"""
+
+import json
+import os
+import time
+
+from annotald import util
+
+
+JOURNAL_SUFFIX = ".journal"
+REJECTED_SUFFIX = ".journal.rejected"
+
+# Compact once this much has been journaled
+COMPACT_BYTES = 4 * 2 ** 20
+
+
+class Journal(object):
+    def __init__(self, filename):
+        self.filename = str(filename)
+        # ID-LOCAL -> text of the tree as last saved
+        self.trees = {}
+        self.size = 0
+
+    @property
+    def journal_filename(self):
+        return self.filename + JOURNAL_SUFFIX
+
+    @classmethod
+    def for_file(cls, filename):
+        journal = cls(filename)
+        journal.load()
+        return journal
+
+    def load(self):
+        try:
+            with open(self.journal_filename, "rb") as fh:
+                data = fh.read()
+        except OSError:
+            return
+        pos = 0
+        for line in data.splitlines(True):
+            if not line.endswith(b"\n"):
+                break
+            try:
+                record = json.loads(line.decode("utf-8"))
+            except ValueError:
+                break
+            self.trees.update(record["trees"])
+            pos += len(line)
+        if pos != len(data):
+            # The last save was cut off by a crash and never acknowledged;
+            # drop it so that new saves are appended after the last good one
+            with open(self.journal_filename, "r+b") as fh:
+                fh.truncate(pos)
+        self.size = pos
+
+    def __len__(self):
+        return len(self.trees)
+
+    def get(self, tree_id):
+        """ The journaled text of a tree, or None """
+        return self.trees.get(tree_id)
+
+    def append(self, trees):
+        """ Durably record the new texts of trees, a dict keyed by ID-LOCAL """
+        line = json.dumps({"time": time.time(), "trees": trees},
+                          ensure_ascii=False) + "\n"
+        data = line.encode("utf-8")
+        with open(self.journal_filename, "ab") as fh:
+            fh.write(data)
+            fh.flush()
+            os.fsync(fh.fileno())
+        if self.size == 0:
+            # The journal file was just created
+            util.fsyncDirectory(os.path.dirname(os.path.abspath(self.filename)))
+        self.size += len(data)
+        self.trees.update(trees)
+
+    def needs_compaction(self):
+        return self.size >= COMPACT_BYTES
+
+    def compact(self, corpus):
+        """
+        Splice the journaled trees into the file of the CorpusFile corpus
+        and empty the journal.  Returns a CorpusFile for the new file.
+
+        Trees whose ID-LOCAL is not in the file (it was changed behind
+        the journal's back) are moved to a .journal.rejected file.
+        """
+        texts = {}
+        rejected = {}
+        for (tree_id, text) in self.trees.items():
+            idx = corpus.index.position(tree_id)
+            if idx is None:
+                rejected[tree_id] = text
+            elif corpus.text(idx) != text:
+                texts[idx] = text
+        if rejected:
+            print("Trees not found in %s, see %s: %s" % (
+                self.filename, self.filename + REJECTED_SUFFIX,
+                ", ".join(sorted(rejected))))
+            with open(self.filename + REJECTED_SUFFIX, "a", encoding="utf-8") as fh:
+                fh.write("\n\n".join(rejected.values()) + "\n\n")
+        if texts:
+            corpus = corpus.replace_trees(texts)
+        self.clear()
+        return corpus
+
+    def clear(self):
+        """ Remove the journal, once its trees are in the corpus file """
+        try:
+            os.unlink(self.journal_filename)
+        except OSError:
+            pass
+        else:
+            util.fsyncDirectory(os.path.dirname(os.path.abspath(self.filename)))
+        self.trees = {}
+        self.size = 0
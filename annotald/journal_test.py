@@ -0,0 +1,67 @@
+import os, shutil, tempfile, unittest
+
+from annotald.corpusfile import CorpusFile
+from annotald.journal import Journal
+
+TEXT = """( (META (ID-LOCAL t.psd,.1)) (S0 (X a)))
+
+( (META (ID-LOCAL t.psd,.2)) (S0 (X b)))
+"""
+
+EDITED = "( (META (ID-LOCAL t.psd,.2)) (S0 (X c)))"
+
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "t.psd")
+        with open(self.path, "w", encoding="utf-8") as fh:
+            fh.write(TEXT)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_append_and_replay(self):
+        journal = Journal(self.path)
+        journal.append({"t.psd,.2": "( (META (ID-LOCAL t.psd,.2)) (S0 (X x)))"})
+        journal.append({"t.psd,.2": EDITED})
+        with open(self.path, encoding="utf-8") as fh:
+            self.assertEqual(fh.read(), TEXT)
+
+        replayed = Journal.for_file(self.path)
+        self.assertEqual(replayed.trees, {"t.psd,.2": EDITED})
+        with CorpusFile(self.path) as corpus:
+            with replayed.compact(corpus) as new_corpus:
+                self.assertEqual(new_corpus.text(1), EDITED)
+        self.assertFalse(os.path.exists(journal.journal_filename))
+        with open(self.path, encoding="utf-8") as fh:
+            self.assertEqual(fh.read(), TEXT.replace("(X b)", "(X c)"))
+
+    def test_replay_is_idempotent(self):
+        journal = Journal(self.path)
+        journal.append({"t.psd,.2": EDITED})
+        with CorpusFile(self.path) as corpus:
+            corpus.replace_trees({1: EDITED}).close()
+        # As after a crash between compacting and removing the journal
+        with CorpusFile(self.path) as corpus:
+            Journal.for_file(self.path).compact(corpus).close()
+        with open(self.path, encoding="utf-8") as fh:
+            self.assertEqual(fh.read(), TEXT.replace("(X b)", "(X c)"))
+
+    def test_torn_append(self):
+        journal = Journal(self.path)
+        journal.append({"t.psd,.1": "( (META (ID-LOCAL t.psd,.1)) (S0 (X z)))"})
+        with open(journal.journal_filename, "ab") as fh:
+            fh.write(b'{"time": 1, "trees": {"t.psd,.2"')
+        replayed = Journal.for_file(self.path)
+        self.assertEqual(list(replayed.trees), ["t.psd,.1"])
+        replayed.append({"t.psd,.2": EDITED})
+        self.assertEqual(len(Journal.for_file(self.path)), 2)
+
+    def test_unknown_tree_is_rejected(self):
+        journal = Journal(self.path)
+        journal.append({"t.psd,.9": "( (META (ID-LOCAL t.psd,.9)) (S0 (X q)))"})
+        with CorpusFile(self.path) as corpus:
+            self.assertIs(journal.compact(corpus), corpus)
+        with open(self.path + ".journal.rejected", encoding="utf-8") as fh:
+            self.assertIn("(X q)", fh.read())
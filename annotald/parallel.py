@@ -0,0 +1,320 @@
+# This Python file uses the following encoding: utf-8
+
+"""
+Parsing and pretty-printing of many trees on a pool of worker processes.
+
+Trees are independent of each other, so a corpus is cut into shards of
+whole trees of about equal size, each shard is handled by a worker process
+and the results are put back together in file order.  Tree boundaries are
+found with the byte-level scanner of the tree index, which is cheap next
+to parsing.
+
+Starting workers and pickling the results back costs time, so inputs
+smaller than MIN_PARALLEL_BYTES (or MIN_PARALLEL_TREES trees) are handled
+in the calling process, as is everything when only one worker is asked
+for.  workers=None means one worker per CPU.
+
+Forking a process that runs server threads can deadlock the children
+(a lock held by another thread stays locked in them), and starting
+workers for every request costs time.  So the server starts one pool
+(see start_pool) when it starts, before it serves anything, whose
+workers are started from a clean process (forkserver, or spawn where
+that is not available); they are used by every request.  Without it,
+as when loading a corpus from a script, a pool is started for each
+call.  Either way, what is sent to the workers is pickled.
+
+Validators (see settings.py) are run on shards of trees the same way.
+They are usually defined in the Python settings file and cannot be
+pickled, so the pool's workers run the settings file themselves and
+the validator is sent by its name there.  A validator that is not in
+the settings file is sent pickled; one that cannot be pickled, or is
+marked parallel = False, is given all the trees in the calling process.
+"""
+
+import atexit
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import contextlib
+import io
+import multiprocessing
+import os
+from pathlib import Path
+import pickle
+import threading
+
+from annotald.annotree import AnnoTree, iter_trees
+from annotald.treecache import gc_paused
+from annotald.treeindex import scan_tree_spans
+from annotald.validationcache import split_trees
+
+
+MIN_PARALLEL_BYTES = 2 ** 20
+MIN_PARALLEL_TREES = 2000
+# Validators take far longer over a tree than parsing does
+MIN_PARALLEL_VALIDATION_TREES = 200
+# Shards per worker; more than one evens out uneven shards
+SHARDS_PER_WORKER = 4
+
+
+def num_workers(workers=None):
+    if _pool_workers is not None:
+        return _pool_workers if workers is None else min(max(1, workers), _pool_workers)
+    if workers is None:
+        return os.cpu_count() or 1
+    return max(1, workers)
+
+
+def _shards(items, weights, num_shards):
+    """ Cut items into about num_shards runs of about equal total weight """
+    total = sum(weights)
+    target = total / num_shards if num_shards else total
+    shards = []
+    current = []
+    weight = 0
+    for (item, item_weight) in zip(items, weights):
+        current.append(item)
+        weight += item_weight
+        if weight >= target:
+            shards.append(current)
+            current = []
+            weight = 0
+    if current:
+        shards.append(current)
+    return shards
+
+
+def _context():
+    """ How workers are started: never by forking this process """
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver")
+    return multiprocessing.get_context("spawn")
+
+
+# The pool shared by every request (see start_pool), and the number of
+# its workers
+_pool = None
+_pool_workers = None
+_pool_lock = threading.Lock()
+
+
+def start_pool(workers=None, validators=None):
+    """
+    Start the worker pool shared by the calls of this module, unless it
+    is started already or only one worker is asked for.  validators, if
+    given, is called in each worker when it starts and returns the
+    validators by name (see validate_many); it must be picklable, such as
+    a module-level function or a functools.partial of one.
+    """
+    global _pool, _pool_workers
+    workers = num_workers(workers)
+    with _pool_lock:
+        if _pool is None and workers > 1:
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=_context(),
+                                        initializer=_start_worker,
+                                        initargs=(validators,))
+            _pool_workers = workers
+            atexit.register(stop_pool)
+        return _pool
+
+
+def stop_pool():
+    global _pool, _pool_workers
+    with _pool_lock:
+        (pool, _pool, _pool_workers) = (_pool, None, None)
+    if pool is not None:
+        pool.shutdown()
+
+
+@contextlib.contextmanager
+def _executor(workers):
+    """ The shared pool if it is started, or a pool for this call """
+    if _pool is not None:
+        yield _pool
+        return
+    with ProcessPoolExecutor(max_workers=workers, mp_context=_context()) as executor:
+        yield executor
+
+
+def _pickle(obj):
+    # Pickling and unpickling trees create about as many objects as
+    # parsing does, and the collector passes that triggers would cost
+    # more than the pickling itself.  The collector is paused for only
+    # that long: other threads of the server go on allocating while the
+    # workers run.
+    with gc_paused():
+        return pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+
+
+def _unpickle(data):
+    with gc_paused():
+        return pickle.loads(data)
+
+
+def _call_pickled(args):
+    """
+    fn on the pickled argument, the result pickled.  Shards and results
+    go to and from the workers as bytes, so that each side (un)pickles
+    them itself with the collector paused.
+    """
+    (fn, data) = args
+    return _pickle(fn(_unpickle(data)))
+
+
+def _map(fn, shards, workers):
+    """ The results of fn on each shard, a list each, in order """
+    tasks = [(fn, _pickle(shard)) for shard in shards]
+    with _executor(workers) as executor:
+        results = []
+        for data in executor.map(_call_pickled, tasks):
+            results.extend(_unpickle(data))
+        return results
+
+
+def _parse_text(args):
+    (cls, text) = args
+    with gc_paused():
+        return list(iter_trees((text,), cls))
+
+
+def _parse_chunks(args):
+    (cls, chunks) = args
+    with gc_paused():
+        return [next(iter_trees((chunk.decode("utf-8"),), cls)) for chunk in chunks]
+
+
+def _pretty(trees):
+    return [tree.pretty() for tree in trees]
+
+
+# The validators of a worker of the shared pool, by name
+_worker_validators = {}
+
+
+def _start_worker(validators):
+    global _worker_validators
+    if validators is not None:
+        _worker_validators = validators()
+
+
+def _validate(args):
+    (validator, version, texts) = args
+    if isinstance(validator, str):
+        validator = _worker_validators[validator]
+    with gc_paused():
+        return split_trees(validator(version, "\n\n".join(texts)))
+
+
+def fromstring_many(text, workers=None, cls=None):
+    """ Parallel version of AnnoTree.fromstring_many """
+    cls = cls or AnnoTree
+    workers = num_workers(workers)
+    data = text.encode("utf-8")
+    if workers == 1 or len(data) < MIN_PARALLEL_BYTES:
+        return cls.fromstring_many(text)
+    spans = list(scan_tree_spans(data))
+    shards = _shards(spans, [length for (_, length) in spans],
+                     workers * SHARDS_PER_WORKER)
+    texts = [
+        (cls, data[shard[0][0] : shard[-1][0] + shard[-1][1]].decode("utf-8"))
+        for shard in shards
+    ]
+    return _map(_parse_text, texts, workers)
+
+
+def read_from_file(filename, workers=None, cls=None):
+    """ Parallel version of AnnoTree.read_from_file for a path """
+    with open(filename, "rb") as fh:
+        data = fh.read()
+    return parse_spans(data, list(scan_tree_spans(data)), workers, cls)
+
+
+def parse_spans(data, spans, workers=None, cls=None):
+    """
+    Parse the trees at the (offset, length) spans of data, the bytes (or
+    an mmap) of a corpus file.
+    """
+    cls = cls or AnnoTree
+    workers = num_workers(workers)
+    weights = [length for (_, length) in spans]
+    if workers == 1 or sum(weights) < MIN_PARALLEL_BYTES:
+        return _parse_chunks(
+            (cls, [data[offset : offset + length] for (offset, length) in spans])
+        )
+    shards = _shards(spans, weights, workers * SHARDS_PER_WORKER)
+    chunks = [
+        (cls, [data[offset : offset + length] for (offset, length) in shard])
+        for shard in shards
+    ]
+    return _map(_parse_chunks, chunks, workers)
+
+
+def pretty_many(trees, workers=None):
+    """ The pretty-printed texts of trees, in order """
+    trees = list(trees)
+    workers = num_workers(workers)
+    if workers == 1 or len(trees) < MIN_PARALLEL_TREES:
+        return _pretty(trees)
+    shards = _shards(trees, [1] * len(trees), workers * SHARDS_PER_WORKER)
+    return _map(_pretty, shards, workers)
+
+
+def write_to_file(obj, trees, workers=None):
+    """ Parallel version of AnnoTree.write_to_file """
+    text = "\n\n".join(pretty_many(trees, workers))
+    if isinstance(obj, io.TextIOBase):
+        obj.write(text)
+    elif isinstance(obj, str) or isinstance(obj, Path):
+        with open(obj, "w", encoding="utf-8") as handle:
+            handle.write(text)
+    else:
+        raise ValueError("Illegal file or path object")
+
+
+def _sendable(validator, name):
+    """
+    What to send the workers for validator: its name, if the shared
+    pool's workers have it by that name, or itself if it can be pickled;
+    None if it cannot be sent
+    """
+    if name is not None and _pool is not None:
+        return name
+    try:
+        pickle.dumps(validator)
+    except Exception:
+        return None
+    return validator
+
+
+def validate_many(validator, version, texts, workers=None, progress=None, name=None):
+    """
+    What validator makes of the trees texts, in order.  name is the
+    validator's name in the Python settings file, if it is from there.
+    progress, if given, is called with the number of trees validated so
+    far as shards are done.
+    """
+    workers = num_workers(workers)
+    sendable = None
+    if (workers > 1 and len(texts) >= MIN_PARALLEL_VALIDATION_TREES
+            and getattr(validator, "parallel", True)):
+        sendable = _sendable(validator, name)
+    if sendable is None:
+        validated = split_trees(validator(version, "\n\n".join(texts)))
+        if progress is not None:
+            progress(len(texts))
+        return validated
+    shards = _shards(texts, [len(text) for text in texts],
+                     workers * SHARDS_PER_WORKER)
+    with _executor(workers) as executor:
+        futures = {}
+        for (idx, shard) in enumerate(shards):
+            task = (_validate, _pickle((sendable, version, shard)))
+            futures[executor.submit(_call_pickled, task)] = idx
+        # Shards are put back in order whichever is done first
+        results = [None] * len(shards)
+        done = 0
+        for future in as_completed(futures):
+            idx = futures[future]
+            results[idx] = _unpickle(future.result())
+            done += len(shards[idx])
+            if progress is not None:
+                progress(done)
+    return [tree for result in results for tree in result]
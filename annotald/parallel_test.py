@@ -0,0 +1,90 @@
+import io, os, shutil, tempfile, unittest
+
+from annotald import parallel
+from annotald.annotree import AnnoTree
+
+TREE = """( (META (ID-CORPUS c.{0}) (ID-LOCAL t.psd,.{0}) (URL u) (COMMENT ))
+  (S0 (S-MAIN (NP-SUBJ (pfn_et_nf_p1 Ég (lemma ég)))
+              (VP (so_1_þf_et_fh_gm_nt_p1 sé (lemma sjá))
+                  (NP-OBJ (entity \\(AB{0}\\) (lemma \\(AB\\))))))
+      (grm .)))"""
+
+
+def flag(version, trees):
+    return trees.replace("(NP", "(NP-FLAG") + "\n"
+
+
+def validators():
+    return {"flag": flag}
+
+
+class ParallelTest(unittest.TestCase):
+    def setUp(self):
+        self.text = "\n\n".join(TREE.format(idx) for idx in range(40))
+        self.trees = AnnoTree.fromstring_many(self.text)
+        # Use the pool even for this small corpus
+        self.saved = (parallel.MIN_PARALLEL_BYTES, parallel.MIN_PARALLEL_TREES)
+        parallel.MIN_PARALLEL_BYTES = parallel.MIN_PARALLEL_TREES = 0
+
+    def tearDown(self):
+        (parallel.MIN_PARALLEL_BYTES, parallel.MIN_PARALLEL_TREES) = self.saved
+
+    def test_fromstring_many(self):
+        self.assertEqual(parallel.fromstring_many(self.text, workers=2), self.trees)
+
+    def test_read_from_file(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, "t.psd")
+            with open(path, "w", encoding="utf-8") as fh:
+                fh.write(self.text)
+            self.assertEqual(parallel.read_from_file(path, workers=2), self.trees)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_pretty(self):
+        self.assertEqual(parallel.pretty_many(self.trees, workers=2),
+                         [tree.pretty() for tree in self.trees])
+        handle = io.StringIO()
+        parallel.write_to_file(handle, self.trees, workers=2)
+        serial = io.StringIO()
+        AnnoTree.write_to_file(serial, self.trees)
+        self.assertEqual(handle.getvalue(), serial.getvalue())
+
+    def validate_many(self, validator, **kwargs):
+        texts = self.text.split("\n\n")
+        saved = parallel.MIN_PARALLEL_VALIDATION_TREES
+        parallel.MIN_PARALLEL_VALIDATION_TREES = 0
+        progress = []
+        try:
+            validated = parallel.validate_many(validator, "", texts, workers=2,
+                                               progress=progress.append, **kwargs)
+        finally:
+            parallel.MIN_PARALLEL_VALIDATION_TREES = saved
+        self.assertEqual(validated, [text.replace("(NP", "(NP-FLAG") for text in texts])
+        self.assertEqual(progress, sorted(progress))
+        self.assertEqual(progress[-1], len(texts))
+        return progress
+
+    def test_validate_many(self):
+        self.assertGreater(len(self.validate_many(flag)), 1)
+        # Validators that cannot be pickled are run here
+        self.assertEqual(len(self.validate_many(lambda version, trees: flag(version, trees))), 1)
+
+    def test_shared_pool(self):
+        parallel.start_pool(2, validators)
+        try:
+            self.assertEqual(parallel.num_workers(), 2)
+            self.assertEqual(parallel.pretty_many(self.trees),
+                             [tree.pretty() for tree in self.trees])
+            # Sent by its name in the settings; the workers have their own
+            progress = self.validate_many(lambda version, trees: None, name="flag")
+            self.assertGreater(len(progress), 1)
+        finally:
+            parallel.stop_pool()
+
+    def test_serial_fallback(self):
+        (parallel.MIN_PARALLEL_BYTES, parallel.MIN_PARALLEL_TREES) = self.saved
+        self.assertEqual(parallel.fromstring_many(self.text, workers=8), self.trees)
+        self.assertEqual(parallel.parse_spans(b"", [], workers=8), [])
+        self.assertEqual(parallel.num_workers(0), 1)
@@ -0,0 +1,574 @@
+# This Python file uses the following encoding: utf-8
+
+"""
+CorpusSearch-style structural queries over AnnoTrees, run in process.
+
+A query file is read the way CorpusSearch reads it::
+
+    node: $ROOT
+    query: ({1}NP-SBJ* iDoms N*) AND (IP-MAT* iDoms {1}NP-SBJ*)
+    append_label{1}: -FLAG
+
+The query is made of search functions joined by AND, OR and NOT (or a
+"!" before a function).  Each function is "argument function argument"
+or "argument exists".  The functions are iDoms, doms (dominates),
+iDomsOnly, iDomsFirst, iDomsLast, precedes, iPrecedes and hasSister.
+An argument is a label pattern:
+  - "*" matches any run of characters, "|" separates alternatives and a
+    leading "!" negates the pattern
+  - a pattern between slashes is a regular expression
+  - $ROOT is the node the search is bounded by (see node:)
+Words are matched as the leaves of their terminals.  Identical
+arguments refer to the same node throughout a query; "[1]", "[2]" and
+so on in front of a pattern tell apart nodes that match the same
+pattern.  A "{n}" tag names the node for the actions.  The arguments of
+a negated function, and those that are only used inside OR or NOT, are
+local to it.
+
+The actions are append_label, prepend_label and replace_label.  They are
+applied to every node that is tagged in a match of the query; a validator
+usually appends -FLAG, which the editor highlights.  Nodes whose label
+matches ignore_nodes, and the META node, are invisible to searches.
+
+A query is compiled once.  Searching a tree takes a single traversal,
+which numbers its nodes in pre-order and records for each its parent,
+the extent of its subtree and the leaves it spans, and collects the
+nodes each argument's pattern matches; every search function is then a
+comparison of those numbers.
+"""
+
+import bisect
+import os
+import re
+
+from annotald.annotree import AnnoTree, html_parens_to_escaped_parens, iter_tree_spans
+
+
+DEFAULT_IGNORE_NODES = "COMMENT|CODE|ID|LB|'|\"|,|E_S|.|/|RMV:*"
+ACTIONS = ("append_label", "prepend_label", "replace_label")
+# Keys of query files that only affect CorpusSearch's output
+IGNORED_KEYS = ("copy_corpus", "print_indices", "nodes_only", "remove_nodes")
+
+_TAG_RE = re.compile(r"^(?:\[(\d+)\]|\{(\d+)\})*")
+_KEY_RE = re.compile(r"^([A-Za-z_]+)(?:\{(\d+)\})?\s*:(.*)$")
+# Regular expression patterns may hold parentheses
+_TOKEN_RE = re.compile(r"[^\s()/]*/[^/\s]+/|\(|\)|[^\s()]+")
+
+
+class QueryError(ValueError):
+    pass
+
+
+class Pattern(object):
+    """ A label pattern, matched against node labels and words """
+
+    def __init__(self, text):
+        self.text = text
+        self.negated = text.startswith("!")
+        body = text[1:] if self.negated else text
+        self.root = body == "$ROOT"
+        if body.startswith("/") and body.endswith("/") and len(body) > 1:
+            regex = body[1:-1]
+        else:
+            regex = "|".join(
+                ".*".join(re.escape(part) for part in alternative.split("*"))
+                for alternative in body.split("|")
+            )
+        try:
+            self._regex = re.compile("(?:%s)\\Z" % regex)
+        except re.error as e:
+            raise QueryError("Bad pattern %s: %s" % (text, e))
+        # label -> whether it matches; labels recur across trees
+        self._matches = {}
+
+    def matches(self, label):
+        result = self._matches.get(label)
+        if result is None:
+            result = self._matches[label] = (
+                (self._regex.match(label) is not None) != self.negated
+            )
+        return result
+
+
+class Argument(object):
+    def __init__(self, text):
+        """ text is an argument as written in the query """
+        prefix = _TAG_RE.match(text)
+        self.tag = None
+        self.name = text
+        for (number, tag) in re.findall(r"\[(\d+)\]|\{(\d+)\}", prefix.group(0)):
+            if tag:
+                self.tag = int(tag)
+                self.name = self.name.replace("{%s}" % tag, "", 1)
+        self.pattern = Pattern(text[prefix.end():])
+
+
+class _Nodes(object):
+    """
+    The searchable nodes of a tree, numbered in pre-order: nodes are
+    AnnoTrees and words; node i dominates the nodes i + 1 to end[i] and
+    spans the words first_word[i] up to (not including) end_word[i].
+    """
+
+    __slots__ = ("nodes", "labels", "parent", "end", "children", "first_word",
+                 "end_word")
+
+    def __init__(self, tree, ignore):
+        self.nodes = []
+        self.labels = []
+        self.parent = []
+        self.end = []
+        self.children = []
+        self.first_word = []
+        self.end_word = []
+        words = 0
+        # (node, parent index); None marks the end of the node above it
+        stack = [(tree, -1)]
+        open_nodes = []
+        while stack:
+            item = stack.pop()
+            if item is None:
+                idx = open_nodes.pop()
+                self.end[idx] = len(self.nodes) - 1
+                self.end_word[idx] = words
+                continue
+            (node, parent) = item
+            idx = len(self.nodes)
+            is_tree = isinstance(node, AnnoTree)
+            self.nodes.append(node)
+            self.labels.append(node.label() if is_tree else node)
+            self.parent.append(parent)
+            self.end.append(idx)
+            self.children.append([])
+            self.first_word.append(words)
+            self.end_word.append(words)
+            if parent >= 0:
+                self.children[parent].append(idx)
+            if not is_tree:
+                words += 1
+                self.end_word[idx] = words
+                continue
+            open_nodes.append(idx)
+            stack.append(None)
+            for child in reversed(node):
+                if isinstance(child, AnnoTree) and (
+                    child.label() == "META" or ignore.matches(child.label())
+                ):
+                    continue
+                stack.append((child, idx))
+
+    def __len__(self):
+        return len(self.nodes)
+
+
+def _idoms(nodes, x, y):
+    return nodes.parent[y] == x
+
+
+def _doms(nodes, x, y):
+    return x < y <= nodes.end[x]
+
+
+def _idoms_only(nodes, x, y):
+    return nodes.parent[y] == x and len(nodes.children[x]) == 1
+
+
+def _idoms_first(nodes, x, y):
+    return nodes.parent[y] == x and nodes.children[x][0] == y
+
+
+def _idoms_last(nodes, x, y):
+    return nodes.parent[y] == x and nodes.children[x][-1] == y
+
+
+def _precedes(nodes, x, y):
+    return nodes.end[x] < y and nodes.end_word[x] <= nodes.first_word[y]
+
+
+def _iprecedes(nodes, x, y):
+    return _precedes(nodes, x, y) and nodes.end_word[x] == nodes.first_word[y]
+
+
+def _has_sister(nodes, x, y):
+    return x != y and nodes.parent[x] == nodes.parent[y] >= 0
+
+
+# Search function name (lower case) -> (test, whether it relates a node
+# to one of its children)
+FUNCTIONS = {
+    "idoms": (_idoms, True),
+    "idominates": (_idoms, True),
+    "doms": (_doms, False),
+    "dominates": (_doms, False),
+    "idomsonly": (_idoms_only, True),
+    "idomsfirst": (_idoms_first, True),
+    "idomslast": (_idoms_last, True),
+    "precedes": (_precedes, False),
+    "iprecedes": (_iprecedes, False),
+    "hassister": (_has_sister, False),
+}
+
+
+class _Search(object):
+    """ The state of searching one tree within one bounding node """
+
+    def __init__(self, nodes, candidates, bound):
+        self.nodes = nodes
+        self.candidates = candidates
+        self.bound = bound
+
+    def candidates_of(self, argument):
+        if argument.pattern.root:
+            return (self.bound,) if not argument.pattern.negated else ()
+        found = self.candidates[argument.pattern.text]
+        return found[bisect.bisect_left(found, self.bound) :
+                     bisect.bisect_right(found, self.nodes.end[self.bound])]
+
+
+def _bind(env, name, node):
+    found = dict(env)
+    found[name] = node
+    return found
+
+
+class Function(object):
+    def __init__(self, left, name, right, negated=False):
+        self.left = left
+        self.name = name
+        self.right = right
+        self.negated = negated
+        if name.lower() == "exists":
+            self.test = None
+            self.from_children = False
+        elif name.lower() in FUNCTIONS:
+            (self.test, self.from_children) = FUNCTIONS[name.lower()]
+        else:
+            raise QueryError("Unknown search function %s" % name)
+
+    def arguments(self):
+        if self.test is None:
+            return [self.left]
+        return [self.left, self.right]
+
+    def _related(self, search, env, x):
+        """ The nodes the right argument may be bound to with the left one at x """
+        y = env.get(self.right.name)
+        if y is not None:
+            return (y,) if self.test(search.nodes, x, y) else ()
+        if self.from_children:
+            matches = self.right.pattern.matches
+            labels = search.nodes.labels
+            candidates = [child for child in search.nodes.children[x]
+                          if matches(labels[child])]
+        else:
+            candidates = search.candidates_of(self.right)
+        return [y for y in candidates if self.test(search.nodes, x, y)]
+
+    def solve(self, search, env):
+        x = env.get(self.left.name)
+        lefts = (x,) if x is not None else search.candidates_of(self.left)
+        for x in lefts:
+            if self.test is None:
+                related = (x,)
+            else:
+                related = self._related(search, env, x)
+            if self.negated:
+                if not related:
+                    yield _bind(env, self.left.name, x)
+                continue
+            for y in related:
+                found = _bind(env, self.left.name, x)
+                if self.test is not None:
+                    found[self.right.name] = y
+                yield found
+
+
+class And(object):
+    def __init__(self, parts):
+        self.parts = parts
+
+    def arguments(self):
+        return [arg for part in self.parts for arg in part.arguments()]
+
+    def solve(self, search, env, start=0):
+        if start == len(self.parts):
+            yield env
+            return
+        for found in self.parts[start].solve(search, env):
+            yield from self.solve(search, found, start + 1)
+
+
+class Or(object):
+    def __init__(self, parts):
+        self.parts = parts
+        # Arguments of every alternative are bound by whichever matches
+        self.common = set.intersection(*[
+            set(arg.name for arg in part.arguments()) for part in parts
+        ])
+
+    def arguments(self):
+        return [arg for part in self.parts for arg in part.arguments()]
+
+    def solve(self, search, env):
+        for part in self.parts:
+            for found in part.solve(search, env):
+                # Arguments of one alternative are not seen outside it
+                yield {name: node for (name, node) in found.items()
+                       if name in env or name in self.common}
+
+
+class Not(object):
+    def __init__(self, part):
+        self.part = part
+
+    def arguments(self):
+        return self.part.arguments()
+
+    def solve(self, search, env):
+        for _ in self.part.solve(search, env):
+            return
+        yield env
+
+
+class _Parser(object):
+    def __init__(self, text):
+        self.tokens = _TOKEN_RE.findall(text)
+        self.pos = 0
+        self.arguments = {}
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def take(self):
+        token = self.peek()
+        if token is None:
+            raise QueryError("Query ends too early")
+        self.pos += 1
+        return token
+
+    def parse(self):
+        if not self.tokens:
+            raise QueryError("Empty query")
+        expr = self.parse_or()
+        if self.peek() is not None:
+            raise QueryError("Unexpected %s in query" % self.peek())
+        return expr
+
+    def parse_or(self):
+        parts = [self.parse_and()]
+        while self.peek() is not None and self.peek().upper() == "OR":
+            self.take()
+            parts.append(self.parse_and())
+        return parts[0] if len(parts) == 1 else Or(parts)
+
+    def parse_and(self):
+        parts = [self.parse_unary()]
+        while self.peek() is not None and self.peek().upper() == "AND":
+            self.take()
+            parts.append(self.parse_unary())
+        return parts[0] if len(parts) == 1 else And(parts)
+
+    def parse_unary(self):
+        token = self.peek()
+        if token is not None and token.upper() == "NOT":
+            self.take()
+            return Not(self.parse_unary())
+        if token == "(":
+            self.take()
+            expr = self.parse_or()
+            if self.take() != ")":
+                raise QueryError("Unbalanced parentheses in query")
+            return expr
+        return self.parse_function()
+
+    def argument(self, text):
+        argument = Argument(text)
+        known = self.arguments.get(argument.name)
+        if known is None:
+            self.arguments[argument.name] = argument
+        elif argument.tag is not None:
+            known.tag = argument.tag
+        return self.arguments[argument.name]
+
+    def parse_function(self):
+        left = self.argument(self.take())
+        name = self.take()
+        negated = name.startswith("!")
+        if negated:
+            name = name[1:]
+        if name.lower() == "exists":
+            return Function(left, name, None, negated)
+        right_text = self.take()
+        right = self.argument(right_text)
+        if right is left:
+            # Two nodes matching the same pattern, e.g. NP* iDoms NP*
+            right = Argument(right_text)
+            right.name = "%s@%d" % (right_text, self.pos)
+        if negated:
+            # The right argument is only looked for, never bound
+            right = Argument(right_text)
+            right.name = "%s@%d" % (right_text, self.pos)
+        return Function(left, name, right, negated)
+
+
+class Query(object):
+    def __init__(self, query, node="$ROOT", actions=(),
+                 ignore_nodes=DEFAULT_IGNORE_NODES):
+        """
+        query is the text of the query; actions is a list of (action,
+        tag, argument) such as ("append_label", 1, "-FLAG")
+        """
+        parser = _Parser(query)
+        self.expr = parser.parse()
+        self.node = Pattern(node)
+        self.ignore = Pattern(ignore_nodes)
+        self.actions = list(actions)
+        self.tagged = {}
+        for argument in parser.arguments.values():
+            if argument.tag is not None:
+                self.tagged[argument.tag] = argument.name
+        for (action, tag, _) in self.actions:
+            if action not in ACTIONS:
+                raise QueryError("Unknown action %s" % action)
+            if tag not in self.tagged:
+                raise QueryError("No node is tagged {%s} for %s" % (tag, action))
+        # Pattern text -> pattern, of the arguments
+        self.patterns = {}
+        for argument in self._all_arguments(self.expr):
+            if not argument.pattern.root:
+                self.patterns.setdefault(argument.pattern.text, argument.pattern)
+
+    @classmethod
+    def read(cls, filename):
+        """ The query of a CorpusSearch query file """
+        with open(filename, encoding="utf-8") as fh:
+            return cls.parse(fh.read())
+
+    @classmethod
+    def parse(cls, text):
+        text = re.sub(r"/\*.*?\*/", "", text, flags=re.DOTALL)
+        options = {}
+        actions = []
+        key = None
+        for line in text.split("\n"):
+            if line.strip().startswith("//"):
+                continue
+            match = _KEY_RE.match(line.strip())
+            if match is None:
+                if key is None and line.strip():
+                    raise QueryError("Expected a key before %s" % line.strip())
+                if key is not None:
+                    value.append(line)
+                continue
+            (key, tag, rest) = match.groups()
+            key = key.lower()
+            value = [rest]
+            if key in ACTIONS:
+                actions.append((key, int(tag) if tag else None, value))
+            elif key in ("node", "query", "ignore_nodes"):
+                options[key] = value
+            elif key not in IGNORED_KEYS:
+                raise QueryError("Unsupported key %s" % key)
+        if "query" not in options:
+            raise QueryError("No query")
+        kwargs = {key: " ".join(lines).strip() for (key, lines) in options.items()}
+        return cls(
+            kwargs.pop("query"),
+            actions=[(action, tag, " ".join(lines).strip())
+                     for (action, tag, lines) in actions],
+            **kwargs
+        )
+
+    @staticmethod
+    def _all_arguments(expr):
+        if isinstance(expr, Function):
+            return expr.arguments()
+        if isinstance(expr, Not):
+            return Query._all_arguments(expr.part)
+        return [arg for part in expr.parts for arg in Query._all_arguments(part)]
+
+    def _nodes(self, tree):
+        """ The nodes of tree, and the nodes each pattern matches """
+        nodes = _Nodes(tree, self.ignore)
+        candidates = {text: [] for text in self.patterns}
+        patterns = list(self.patterns.items())
+        bounds = []
+        for (idx, label) in enumerate(nodes.labels):
+            for (text, pattern) in patterns:
+                if pattern.matches(label):
+                    candidates[text].append(idx)
+            if self.node.matches(label) if not self.node.root else idx == 0:
+                bounds.append(idx)
+        return (nodes, candidates, bounds)
+
+    def search(self, tree):
+        """ The matches of the query in tree, as dicts of tag -> node """
+        (nodes, candidates, bounds) = self._nodes(tree)
+        matches = []
+        for bound in bounds:
+            search = _Search(nodes, candidates, bound)
+            for env in self.expr.solve(search, {}):
+                matches.append({
+                    tag: nodes.nodes[env[name]]
+                    for (tag, name) in self.tagged.items()
+                    if env.get(name) is not None
+                })
+        return matches
+
+    def count(self, tree):
+        return len(self.search(tree))
+
+    def apply(self, tree):
+        """ Apply the actions to the matches in tree; whether it changed """
+        changed = False
+        done = set()
+        for match in self.search(tree):
+            for (action, tag, argument) in self.actions:
+                node = match.get(tag)
+                if not isinstance(node, AnnoTree) or (id(node), action) in done:
+                    continue
+                done.add((id(node), action))
+                label = node.label()
+                if action == "append_label":
+                    label = label + argument
+                elif action == "prepend_label":
+                    label = argument + label
+                else:
+                    label = argument
+                if label != node.label():
+                    node.set_label(label)
+                    changed = True
+        return changed
+
+    def run(self, text):
+        """
+        Apply the actions to each tree of text; trees that are not
+        changed are given back as they are
+        """
+        trees = []
+        for (start, end, tree) in iter_tree_spans(text):
+            if self.apply(tree):
+                # Parsing turned escaped parens into HTML entities
+                trees.append(html_parens_to_escaped_parens(tree.pretty()))
+            else:
+                trees.append(text[start:end])
+        return "\n\n".join(trees)
+
+
+def validator(filename):
+    """
+    A validator (see settings.py) running the query file filename, which
+    is read again whenever it changes
+    """
+    compiled = {}
+
+    def validate(version, trees):
+        mtime = os.stat(filename).st_mtime_ns
+        if compiled.get("mtime") != mtime:
+            compiled["query"] = Query.read(filename)
+            compiled["mtime"] = mtime
+        return compiled["query"].run(trees)
+
+    # Results change with the file (see annotald.validationcache)
+    validate.state = lambda: os.stat(filename).st_mtime_ns
+    return validate
@@ -0,0 +1,92 @@
+# This Python file uses the following encoding: utf-8
+
+import os, shutil, tempfile, unittest
+
+from annotald import query
+from annotald.annotree import AnnoTree
+from annotald.query import Query, QueryError
+
+TREE = ("( (META (ID-LOCAL t.psd,.1) (COMMENT )) (S0 (S-MAIN "
+        "(NP-SUBJ (pfn_et_nf_p1 Ég (lemma ég))) "
+        "(VP (so_1_þf_et_p1 sá (lemma sjá)) "
+        "(NP-OBJ (no_et_þf_kk mann (lemma maður)))) (grm .))))")
+
+INTRANSITIVE = ("( (META (ID-LOCAL t.psd,.2) (COMMENT )) (S0 (S-MAIN "
+                "(NP-SUBJ (pfn_et_nf_p1 Ég (lemma ég))) "
+                "(VP (so_1_nf_et_p1 sef (lemma sofa))) (grm .))))")
+
+FLAG_OBJECTS = """node: $ROOT
+copy_corpus: t
+// Flag objects
+query: ({1}NP* iDoms no*)
+       AND (VP iDoms {1}NP*)
+append_label{1}: -FLAG
+"""
+
+
+class QueryTest(unittest.TestCase):
+    def count(self, text):
+        return Query(text).count(AnnoTree.fromstring(TREE))
+
+    def test_functions(self):
+        self.assertEqual(self.count("NP* iDoms pfn*"), 1)
+        self.assertEqual(self.count("S-MAIN iDoms no*"), 0)
+        self.assertEqual(self.count("S-MAIN doms no*"), 1)
+        self.assertEqual(self.count("NP-SUBJ iPrecedes VP"), 1)
+        self.assertEqual(self.count("VP precedes NP-SUBJ"), 0)
+        self.assertEqual(self.count("NP-SUBJ hasSister VP"), 1)
+        self.assertEqual(self.count("VP iDomsFirst so*"), 1)
+        self.assertEqual(self.count("VP iDomsLast so*"), 0)
+        self.assertEqual(self.count("no* iDoms mann"), 1)
+        self.assertEqual(self.count("[1]NP* precedes [2]NP*"), 1)
+
+    def test_patterns(self):
+        self.assertEqual(self.count("/NP-(SUBJ|OBJ)/ exists"), 2)
+        self.assertEqual(self.count("NP-SUBJ|NP-OBJ exists"), 2)
+        self.assertEqual(self.count("!NP* iDoms pfn*"), 0)
+        # META and ignored nodes are not searched
+        self.assertEqual(self.count("ID-LOCAL exists"), 0)
+
+    def test_connectives(self):
+        self.assertEqual(self.count("(NP* iDoms no*) AND (VP iDoms NP*)"), 1)
+        self.assertEqual(self.count("NP* !iDoms no*"), 1)
+        self.assertEqual(self.count("NOT (VP exists)"), 0)
+        self.assertEqual(self.count("(NP-X exists) OR (VP exists)"), 1)
+
+    def test_errors(self):
+        for text in ["", "NP* foo VP", "(NP* iDoms no*", "NP* iDoms no*)"]:
+            with self.assertRaises(QueryError):
+                Query(text)
+        with self.assertRaises(QueryError):
+            Query.parse("query: NP* exists\nprint_complement: t")
+        with self.assertRaises(QueryError):
+            Query.parse("query: NP* exists\nappend_label{2}: -FLAG")
+
+    def test_run(self):
+        q = Query.parse(FLAG_OBJECTS)
+        (flagged, untouched) = q.run(TREE + "\n\n" + INTRANSITIVE).split("\n\n")
+        self.assertIn("(NP-OBJ-FLAG (no_et_þf_kk mann", flagged)
+        self.assertEqual(flagged.count("-FLAG"), 1)
+        self.assertEqual(untouched, INTRANSITIVE)
+
+    def test_run_keeps_escaped_parens(self):
+        tree = TREE.replace("(no_et_þf_kk mann (lemma maður))",
+                            "(entity \\(AB\\) (lemma \\(AB\\)))")
+        (flagged,) = Query.parse(FLAG_OBJECTS.replace("no*", "entity")).run(tree).split("\n\n")
+        self.assertIn("(NP-OBJ-FLAG (entity \\(AB\\) (lemma \\(AB\\))))", flagged)
+        self.assertNotIn("&#40;", flagged)
+
+    def test_validator(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "flag.q")
+            with open(path, "w", encoding="utf-8") as fh:
+                fh.write(FLAG_OBJECTS)
+            validate = query.validator(path)
+            self.assertIn("-FLAG", validate("", TREE))
+            with open(path, "w", encoding="utf-8") as fh:
+                fh.write(FLAG_OBJECTS.replace("-FLAG", "-OBJ"))
+            os.utime(path, ns=(0, 0))
+            self.assertIn("NP-OBJ-OBJ", validate("", TREE))
+        finally:
+            shutil.rmtree(directory)
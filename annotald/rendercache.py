@@ -0,0 +1,68 @@
+# This Python file uses the following encoding: utf-8
+
+"""
+An LRU cache of the HTML rendered for trees.
+
+Entries are keyed by the md5 of the tree's text (the same hash the tree
+index records) and the corpus format, so a tree that has not been edited
+is rendered only once however often it is shown, and an edited tree is
+simply a new key.
+"""
+
+from collections import OrderedDict
+import threading
+
+from annotald.treeindex import tree_digest
+
+
+class RenderCache(object):
+    def __init__(self, render, maxsize=4096):
+        """ render(tree_text, version) returns the HTML of a tree """
+        self.render = render
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, text, version=None, digest=None):
+        """ digest is the md5 of text, if the caller has it already """
+        if digest is None:
+            digest = tree_digest(text.encode("utf-8"))
+        key = (digest, version)
+        with self._lock:
+            html = self._entries.get(key)
+            if html is not None:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return html
+            self.misses += 1
+        # Rendered without the lock; threads rendering the same tree at
+        # once just store the same HTML
+        html = self.render(text, version)
+        with self._lock:
+            self._entries[key] = html
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return html
+
+    def memory_estimate(self):
+        """ About the memory the cached HTML takes, in bytes """
+        with self._lock:
+            return sum(len(html) for html in self._entries.values())
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,25 @@
+import unittest
+
+from annotald.rendercache import RenderCache
+
+
+class RenderCacheTest(unittest.TestCase):
+    def test_lru(self):
+        rendered = []
+
+        def render(text, version):
+            rendered.append(text)
+            return "<div>%s %s</div>" % (text, version)
+
+        cache = RenderCache(render, maxsize=2)
+        self.assertEqual(cache.get("(A a)"), "<div>(A a) None</div>")
+        cache.get("(B b)")
+        cache.get("(A a)")
+        self.assertEqual(rendered, ["(A a)", "(B b)"])
+        cache.get("(A a)", "deep")
+        # (B b) was the least recently used
+        self.assertEqual(len(cache), 2)
+        cache.get("(B b)")
+        self.assertEqual(rendered, ["(A a)", "(B b)", "(A a)", "(B b)"])
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(cache.stats()["misses"], 4)
@@ -0,0 +1,221 @@
+# This Python file uses the following encoding: utf-8
+
+"""
+Validators made of many rules that share one parse and one traversal.
+
+A rule is a function that is given tree nodes and says whether to flag
+them.  It is registered for the nodes it is about, by label pattern (as
+in annotald.query: "NP*", "NP-SUBJ|NP-OBJ", "/IP-.*/") or by terminal
+category (the part of a terminal's tag before the first "_", such as
+"so" for verbs), or for every node if neither is given::
+
+    rules = RuleEngine()
+
+    @rules.rule(labels="NP*")
+    def np_without_children(node, path):
+        return len(node) == 0 and "empty noun phrase"
+
+    @rules.rule(categories="so")
+    def verb_without_lemma(node, path):
+        return node.lemma is None
+
+    validators = {"rules": rules.validator()}
+
+A rule is called as rule(node, path), path being the positions of the
+children from the root of the tree down to node, and returns a message
+or True to flag node, or anything false not to.  Rules see the nodes as
+they are in the text; flags are added when all rules have been run.
+
+Each tree is parsed once and walked once, the META node and the
+unlabelled node that wraps a tree being skipped;
+a node is given to the rules registered for its label, which are found
+from a table built once for each distinct label.  A flagged node gets
+"-FLAG" appended to its label, unless its label has it already;
+terminals are told apart by their lower case tags, so a flag raised on
+a terminal goes on the node above it.  The
+time each rule takes, how often it is called and how many nodes it
+flags are kept (see stats and report); validations run on worker
+processes (see parallel.validate_many) keep theirs in the workers.
+"""
+
+from collections import namedtuple
+import threading
+import time
+
+from annotald.annotree import AnnoTree, html_parens_to_escaped_parens, iter_tree_spans
+from annotald.annotree import terminal_codec
+from annotald.query import Pattern
+
+
+FLAG = "-FLAG"
+
+
+class Flag(namedtuple("Flag", "rule, tree_id, path, label, message")):
+    """
+    A node flagged by a rule: the rule's name, the ID-LOCAL of the tree,
+    the path of the node and its label, and what the rule said of it
+    """
+
+    __slots__ = ()
+
+
+class Rule(object):
+    def __init__(self, fn, labels=None, categories=None, name=None):
+        self.fn = fn
+        self.name = name or fn.__name__
+        self.labels = Pattern(labels) if labels is not None else None
+        if isinstance(categories, str):
+            categories = categories.split("|")
+        self.categories = frozenset(categories) if categories is not None else None
+
+    def applies_to(self, label):
+        if self.labels is None and self.categories is None:
+            return True
+        if self.labels is not None and self.labels.matches(label):
+            return True
+        return (
+            self.categories is not None
+            and label.islower()
+            and terminal_codec.decode(label).cat in self.categories
+        )
+
+
+class RuleEngine(object):
+    def __init__(self, flag=FLAG):
+        self.flag = flag
+        self.rules = []
+        # label -> the positions of the rules that apply to it
+        self._dispatch = {}
+        self._lock = threading.Lock()
+        self._seconds = []
+        self._calls = []
+        self._flags = []
+
+    def add(self, fn, labels=None, categories=None, name=None):
+        """ Register fn as a rule; see the module docstring """
+        with self._lock:
+            self.rules.append(Rule(fn, labels, categories, name))
+            self._seconds.append(0.0)
+            self._calls.append(0)
+            self._flags.append(0)
+            self._dispatch = {}
+        return fn
+
+    def rule(self, labels=None, categories=None, name=None):
+        """ A decorator registering its function as a rule """
+        return lambda fn: self.add(fn, labels, categories, name)
+
+    def _rules_for(self, label):
+        found = self._dispatch.get(label)
+        if found is None:
+            found = self._dispatch[label] = tuple(
+                idx for (idx, rule) in enumerate(self.rules) if rule.applies_to(label)
+            )
+        return found
+
+    def check(self, tree):
+        """ The flags the rules raise on tree, which is left as it is """
+        flags = []
+        tree_id = None
+        seconds = self._seconds
+        calls = self._calls
+        flagged = self._flags
+        rules = self.rules
+        clock = time.perf_counter
+        stack = [(tree, ())]
+        while stack:
+            (node, path) = stack.pop()
+            label = node.label()
+            # The wrapper of the tree is no node of it; flagged, its label
+            # would be the flag alone
+            applying = self._rules_for(label) if label or path else ()
+            for idx in applying:
+                start = clock()
+                result = rules[idx].fn(node, path)
+                seconds[idx] += clock() - start
+                calls[idx] += 1
+                if result:
+                    flagged[idx] += 1
+                    if tree_id is None:
+                        tree_id = (tree.get_metadata() or {}).get("tree_id")
+                    flags.append(Flag(
+                        rules[idx].name,
+                        tree_id,
+                        path,
+                        label,
+                        result if isinstance(result, str) else None,
+                    ))
+            for pos in range(len(node) - 1, -1, -1):
+                child = node[pos]
+                if isinstance(child, AnnoTree) and child.label() != "META":
+                    stack.append((child, path + (pos,)))
+        return flags
+
+    def apply(self, tree, flags):
+        """ Flag the nodes of tree at the paths of flags; whether it changed """
+        changed = False
+        for path in set(flag.path for flag in flags):
+            node = tree
+            for pos in path:
+                if AnnoTree.is_terminal(node[pos]):
+                    break
+                node = node[pos]
+            if not node.label().endswith(self.flag):
+                node.set_label(node.label() + self.flag)
+                changed = True
+        return changed
+
+    def run(self, text):
+        """
+        Run the rules on each tree of text.  The trees with the flagged
+        nodes flagged, and the flags; trees that are not changed are given
+        back as they are.
+        """
+        trees = []
+        flags = []
+        for (start, end, tree) in iter_tree_spans(text):
+            tree_flags = self.check(tree)
+            flags.extend(tree_flags)
+            if tree_flags and self.apply(tree, tree_flags):
+                # Parsing turned escaped parens into HTML entities
+                trees.append(html_parens_to_escaped_parens(tree.pretty()))
+            else:
+                trees.append(text[start:end])
+        return ("\n\n".join(trees), flags)
+
+    def validator(self):
+        """ A validator (see settings.py) running the rules """
+
+        def validate(version, trees):
+            return self.run(trees)[0]
+
+        return validate
+
+    def stats(self):
+        """ For each rule, by name, its seconds, calls and flags so far """
+        return {
+            rule.name: {
+                "seconds": self._seconds[idx],
+                "calls": self._calls[idx],
+                "flags": self._flags[idx],
+            }
+            for (idx, rule) in enumerate(self.rules)
+        }
+
+    def report(self):
+        """ The time each rule has taken, slowest first, as a table """
+        lines = ["{0:<30} {1:>10} {2:>10} {3:>8}  {4:>6}".format(
+            "rule", "seconds", "calls", "flags", "share")]
+        total = sum(self._seconds) or 1.0
+        for (name, stats) in sorted(self.stats().items(),
+                                    key=lambda item: -item[1]["seconds"]):
+            lines.append("{0:<30} {1:>10.4f} {2:>10} {3:>8}  {4:6.1%}".format(
+                name, stats["seconds"], stats["calls"], stats["flags"],
+                stats["seconds"] / total))
+        return "\n".join(lines)
+
+    def reset(self):
+        with self._lock:
+            self._seconds = [0.0] * len(self.rules)
+            self._calls = [0] * len(self.rules)
+            self._flags = [0] * len(self.rules)
@@ -0,0 +1,84 @@
+# This Python file uses the following encoding: utf-8
+
+import unittest
+
+from annotald.rules import RuleEngine
+
+TREE = ("( (META (ID-LOCAL t.psd,.1) (COMMENT )) (S0 (S-MAIN "
+        "(NP-SUBJ (pfn_et_nf_p1 Ég (lemma ég))) "
+        "(VP (so_1_þf_et_p1 sá (lemma sjá)) "
+        "(NP-OBJ (no_et_þf_kk mann (lemma maður)))) (grm .))))")
+
+UNFLAGGED = ("( (META (ID-LOCAL t.psd,.2) (COMMENT )) (S0 (S-MAIN "
+             "(VP (so_0_et_p1 sef (lemma sofa))) (grm .))))")
+
+
+class RuleEngineTest(unittest.TestCase):
+    def setUp(self):
+        self.engine = RuleEngine()
+        self.seen = []
+
+        @self.engine.rule(labels="NP*")
+        def noun_phrase(node, path):
+            self.seen.append(node.label())
+            return node.label().startswith("NP-OBJ") and "object"
+
+        @self.engine.rule(categories="so|pfn")
+        def verb_or_pronoun(node, path):
+            self.seen.append(node.label())
+            return node.label().startswith("so_1")
+
+        @self.engine.rule()
+        def anything(node, path):
+            return False
+
+    def test_run(self):
+        (text, flags) = self.engine.run(TREE + "\n\n" + UNFLAGGED)
+        (flagged, untouched) = text.split("\n\n")
+        self.assertIn("(NP-OBJ-FLAG (no_et_þf_kk mann", flagged)
+        # Terminals are flagged through the node above them
+        self.assertIn("(VP-FLAG (so_1_þf_et_p1 sá", flagged)
+        self.assertEqual(untouched, UNFLAGGED)
+        self.assertEqual(
+            [(flag.rule, flag.tree_id, flag.path, flag.label, flag.message)
+             for flag in flags],
+            [("verb_or_pronoun", "t.psd,.1", (1, 0, 1, 0), "so_1_þf_et_p1", None),
+             ("noun_phrase", "t.psd,.1", (1, 0, 1, 1), "NP-OBJ", "object")])
+        # Nodes are dispatched only to the rules for their label or category
+        self.assertEqual(sorted(set(self.seen)),
+                         ["NP-OBJ", "NP-SUBJ", "pfn_et_nf_p1", "so_0_et_p1",
+                          "so_1_þf_et_p1"])
+
+    def test_escaped_parens(self):
+        tree = TREE.replace("(no_et_þf_kk mann (lemma maður))",
+                            "(entity \\(AB\\) (lemma \\(AB\\)))")
+        (text, _) = self.engine.run(tree)
+        self.assertIn("(NP-OBJ-FLAG (entity \\(AB\\) (lemma \\(AB\\))))", text)
+        self.assertNotIn("&#40;", text)
+
+    def test_root_wrapper_is_skipped(self):
+        engine = RuleEngine()
+        labels = []
+        engine.add(lambda node, path: labels.append(node.label()) or True, name="every")
+        (text, flags) = engine.run(UNFLAGGED)
+        self.assertNotIn("", labels)
+        self.assertIn("S0", labels)
+        self.assertTrue(text.startswith("( (META"))
+        self.assertNotIn("(-FLAG", text)
+
+    def test_flags_are_added_once(self):
+        (text, _) = self.engine.run(TREE)
+        (again, flags) = self.engine.run(text)
+        self.assertEqual(again, text)
+        self.assertEqual(len(flags), 2)
+
+    def test_stats(self):
+        self.engine.validator()(None, TREE)
+        stats = self.engine.stats()
+        self.assertEqual(stats["noun_phrase"]["calls"], 2)
+        self.assertEqual(stats["noun_phrase"]["flags"], 1)
+        # S0, S-MAIN, NP-SUBJ, pfn, VP, so, NP-OBJ, no and grm
+        self.assertEqual(stats["anything"]["calls"], 9)
+        self.assertEqual(len(self.engine.report().split("\n")), 4)
+        self.engine.reset()
+        self.assertEqual(self.engine.stats()["anything"]["calls"], 0)
@@ -0,0 +1,173 @@
+# This Python file uses the following encoding: utf-8
+
+"""
+An inverted index of the trees of a corpus, for finding trees by text.
+
+Every atom of a tree's text (a word, lemma, terminal category, label or
+metadata value: any run of characters other than whitespace and
+parentheses) is mapped to the sorted positions of the trees it occurs
+in.  A search text without whitespace or parentheses can only occur in
+a tree inside one of its atoms, so such searches are answered from the
+atoms that contain the text without looking at the trees themselves;
+the Corpus scans the texts for other searches.
+
+The atoms that contain a search text are found from the trigrams of
+the atoms: only atoms that have every trigram of the search text are
+looked at.  Search texts shorter than a trigram are looked for in every
+atom.
+
+The index is updated in place as trees are given new texts, added or
+removed.  The positions a search text occurs in are cached until the
+index next changes, so stepping through the matches of a search, or
+counting them, costs a binary search.
+"""
+
+from array import array
+import bisect
+import re
+import threading
+
+
+ATOM_RE = re.compile(r"[^\s()]+")
+# Search texts whose positions are kept until the index changes
+MAX_CACHED_SEARCHES = 64
+GRAM = 3
+
+
+def atoms(text):
+    # The same as ATOM_RE.findall, at a third of the cost
+    return set(text.replace("(", " ").replace(")", " ").split())
+
+
+def grams(text):
+    return {text[idx : idx + GRAM] for idx in range(len(text) - GRAM + 1)}
+
+
+def is_indexable(text):
+    """ Whether searches for text can be answered from the index """
+    return ATOM_RE.fullmatch(text) is not None
+
+
+class SearchIndex(object):
+    def __init__(self, texts, records=None):
+        """
+        records is the list of records of the Corpus whose texts are
+        indexed; the index can answer searches only for that list
+        """
+        self.records = records
+        # atom -> positions of the trees it occurs in, in order
+        self._postings = {}
+        # trigram -> the atoms that have it
+        self._grams = {}
+        self._searches = {}
+        self._lock = threading.Lock()
+        for (idx, text) in enumerate(texts):
+            for atom in atoms(text):
+                positions = self._postings.get(atom)
+                if positions is None:
+                    positions = self._postings[atom] = array("l")
+                positions.append(idx)
+        for atom in self._postings:
+            self._add_grams(atom)
+
+    def __len__(self):
+        """ The number of distinct atoms """
+        return len(self._postings)
+
+    def _add_grams(self, atom):
+        for gram in grams(atom):
+            found = self._grams.get(gram)
+            if found is None:
+                found = self._grams[gram] = set()
+            found.add(atom)
+
+    def _remove_grams(self, atom):
+        for gram in grams(atom):
+            found = self._grams[gram]
+            found.discard(atom)
+            if not found:
+                del self._grams[gram]
+
+    def _add(self, atom, idx):
+        positions = self._postings.get(atom)
+        if positions is None:
+            positions = self._postings[atom] = array("l")
+            self._add_grams(atom)
+        bisect.insort(positions, idx)
+
+    def _remove(self, atom, idx):
+        positions = self._postings[atom]
+        del positions[bisect.bisect_left(positions, idx)]
+        if not positions:
+            del self._postings[atom]
+            self._remove_grams(atom)
+
+    def update(self, changes, records):
+        """
+        changes holds (position, old text, new text) for the trees given
+        new texts; records is the corpus's list of records after them
+        """
+        with self._lock:
+            for (idx, old_text, new_text) in changes:
+                old_atoms = atoms(old_text)
+                new_atoms = atoms(new_text)
+                for atom in old_atoms - new_atoms:
+                    self._remove(atom, idx)
+                for atom in new_atoms - old_atoms:
+                    self._add(atom, idx)
+            self._searches.clear()
+            self.records = records
+
+    def splice(self, start, old_texts, new_texts, records):
+        """
+        The trees old_texts in positions start onwards were replaced by
+        new_texts, and the trees after them moved; records is the
+        corpus's list of records after that
+        """
+        end = start + len(old_texts)
+        shift = len(new_texts) - len(old_texts)
+        with self._lock:
+            for (idx, text) in enumerate(old_texts, start):
+                for atom in atoms(text):
+                    self._remove(atom, idx)
+            if shift:
+                for positions in self._postings.values():
+                    i = bisect.bisect_left(positions, end)
+                    if i < len(positions):
+                        positions[i:] = array("l", [idx + shift for idx in positions[i:]])
+            for (idx, text) in enumerate(new_texts, start):
+                for atom in atoms(text):
+                    self._add(atom, idx)
+            self._searches.clear()
+            self.records = records
+
+    def _atoms_containing(self, text):
+        text_grams = grams(text)
+        if not text_grams:
+            return [atom for atom in self._postings if text in atom]
+        candidates = sorted((self._grams.get(gram, ()) for gram in text_grams), key=len)
+        found = set(candidates[0])
+        for atoms_with_gram in candidates[1:]:
+            if not found:
+                break
+            found &= atoms_with_gram
+        return [atom for atom in found if text in atom]
+
+    def positions(self, text, records):
+        """
+        The positions of the trees whose text contains text, in order, or
+        None if the index is not of records
+        """
+        with self._lock:
+            if records is not self.records:
+                return None
+            positions = self._searches.get(text)
+            if positions is None:
+                found = set()
+                for atom in self._atoms_containing(text):
+                    found.update(self._postings[atom])
+                positions = array("l", sorted(found))
+                if len(self._searches) >= MAX_CACHED_SEARCHES:
+                    self._searches.clear()
+                self._searches[text] = positions
+            return positions
@@ -0,0 +1,47 @@
+import unittest
+
+from annotald.searchindex import SearchIndex, atoms, is_indexable
+
+
+class SearchIndexTest(unittest.TestCase):
+    def test_atoms(self):
+        self.assertEqual(atoms("( (S0 (no_et_nf_kk maður (lemma maður))))"),
+                         {"S0", "no_et_nf_kk", "maður", "lemma"})
+        self.assertTrue(is_indexable("maður"))
+        self.assertFalse(is_indexable("(S0"))
+        self.assertFalse(is_indexable("no maður"))
+        self.assertFalse(is_indexable(""))
+
+    def test_positions(self):
+        records = []
+        index = SearchIndex(["(S0 (X hestur))", "(S0 (X maður))", "(S0 (Y hest))"],
+                            records)
+        self.assertEqual(list(index.positions("hest", records)), [0, 2])
+        self.assertEqual(list(index.positions("S0", records)), [0, 1, 2])
+        self.assertEqual(list(index.positions("köttur", records)), [])
+        # Only the records the index is of are answered for
+        self.assertIsNone(index.positions("hest", []))
+
+    def test_update(self):
+        records = []
+        index = SearchIndex(["(S0 (X hestur))", "(S0 (X maður))"], records)
+        self.assertEqual(list(index.positions("hest", records)), [0])
+        new_records = []
+        index.update([(1, "(S0 (X maður))", "(S0 (X hestar))")], new_records)
+        self.assertIsNone(index.positions("hest", records))
+        self.assertEqual(list(index.positions("hest", new_records)), [0, 1])
+        self.assertEqual(list(index.positions("maður", new_records)), [])
+        self.assertEqual(len(index), 4)
+
+    def test_splice(self):
+        records = []
+        index = SearchIndex(["(S0 (X hestur))", "(S0 (X maður))", "(S0 (Y hest))"],
+                            records)
+        new_records = []
+        index.splice(1, ["(S0 (X maður))"], ["(S0 (Z köttur))", "(S0 (Z hestar))"],
+                     new_records)
+        self.assertEqual(list(index.positions("hest", new_records)), [0, 2, 3])
+        self.assertEqual(list(index.positions("kött", new_records)), [1])
+        self.assertEqual(list(index.positions("maður", new_records)), [])
+        # Search texts shorter than a trigram are looked for in every atom
+        self.assertEqual(list(index.positions("Z", new_records)), [1, 2])
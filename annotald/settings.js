@@ -1540,6 +1540,15 @@ let aug_tree_example = {
     },
 };
 
+// Height in pixels assumed for a tree that has not been shown yet
+const VIRTUAL_TREE_HEIGHT = 300;
+// How far above and below the viewport trees are kept mounted, in viewport heights
+const VIRTUAL_MARGIN = 1;
+// Fewest trees fetched from the server at a time
+const VIRTUAL_FETCH_TREES = 100;
+// Most unmounted trees whose elements are kept to be mounted again
+const VIRTUAL_RECYCLED_ROWS = 200;
+
 function TreeManager() {
     this.aug_trees = annotrees;
     this.id_to_index = {};
@@ -1553,40 +1562,331 @@ function TreeManager() {
     };
     this.prev_selection = null;
     this.comment_visible = [];
+    // Server version (content hash) of each tree as of the last acknowledged save
+    this.versions = {};
+    // Trees changed since the last acknowledged save, by tree_id
+    this.dirty = {};
+    this.fetching = false;
+
+    /*
+     * In virtual mode only the trees near the viewport are in the DOM.  The
+     * rest of the file is stood in for by two spacers, sized from the
+     * measured height of every tree shown so far and an estimate for the
+     * others.  Trees are fetched from the server a window at a time and are
+     * kept as JSON text while they are not mounted.  The elements of the
+     * trees unmounted last are kept, so that scrolling back mounts them
+     * again instead of building them anew.
+     */
+    this.virtual = !!annotree_page.virtual;
+    this.total = annotree_page.total;
+    this.heights = [];
+    this.measured_count = 0;
+    this.measured_total = 0;
+    this.height_estimate = VIRTUAL_TREE_HEIGHT;
+    // offsets[idx] is the offset of the top of tree idx; the first
+    // offsets_valid of them are up to date
+    this.offsets = new Float64Array(1);
+    this.offsets_valid = 1;
+    // Elements of unmounted trees, by index, oldest first
+    this.recycled = new Map();
+    this.mounted_start = 0;
+    this.mounted_end = 0;
+    this.top_spacer = null;
+    this.bottom_spacer = null;
+    this.viewport_pending = false;
 
     this.init = () => {
         this.aug_trees.forEach((aug_tree, idx) => {
-            let tree_id = this.aug_trees[idx].meta.tree_id;
-            this.id_to_index[tree_id] = idx;
-            this.comment_visible[idx] = true;
+            this.register(idx, aug_tree);
         });
+        if (this.virtual) {
+            this.aug_trees.length = this.total;
+        }
         this.render_all();
     };
 
+    this.register = (idx, aug_tree) => {
+        let tree_id = aug_tree.meta.tree_id;
+        this.id_to_index[tree_id] = idx;
+        this.comment_visible[idx] = true;
+        this.versions[tree_id] = aug_tree.version;
+    };
+
+    this.fetch_window = (start, end, on_success) => {
+        if (this.fetching) {
+            return;
+        }
+        this.fetching = true;
+        let loaded = false;
+        $.ajax({
+            type: "GET",
+            url: "loadTrees",
+            data: {start: start, end: end},
+            dataType: "json",
+            success: (resp) => {
+                if (resp.result !== "success") {
+                    displayError("Could not load trees: " + resp.reason);
+                    return;
+                }
+                on_success(resp);
+                loaded = true;
+            },
+            error: (resp) => {
+                displayError("Could not load trees");
+            },
+            complete: () => {
+                this.fetching = false;
+                if (loaded) {
+                    // Keep going while the trees do not fill the window
+                    $(window).trigger("scroll");
+                }
+            },
+        });
+    };
+
+    this.store_trees = (start, aug_trees) => {
+        aug_trees.forEach((aug_tree, offset) => {
+            let idx = start + offset;
+            if (this.aug_trees[idx] !== undefined) {
+                // Already loaded, and possibly edited since
+                return;
+            }
+            this.aug_trees[idx] = JSON.stringify(aug_tree);
+            this.register(idx, aug_tree);
+        });
+    };
+
+    this.is_loaded = (idx) => {
+        return this.aug_trees[idx] !== undefined;
+    };
+
+    this.tree_count = () => {
+        return this.virtual ? this.total : this.aug_trees.length;
+    };
+
+    /*
+     * The tree at idx, unpacked from its JSON text if it is not mounted
+     */
+    this.tree_at = (idx) => {
+        let aug_tree = this.aug_trees[idx];
+        if (typeof aug_tree === "string") {
+            aug_tree = JSON.parse(aug_tree);
+            this.aug_trees[idx] = aug_tree;
+        }
+        return aug_tree;
+    };
+
+    this.set_tree = (idx, aug_tree) => {
+        this.aug_trees[idx] = aug_tree;
+        this.recycled.delete(idx);
+        this.dirty[aug_tree.meta.tree_id] = true;
+    };
+
     this.render_all = () => {
         $(this.container).empty();
+        this.recycled.clear();
+        this.selection.index = null;
+        this.selection.start = null;
+        this.selection.end = null;
+        if (this.virtual) {
+            this.top_spacer = $("<div/>", {class: "virtual-spacer"}).get(0);
+            this.bottom_spacer = $("<div/>", {class: "virtual-spacer"}).get(0);
+            this.container.append(this.top_spacer, this.bottom_spacer);
+            this.mounted_start = 0;
+            this.mounted_end = 0;
+            this.update_viewport();
+            return;
+        }
         this.aug_trees.forEach((aug_tree, idx) => {
             let dom_id = this.index_to_dom_id(idx);
             let elem = aug_tree_to_dom_elem(aug_tree, idx, dom_id);
             this.container.append($(elem));
         });
-        this.selection.index = null;
-        this.selection.start = null;
-        this.selection.end = null;
+    };
+
+    this.tree_height = (idx) => {
+        let height = this.heights[idx];
+        return height === undefined ? this.height_estimate : height;
+    };
+
+    this.set_height = (idx, height) => {
+        let old = this.heights[idx];
+        if (old === height) {
+            return;
+        }
+        if (old === undefined) {
+            this.measured_count += 1;
+            this.measured_total += height;
+        } else {
+            this.measured_total += height - old;
+        }
+        this.heights[idx] = height;
+        this.offsets_valid = Math.min(this.offsets_valid, idx + 1);
+    };
+
+    // Bring the offsets that are out of date up to date
+    this.update_offsets = () => {
+        if (this.offsets.length !== this.total + 1) {
+            this.offsets = new Float64Array(this.total + 1);
+            this.offsets_valid = 1;
+        }
+        for (let idx = this.offsets_valid; idx <= this.total; idx++) {
+            this.offsets[idx] = this.offsets[idx - 1] + this.tree_height(idx - 1);
+        }
+        this.offsets_valid = this.total + 1;
+    };
+
+    // Offset of the top of tree idx from the top of the container
+    this.offset_of = (idx) => {
+        this.update_offsets();
+        return this.offsets[idx];
+    };
+
+    // Index of the tree at offset y from the top of the container
+    this.index_at = (y) => {
+        this.update_offsets();
+        // The last tree whose top is at or above y
+        let low = 0;
+        let high = this.total;
+        while (low < high) {
+            let mid = (low + high + 1) >> 1;
+            if (this.offsets[mid] <= y) {
+                low = mid;
+            } else {
+                high = mid - 1;
+            }
+        }
+        return low;
+    };
+
+    /*
+     * Mount the trees within VIRTUAL_MARGIN viewports of the viewport and
+     * unmount the others, fetching any that have not been loaded first.
+     */
+    this.update_viewport = () => {
+        if (!this.virtual || this.top_spacer === null) {
+            return;
+        }
+        let view_height = $(window).height();
+        let view_top = $(window).scrollTop() - this.container.offset().top;
+        let margin = view_height * VIRTUAL_MARGIN;
+        let start = Math.max(0, this.index_at(view_top - margin));
+        let end = Math.min(this.total, this.index_at(view_top + view_height + margin) + 1);
+
+        let missing = [];
+        for (let idx = start; idx < end; idx++) {
+            if (!this.is_loaded(idx)) {
+                missing.push(idx);
+            }
+        }
+        if (missing.length > 0) {
+            let first = missing[0];
+            let last = Math.max(missing[missing.length - 1] + 1, first + VIRTUAL_FETCH_TREES);
+            this.fetch_window(first, last, (resp) => {
+                this.store_trees(resp.start, resp.trees);
+            });
+            return;
+        }
+        this.mount(start, end);
+    };
+
+    // Update the viewport once per frame however many scroll events come in
+    this.schedule_viewport = () => {
+        if (this.viewport_pending) {
+            return;
+        }
+        this.viewport_pending = true;
+        window.requestAnimationFrame(() => {
+            this.viewport_pending = false;
+            this.update_viewport();
+        });
+    };
+
+    this.mount = (start, end) => {
+        if (start === this.mounted_start && end === this.mounted_end) {
+            return;
+        }
+        for (let idx = this.mounted_start; idx < this.mounted_end; idx++) {
+            if (idx < start || end <= idx) {
+                this.unmount(idx);
+            }
+        }
+        let anchor = this.top_spacer;
+        for (let idx = start; idx < end; idx++) {
+            let elem = document.getElementById(this.index_to_dom_id(idx));
+            if (!elem) {
+                elem = this.recycled.get(idx);
+                if (elem === undefined) {
+                    elem = aug_tree_to_dom_elem(this.tree_at(idx), idx, this.index_to_dom_id(idx));
+                } else {
+                    this.recycled.delete(idx);
+                }
+                anchor.after(elem);
+            }
+            anchor = elem;
+        }
+        this.mounted_start = start;
+        this.mounted_end = end;
+        this.measure();
+        this.render_selection();
+    };
+
+    this.unmount = (idx) => {
+        let elem = document.getElementById(this.index_to_dom_id(idx));
+        if (elem) {
+            elem.remove();
+            this.recycled.set(idx, elem);
+            if (this.recycled.size > VIRTUAL_RECYCLED_ROWS) {
+                this.recycled.delete(this.recycled.keys().next().value);
+            }
+        }
+        if (typeof this.aug_trees[idx] === "object") {
+            this.aug_trees[idx] = JSON.stringify(this.aug_trees[idx]);
+        }
+    };
+
+    /*
+     * Record the heights of the mounted trees and resize the spacers.  Heights
+     * are taken between the tops of consecutive trees so that margins count.
+     */
+    this.measure = () => {
+        let tops = [];
+        for (let idx = this.mounted_start; idx < this.mounted_end; idx++) {
+            tops.push(document.getElementById(this.index_to_dom_id(idx)).offsetTop);
+        }
+        tops.push(this.bottom_spacer.offsetTop);
+        for (let offset = 1; offset < tops.length; offset++) {
+            this.set_height(this.mounted_start + offset - 1, tops[offset] - tops[offset - 1]);
+        }
+        if (this.measured_count > 0) {
+            let estimate = this.measured_total / this.measured_count;
+            if (estimate !== this.height_estimate) {
+                // Every tree not measured yet moves
+                this.height_estimate = estimate;
+                this.offsets_valid = 1;
+            }
+        }
+        $(this.top_spacer).height(this.offset_of(this.mounted_start));
+        $(this.bottom_spacer).height(
+            this.offset_of(this.total) - this.offset_of(this.mounted_end));
     };
 
     this.render_index = (idx) => {
         let aug_tree = this.get_tree_by_index(idx);
-        let elem = this.container.children().get(idx);
+        let dom_id = this.index_to_dom_id(idx);
+        let elem = document.getElementById(dom_id);
         if (!elem) {
-            console.err("Index out of bounds");
+            // Not mounted; rendered when it is scrolled to
+            this.recycled.delete(idx);
             return;
         }
         let tree = aug_tree.tree;
         tree.tree_id = aug_tree.meta.tree_id;
-        let dom_id = this.index_to_dom_id(idx);
         let new_elem = aug_tree_to_dom_elem(aug_tree, idx, dom_id);
         $(elem).replaceWith($(new_elem));
+        if (this.virtual) {
+            this.measure();
+        }
     };
 
     this.render_selection = () => {
@@ -1602,6 +1902,10 @@ function TreeManager() {
             return arr;
         }
         let dom_id = this.index_to_dom_id(this.selection.index);
+        if (!document.getElementById(dom_id)) {
+            // Scrolled out of view
+            return arr;
+        }
         let runner = this.get_element(dom_id, this.selection.start);
         arr.push(runner);
         if (this.selection.end) {
@@ -1630,7 +1934,7 @@ function TreeManager() {
             return;
         }
         this.record(this.selection);
-        this.aug_trees[selection.index] = aug_tree;
+        this.set_tree(selection.index, aug_tree);
         this.render_index(selection.index);
 
         this.selection.index = mod_sel.index;
@@ -1649,7 +1953,7 @@ function TreeManager() {
         this.record(this.selection);
         this.selection.index = null;
 
-        this.aug_trees[idx] = aug_tree;
+        this.set_tree(idx, aug_tree);
         this.render_index(idx);
 
         this.render_selection();
@@ -1719,7 +2023,7 @@ function TreeManager() {
         };
         this.redo_stack.push(curr_state);
         this.selection = saved.selection;
-        this.aug_trees[idx] = saved.aug_tree;
+        this.set_tree(idx, saved.aug_tree);
         this.render_index(idx);
         this.render_selection();
         this.render_caption();
@@ -1741,7 +2045,7 @@ function TreeManager() {
         };
         this.undo_stack.push(curr_state);
         this.selection = saved.selection;
-        this.aug_trees[idx] = saved.aug_tree;
+        this.set_tree(idx, saved.aug_tree);
         this.render_index(idx);
         this.render_selection();
         this.render_caption();
@@ -1771,14 +2075,14 @@ function TreeManager() {
         if (!this.selection.start) {
             return false;
         }
-        let tree = this.aug_trees[this.selection.index].tree;
+        let tree = this.tree_at(this.selection.index).tree;
         let text = tree_to_text(tree);
         return text;
     };
 
     this.get_tree_text = (dom_id) => {
         let idx = this.dom_id_to_index(dom_id);
-        let tree = this.aug_trees[idx].tree;
+        let tree = this.tree_at(idx).tree;
         let text = tree_to_text(tree);
         return text;
     };
@@ -1798,6 +2102,10 @@ function TreeManager() {
 
     this.get_tree_by_index = (idx) => {
         let aug_tree = this.aug_trees[idx];
+        if (typeof aug_tree === "string") {
+            // Parsing the packed tree already makes a copy
+            return JSON.parse(aug_tree);
+        }
         return clone_obj(aug_tree);
     };
 
@@ -1923,7 +2231,7 @@ function TreeManager() {
         }
 
         let tree_idx = sel.index + 1;
-        if (this.aug_trees.length < tree_idx) {
+        if (this.tree_count() <= tree_idx || !this.is_loaded(tree_idx)) {
             // no wrap
             this.selection.index = null;
             this.selection.start = null;
@@ -1959,7 +2267,7 @@ function TreeManager() {
         }
 
         let tree_idx = sel.index - 1;
-        if (0 <= tree_idx) {
+        if (0 <= tree_idx && this.is_loaded(tree_idx)) {
             let prev_tree = this.get_tree_by_index(tree_idx).tree;
             this.selection.index = tree_idx;
             this.selection.start = node_path_last(prev_tree);
@@ -2031,20 +2339,63 @@ function TreeManager() {
     };
 
     this.go_to_selection = () => {
-        if (this.has_selection()) {
-            scrollToShowSel($(".snodesel").first());
+        if (!this.has_selection()) {
+            return;
+        }
+        let dom_id = this.index_to_dom_id(this.selection.index);
+        if (this.virtual && !document.getElementById(dom_id)) {
+            // Bring the tree into the viewport so that it gets mounted
+            window.scroll(0, this.container.offset().top + this.offset_of(this.selection.index));
+            this.update_viewport();
         }
+        scrollToShowSel($(".snodesel").first());
     };
 
     this.get_all_trees = () => {
         let clones = [];
         this.aug_trees.forEach((item, idx) => {
-            let cloned = clone_obj(item);
+            let cloned = this.get_tree_by_index(idx);
             normalize_variants(cloned.tree);
             clones.push(cloned);
         });
         return clones;
     };
+
+    /*
+     * Changes since the last acknowledged save, each addressed by tree_id and the
+     * server version it was based on.  The trees are no longer considered dirty;
+     * call save_failed with the changes if the server does not accept them.
+     */
+    this.take_changes = () => {
+        let changes = [];
+        Object.keys(this.dirty).forEach((tree_id) => {
+            let cloned = this.get_tree_by_index(this.id_to_index[tree_id]);
+            normalize_variants(cloned.tree);
+            changes.push({
+                tree_id: tree_id,
+                base_version: this.versions[tree_id],
+                tree: cloned,
+            });
+        });
+        this.dirty = {};
+        return changes;
+    };
+
+    this.save_succeeded = (versions) => {
+        Object.keys(versions).forEach((tree_id) => {
+            this.versions[tree_id] = versions[tree_id];
+        });
+    };
+
+    this.save_failed = (changes) => {
+        changes.forEach((change) => {
+            this.dirty[change.tree_id] = true;
+        });
+    };
+
+    this.has_changes = () => {
+        return Object.keys(this.dirty).length > 0;
+    };
 }
 
 function common_prefix(path, other) {
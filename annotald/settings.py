@@ -30,15 +30,35 @@ rewriteIndices = True
 # Tips:
 # - use the OrderedDict class (form the collections module) to preserve
 #   the order of the validators in the menu
+# - many trees are validated on worker processes, each of which runs
+#   this file to get the validators; set a validator's parallel
+#   attribute to False to keep it in the server's process
+# - validated trees are remembered (see annotald/validationcache.py); set a
+#   validator's idempotent attribute to True if it gives back the trees
+#   it gave back unchanged, so that those are not validated again
 
 validators = {}
 
 # from lovett.annotald import stdinValidator, flagIf
+# from annotald.util import corpusSearchValidate
 # validators = {
 #     "example of a stdin validation query": stdinValidator("/path/to/script.py"),
 #     "example of a lovett validator": flagIf(lovett expression),
-#     "example of a corpussearch-based validator": TODO
+#     "example of a corpussearch-based validator":
+#         corpusSearchValidate("/path/to/query.q"),
 # }
 
+# Checks written in Python are best made rules of one RuleEngine, which
+# parses the trees once and runs every rule in one pass (see
+# annotald/rules.py):
+# from annotald.rules import RuleEngine
+# rules = RuleEngine()
+#
+# @rules.rule(categories="so")
+# def verb_without_lemma(node, path):
+#     return node.lemma is None
+#
+# validators = {"rules": rules.validator()}
+
 # TODO: document
 serverMode = True
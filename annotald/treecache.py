@@ -0,0 +1,272 @@
+# This Python file uses the following encoding: utf-8
+
+"""
+A persistent cache of parsed trees, stored next to the corpus file.
+
+The cache (``foo.psd.cache``) maps the md5 of a tree's text, as recorded
+in the TreeIndex, to the AnnoTree encoded as JSON: a node is a list of
+its label, lemma, exp_seg and exp_abbrev followed by its children, and
+a leaf is a string.  The file lies next to the corpus, where others may
+be able to write, so it holds only data: a bad entry can at worst give
+a wrong tree, never run code.  Each entry also carries the md5 of the
+tree's digest and encoding, and entries that do not match it are
+ignored.  Since entries are addressed by
+content, an entry can never be stale: editing a tree changes its hash, so
+only the edited tree misses the cache and gets a new entry, and trees that
+did not change are found again even after the file has been rewritten.
+
+The file is a sequence of frames and is only ever appended to, so adding
+entries after a save is cheap and a crash can at worst cut off the last
+frame, which is then ignored.  A header frame records the size, mtime and
+content hash of the corpus file the cache was last synced with.  When
+unreferenced entries outnumber the live ones the cache is compacted by
+writing a new file and renaming it into place.
+
+Loading the cache is a single read of the file; trees are decoded when
+they are asked for.
+"""
+
+import binascii
+import gc
+import hashlib
+import json
+import os
+import struct
+import threading
+
+from annotald.annotree import AnnoTree, _make_tree
+
+
+CACHE_SUFFIX = ".cache"
+CACHE_FORMAT = 2
+
+_FRAME = struct.Struct("<cI")
+_HEADER = b"H"
+_TREE = b"T"
+_DIGEST_SIZE = 16
+
+
+def _encode(tree):
+    if not isinstance(tree, AnnoTree):
+        return tree
+    return [tree.label(), tree.lemma, tree.exp_seg, tree.exp_abbrev] + [
+        _encode(child) for child in tree
+    ]
+
+
+def _decode(data):
+    if type(data) is str:
+        return data
+    (label, lemma, exp_seg, exp_abbrev) = data[:4]
+    return _make_tree(AnnoTree, label, [_decode(child) for child in data[4:]],
+                      lemma, exp_seg, exp_abbrev)
+
+
+def _checksum(digest, data):
+    """ digest is the tree's md5 as bytes, data its encoding """
+    return hashlib.md5(digest + data).digest()
+
+
+class TreeCache(object):
+    def __init__(self, filename):
+        self.filename = str(filename)
+        self.header = {}
+        # md5 hex digest of a tree's text -> checksum and encoding
+        self._records = {}
+        self._pending = []
+        self._frames = 0
+        # Server threads add trees and flush concurrently
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def cache_filename(self):
+        return self.filename + CACHE_SUFFIX
+
+    @classmethod
+    def for_file(cls, filename):
+        cache = cls(filename)
+        cache.load()
+        return cache
+
+    def load(self):
+        try:
+            with open(self.cache_filename, "rb") as fh:
+                data = fh.read()
+        except OSError:
+            return
+        view = memoryview(data)
+        pos = 0
+        while pos + _FRAME.size <= len(data):
+            (kind, length) = _FRAME.unpack_from(data, pos)
+            start = pos + _FRAME.size
+            end = start + length
+            if end > len(data):
+                break
+            if kind == _HEADER:
+                try:
+                    header = json.loads(bytes(view[start:end]).decode("utf-8"))
+                except ValueError:
+                    header = {}
+                if header.get("format") != CACHE_FORMAT:
+                    # Written by another version; start a new one
+                    self._records = {}
+                    self.header = {}
+                    self._frames = 0
+                    try:
+                        os.unlink(self.cache_filename)
+                    except OSError:
+                        pass
+                    return
+                self.header = header
+            elif kind == _TREE:
+                digest = binascii.hexlify(view[start : start + _DIGEST_SIZE])
+                self._records[digest.decode("ascii")] = view[start + _DIGEST_SIZE : end]
+            self._frames += 1
+            pos = end
+        if pos != len(data):
+            # The last frame was cut off by a crash while appending; drop it
+            # so that new frames are appended after the last good one
+            try:
+                with open(self.cache_filename, "r+b") as fh:
+                    fh.truncate(pos)
+            except OSError:
+                pass
+
+    def is_valid_for(self, index):
+        """ Whether the cache was last synced with the file index describes """
+        return (
+            self.header.get("size") == index.size
+            and self.header.get("mtime") == index.mtime
+            and self.header.get("digest") == index.corpus_digest()
+        )
+
+    def __contains__(self, digest):
+        return digest in self._records
+
+    def get(self, digest):
+        data = self._records.get(digest)
+        if data is None:
+            self.misses += 1
+            return None
+        checksum = bytes(data[:_DIGEST_SIZE])
+        data = bytes(data[_DIGEST_SIZE:])
+        try:
+            if checksum != _checksum(binascii.unhexlify(digest), data):
+                raise ValueError("Checksum mismatch")
+            tree = _decode(json.loads(data.decode("utf-8")))
+        except (ValueError, TypeError, IndexError, RecursionError):
+            # Damaged, or not written by us; the tree is parsed instead
+            with self._lock:
+                self._records.pop(digest, None)
+            self.misses += 1
+            return None
+        self.hits += 1
+        return tree
+
+    def put(self, digest, tree):
+        """ Add a tree; it is written to disk on the next flush """
+        with self._lock:
+            if digest in self._records:
+                return
+            try:
+                encoded = json.dumps(_encode(tree), ensure_ascii=False,
+                                     separators=(",", ":")).encode("utf-8")
+            except RecursionError:
+                # Too deep to encode; it is parsed each time instead
+                return
+            data = _checksum(binascii.unhexlify(digest), encoded) + encoded
+            self._records[digest] = data
+            self._pending.append(
+                _FRAME.pack(_TREE, _DIGEST_SIZE + len(data))
+                + binascii.unhexlify(digest)
+                + data
+            )
+
+    def flush(self):
+        with self._lock:
+            if not self._pending:
+                return
+            try:
+                with open(self.cache_filename, "ab") as fh:
+                    fh.write(b"".join(self._pending))
+            except OSError:
+                print("Could not write tree cache %s" % self.cache_filename)
+            self._frames += len(self._pending)
+            self._pending = []
+
+    def sync(self, index):
+        """
+        Record that the cache is up to date with the file index describes.
+
+        Entries no longer referenced by the index are dropped by compacting
+        the cache once they outnumber the live ones.
+        """
+        with self._lock:
+            live = set(entry.digest for entry in index.entries)
+            if self._frames > 2 * max(len(live), 1):
+                self.compact(live, index)
+                return
+            self.flush()
+            header = self._header_for(index)
+            if header == self.header:
+                return
+            self.header = header
+            self._pending.append(self._header_frame(header))
+            self.flush()
+
+    def compact(self, live, index):
+        """ Rewrite the cache with only the entries whose digest is in live """
+        with self._lock:
+            self._pending = []
+            self._records = {
+                digest: data for (digest, data) in self._records.items() if digest in live
+            }
+            self.header = self._header_for(index)
+            frames = [self._header_frame(self.header)]
+            for (digest, data) in self._records.items():
+                frames.append(
+                    _FRAME.pack(_TREE, _DIGEST_SIZE + len(data))
+                    + binascii.unhexlify(digest)
+                    + bytes(data)
+                )
+            tmp_name = self.cache_filename + ".tmp"
+            try:
+                with open(tmp_name, "wb") as fh:
+                    fh.write(b"".join(frames))
+                os.replace(tmp_name, self.cache_filename)
+            except OSError:
+                print("Could not write tree cache %s" % self.cache_filename)
+            self._frames = len(frames)
+
+    @staticmethod
+    def _header_for(index):
+        return {
+            "format": CACHE_FORMAT,
+            "size": index.size,
+            "mtime": index.mtime,
+            "digest": index.corpus_digest(),
+        }
+
+    @staticmethod
+    def _header_frame(header):
+        data = json.dumps(header).encode("utf-8")
+        return _FRAME.pack(_HEADER, len(data)) + data
+
+
+class gc_paused(object):
+    """
+    Suspend the cyclic garbage collector while building many objects.
+
+    Trees hold no reference cycles, so the collector passes triggered by
+    allocating millions of nodes are pure overhead.
+    """
+
+    def __enter__(self):
+        self.was_enabled = gc.isenabled()
+        gc.disable()
+
+    def __exit__(self, *exc_info):
+        if self.was_enabled:
+            gc.enable()
@@ -0,0 +1,83 @@
+import os, shutil, tempfile, unittest
+
+from annotald import util
+from annotald.corpusfile import CorpusFile
+from annotald.treecache import TreeCache
+
+TREES = ["( (META (ID-LOCAL t.psd,.{0})) (S0 (no_et_nf_kk a{0} (lemma a))))".format(i)
+         for i in range(3)]
+
+
+class TreeCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "t.psd")
+        with open(self.path, "w", encoding="utf-8") as fh:
+            fh.write("\n\n".join(TREES))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def load(self):
+        cache = TreeCache.for_file(self.path)
+        with CorpusFile(self.path, cache=cache) as corpus:
+            return (cache, corpus.trees(), corpus.index)
+
+    def test_reopen_hits_cache(self):
+        (cache, trees, index) = self.load()
+        self.assertEqual(cache.misses, 3)
+        (cache, cached_trees, index) = self.load()
+        self.assertEqual((cache.hits, cache.misses), (3, 0))
+        self.assertTrue(cache.is_valid_for(index))
+        self.assertEqual(cached_trees, trees)
+        self.assertEqual(cached_trees[0][1][0].lemma, "a")
+
+    def test_edit_misses_only_edited_tree(self):
+        self.load()
+        edited = TREES[:]
+        edited[1] = edited[1].replace("a1", "b1")
+        util.writeTreesToFile("", "\n\n".join(edited), self.path)
+        (cache, trees, index) = self.load()
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+        self.assertEqual(trees[1][1][0][0], "b1")
+
+    def test_truncated_cache(self):
+        self.load()
+        # Cut the file in the middle of the last tree frame
+        cache = TreeCache.for_file(self.path)
+        size = os.path.getsize(self.path + ".cache")
+        header_size = len(TreeCache._header_frame(cache.header))
+        with open(self.path + ".cache", "r+b") as fh:
+            fh.truncate(size - header_size - 3)
+        (cache, trees, index) = self.load()
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+        (cache, trees, index) = self.load()
+        self.assertEqual((cache.hits, cache.misses), (3, 0))
+        self.assertEqual(len(trees), 3)
+
+    def test_compaction(self):
+        for num in range(4):
+            edited = [tree.replace("(lemma a)", "(lemma a%d)" % num) for tree in TREES]
+            util.writeTreesToFile("", "\n\n".join(edited), self.path)
+            (cache, trees, index) = self.load()
+        self.assertLessEqual(len(TreeCache.for_file(self.path)._records), 6)
+
+    def test_tampered_cache(self):
+        (cache, trees, index) = self.load()
+        with open(self.path + ".cache", "rb") as fh:
+            data = fh.read()
+        self.assertEqual(data.count(b'"a1"'), 1)
+        with open(self.path + ".cache", "wb") as fh:
+            fh.write(data.replace(b'"a1"', b'"x1"'))
+        (cache, tampered_trees, index) = self.load()
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+        self.assertEqual(tampered_trees, trees)
+
+    def test_other_format(self):
+        self.load()
+        with open(self.path + ".cache", "wb") as fh:
+            fh.write(TreeCache._header_frame({"format": 0}))
+        (cache, trees, index) = self.load()
+        self.assertEqual(cache.misses, 3)
+        (cache, trees, index) = self.load()
+        self.assertEqual((cache.hits, cache.misses), (3, 0))
@@ -21,8 +21,8 @@ from __future__ import unicode_literals
 import annotald
 
 # Python standard library
-import codecs
 import getpass
+import io
 import json
 import os
 import pkg_resources
@@ -32,13 +32,28 @@ import sys
 import time
 import traceback
 import argparse
+import copy
+import functools
+import html
+import itertools
+import threading
+import urllib.parse
+import zlib
+from collections import OrderedDict
 
 # External libraries
 import cherrypy
 import cherrypy.lib.caching
-from mako.template import Template
+import cherrypy.process.plugins
+from mako.lookup import TemplateLookup
 
 from annotald.annotree import AnnoTree
+from annotald.assets import ASSET_CACHE_CONTROL, AssetBundle
+from annotald.corpus import Corpus
+from annotald.rendercache import RenderCache
+from annotald.treecache import TreeCache
+from annotald.treeindex import tree_digest
+from annotald.validationcache import Restructured, ValidationCache, split_trees
 
 try:
     from icecream import ic
@@ -46,6 +61,7 @@ try:
 except ImportError:  # Graceful fallback if IceCream isn't installed.
     ic = lambda *a: None if not a else (a[0] if len(a) == 1 else a)  # noqa
 
+from annotald import parallel
 from annotald import util
 from annotald import reynir_utils
 
@@ -54,12 +70,198 @@ VERSION = annotald.__version__
 HTML_LPAREN = "&#40;"
 HTML_RPAREN = "&#41;"
 
+# Trees sent with the page and in each window the client fetches after it
+TREES_PER_PAGE = 50
+MAX_TREES_PER_REQUEST = 1000
+
+# Background validations that are done are kept this long for their
+# client to ask about (see Treedraw.validationProgress)
+VALIDATION_JOB_SECONDS = 10 * 60
+
+# Responses of these types are gzipped for clients that accept it
+COMPRESSED_MIME_TYPES = [
+    "text/html",
+    "text/plain",
+    "text/css",
+    "text/javascript",
+    "application/javascript",
+    "application/json",
+]
+# zlib wbits for the Content-Encodings accepted on request bodies
+REQUEST_ENCODINGS = {
+    "gzip": 16 + zlib.MAX_WBITS,
+    "x-gzip": 16 + zlib.MAX_WBITS,
+    "deflate": zlib.MAX_WBITS,
+}
+
+
+def decompressRequestBody():
+    """
+    Inflate a request body sent with Content-Encoding gzip or deflate,
+    before it is processed (by tools.json_in, for instance).
+    """
+    request = cherrypy.serving.request
+    encoding = request.headers.get("Content-Encoding", "").strip().lower()
+    if encoding in ("", "identity") or not request.process_request_body:
+        return
+    if encoding not in REQUEST_ENCODINGS:
+        raise cherrypy.HTTPError(415, "Unsupported Content-Encoding %s" % encoding)
+    if request.body.length is None:
+        raise cherrypy.HTTPError(411)
+    # Hold the inflated body to the limit on request bodies
+    limit = request.body.maxbytes or 0
+    decompressor = zlib.decompressobj(REQUEST_ENCODINGS[encoding])
+    with cherrypy.HTTPError.handle(zlib.error, 400, "Invalid %s body" % encoding):
+        data = decompressor.decompress(request.body.fp.read(request.body.length), limit)
+    if decompressor.unconsumed_tail:
+        raise cherrypy.HTTPError(413)
+    if not decompressor.eof:
+        raise cherrypy.HTTPError(400, "Truncated %s body" % encoding)
+    request.body.fp = io.BytesIO(data)
+    request.body.length = len(data)
+    request.headers["Content-Length"] = str(len(data))
+    del request.headers["Content-Encoding"]
+
+
+# Before tools.json_in, which has priority 30
+cherrypy.tools.decompress = cherrypy.Tool(
+    "before_request_body", decompressRequestBody, priority=20
+)
+
+
+def templateModuleDirectory(templateDir):
+    """
+    Where the templates in templateDir are kept compiled between runs, or
+    None if there is nowhere to write them.  Each installation gets its
+    own directory, since modules are looked up by the template's name.
+    """
+    cacheHome = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    directory = os.path.join(
+        cacheHome,
+        "annotald",
+        "templates-" + tree_digest(os.path.abspath(templateDir).encode("utf-8"))[:16],
+    )
+    try:
+        os.makedirs(directory, exist_ok=True)
+    except OSError:
+        return None
+    return directory
+
+
+def templateLookup():
+    """
+    The page templates, compiled once and recompiled only when a
+    template file's mtime changes
+    """
+    templateDir = pkg_resources.resource_filename("annotald", "data/html")
+    return TemplateLookup(
+        directories=[templateDir],
+        module_directory=templateModuleDirectory(templateDir),
+        filesystem_checks=True,
+        strict_undefined=True,
+    )
+
+
+def loadPythonOptions(args):
+    pythonOptions = runPythonSettings(args.pythonSettings)
+    cherrypy.engine.autoreload.files.add(args.pythonSettings)
+    return pythonOptions
+
+
+def runPythonSettings(pythonSettings):
+    """ The options set by the Python settings file pythonSettings """
+    pythonOptions = {
+        "extraJavascripts": [],
+        "debugJs": False,
+        "validators": {},
+        "colorCSS": False,
+        # TODO: this masks a bug in jana's branch
+        "colorCSSPath": "/dev/null",
+        "corpusSearchValidate": util.corpusSearchValidate,
+        "rewriteIndices": True,
+        "serverMode": True,
+    }
+    if pythonSettings is not None:
+        if (
+            sys.version_info[0] == 2
+            and sys.version_info[1] < 7
+            or sys.version_info[0] == 3
+            and sys.version_info[1] < 2
+        ):
+            print("Specifying python settings requires Python v." + ">2.7 or >3.2.")
+            sys.exit(1)
+        else:
+            pythonOptions = runpy.run_path(
+                pythonSettings, init_globals=pythonOptions
+            )
+    return pythonOptions
+
+
+def settingsValidators(pythonSettings):
+    """
+    The validators of the Python settings file, by name; the worker
+    processes (see annotald.parallel) run the file to get them
+    """
+    return runPythonSettings(pythonSettings)["validators"]
+
+
+def scriptFiles(args, pythonOptions):
+    """ The scripts of the page, in load order """
+    def script(name):
+        return pkg_resources.resource_filename("annotald", "data/scripts/" + name)
+
+    jquery = "jquery-debug.js" if pythonOptions["debugJs"] else "jquery.js"
+    return (
+        [
+            script(jquery),
+            script("jquery.mousewheel.min.js"),
+            script("treedrawing.utils.js"),
+            script("treedrawing.js"),
+            script("underscore-min.js"),
+        ]
+        + list(pythonOptions["extraJavascripts"])
+        # The context menu is set up from the settings, so it comes last
+        + [args.settings, script("treedrawing.contextMenu.js")]
+    )
+
+
+def styleFiles(pythonOptions):
+    styles = [
+        pkg_resources.resource_filename("annotald", "data/css/treedrawing.css")
+    ]
+    if pythonOptions["colorCSS"]:
+        styles.append(pythonOptions["colorCSSPath"])
+    return styles
+
+
+def pageAssets(args, pythonOptions):
+    assetBundle = AssetBundle(
+        scriptFiles(args, pythonOptions), styleFiles(pythonOptions),
+        minify=not pythonOptions["debugJs"],
+    )
+    assetBundle.refresh()
+    return assetBundle
+
+
 class Treedraw(object):
-    def __init__(self, args, shortfile):
+    def __init__(self, args, shortfile, directory=None):
+        """
+        directory is the CorpusDirectory serving the file, if it is one
+        of many; the settings, page assets and templates are its
+        """
         self.thefile = args.psd[0]
         self.shortfile = shortfile
         self.options = args
-        self.readVersionCookie(self.thefile)
+        self.directory = directory
+        self.treeCache = None
+        self.corpus = self.openCorpus(self.thefile)
+        self.versionCookie = self.corpus.version_cookie
+        if self.corpus.journal is not None and len(self.corpus.journal):
+            print("Replaying %d saved trees from %s" % (
+                len(self.corpus.journal), self.corpus.journal.journal_filename))
+            self.corpus.compact()
 
         # TODO: after a respawn these will not be right
         self.inidle = False
@@ -73,32 +275,23 @@ class Treedraw(object):
         else:
             self.conversionFn = AnnoTree.to_html
             self.useMetadata = False
+        self.renderCache = RenderCache(self.treeToHtml)
+        self.validationCache = ValidationCache()
+        # Background validations (see doValidate), by id
+        self.validationJobs = {}
+        self.validationJobIds = itertools.count(1)
+        self.validationJobsLock = threading.Lock()
         self.showingPartialFile = self.options.oneTree or self.options.numTrees > 1
-        self.pythonOptions = {
-            "extraJavascripts": [],
-            "debugJs": False,
-            "validators": {},
-            "colorCSS": False,
-            # TODO: this masks a bug in jana's branch
-            "colorCSSPath": "/dev/null",
-            "corpusSearchValidate": util.corpusSearchValidate,
-            "rewriteIndices": True,
-            "serverMode": True,
-        }
-        if args.pythonSettings is not None:
-            if (
-                sys.version_info[0] == 2
-                and sys.version_info[1] < 7
-                or sys.version_info[0] == 3
-                and sys.version_info[1] < 2
-            ):
-                print("Specifying python settings requires Python v." + ">2.7 or >3.2.")
-                sys.exit(1)
-            else:
-                self.pythonOptions = runpy.run_path(
-                    args.pythonSettings, init_globals=self.pythonOptions
-                )
-        cherrypy.engine.autoreload.files.add(args.pythonSettings)
+        self.treeIndexStart = 0
+        self.treeIndexEnd = self.options.numTrees
+        if directory is None:
+            self.pythonOptions = loadPythonOptions(args)
+            self.assetBundle = pageAssets(args, self.pythonOptions)
+            self.templates = templateLookup()
+        else:
+            self.pythonOptions = directory.pythonOptions
+            self.assetBundle = directory.assetBundle
+            self.templates = directory.templates
 
         self.doLogEvent({"type": "program-start", "filename": self.thefile})
 
@@ -109,33 +302,71 @@ class Treedraw(object):
         "tools.caching.on": False,
         "tools.encode.on": True,
         "tools.encode.encoding": "utf-8",
+        "tools.gzip.on": True,
+        "tools.gzip.mime_types": COMPRESSED_MIME_TYPES,
+        "tools.decompress.on": True,
         "tools.expires.on": True,
         "tools.expires.secs": 3600,
     }
 
+    @cherrypy.expose
+    def assets(self, name):
+        """ A bundle of the page's scripts or styles, see annotald.assets """
+        asset = self.assetBundle.get(name)
+        if asset is None:
+            raise cherrypy.NotFound()
+        request = cherrypy.serving.request
+        headers = cherrypy.serving.response.headers
+        headers["Content-Type"] = asset.content_type
+        headers["Cache-Control"] = ASSET_CACHE_CONTROL
+        headers["ETag"] = '"%s"' % asset.digest
+        headers["Vary"] = "Accept-Encoding"
+        cherrypy.lib.cptools.validate_etags()
+        accepted = [
+            encoding.value
+            for encoding in request.headers.elements("Accept-Encoding")
+            if encoding.qvalue > 0
+        ]
+        if "gzip" in accepted or "x-gzip" in accepted:
+            headers["Content-Encoding"] = "gzip"
+            return asset.gzipped
+        return asset.data
+
+    # Bundles are compressed already and never expire
+    assets._cp_config = {
+        "tools.gzip.on": False,
+        "tools.encode.on": False,
+        "tools.expires.on": False,
+    }
+
     def integrateTrees(self, trees):
-        trees = trees.strip().split("\n\n")
-        if self.showingPartialFile:
-            self.trees[self.treeIndexStart : self.treeIndexEnd] = trees
-            self.treeIndexEnd = self.treeIndexStart + len(trees)
-        else:
-            self.trees = trees
-        return "\n\n".join(self.trees)
+        if isinstance(trees, str):
+            trees = trees.strip().split("\n\n")
+        # The shown trees' positions change with the corpus
+        with self.corpus.lock:
+            if self.showingPartialFile:
+                self.corpus.replace(self.treeIndexStart, self.treeIndexEnd, trees)
+                self.treeIndexEnd = self.treeIndexStart + len(trees)
+            else:
+                self.corpus.replace(0, len(self.corpus), trees)
 
     @cherrypy.expose
     @cherrypy.tools.json_in()
     @cherrypy.tools.json_out()
     def doSave(self, data=None):
         data = data or cherrypy.request.json
-        trees = data["trees"]
-
         cherrypy.response.headers["Content-Type"] = "application/json"
+        if "changes" in data:
+            return self.saveChanges(data["changes"])
+        trees = data["trees"]
 
         trees = [AnnoTree.aug_tree_from_json(tree) for tree in trees]
-        output_str = "\n\n".join([tree.pretty() for tree in trees])
-
+        tree_strs = parallel.pretty_many(trees, self.options.workers)
         try:
-            util.writeTreesToFile(self.versionCookie, output_str, self.thefile)
+            with self.corpus.lock:
+                # When showing part of the file the page only holds those trees
+                self.integrateTrees(tree_strs)
+                self.corpus.write()
             self.doLogEvent({"type": "save"})
             return dict(result="success")
         except Exception as e:
@@ -143,47 +374,200 @@ class Treedraw(object):
             traceback.print_exc()
             return dict(result="failure", reason="server got an exception")
 
+    def saveChanges(self, changes):
+        """
+        Save only the trees that changed since the client's last save.
+
+        Each change holds a tree_id, the tree and the version (hash of the
+        tree text) it was based on.  The trees are appended to the journal
+        and put in the in-memory list of trees; if any tree is not at the
+        version the client expected nothing is saved.  Concurrent saves
+        are checked and applied one at a time, so of two saves based on
+        the same version of a tree the second one is a conflict.
+        """
+        if self.corpus.journal is None:
+            return dict(result="unsupported",
+                        reason="Cannot save changed trees alone in this mode")
+        texts = {}
+        for change in changes:
+            tree = AnnoTree.aug_tree_from_json(change["tree"])
+            texts[change["tree_id"]] = tree.pretty()
+
+        with self.corpus.lock:
+            self.corpus.refresh()
+            conflicts = []
+            for change in changes:
+                idx = self.corpus.position(change["tree_id"])
+                if idx is None or self.corpus.version(idx) != change["base_version"]:
+                    conflicts.append(change["tree_id"])
+            if conflicts:
+                return dict(result="conflict", conflicts=conflicts,
+                            reason="Trees changed on disk since they were loaded")
+            try:
+                versions = self.corpus.save_trees(texts)
+            except Exception as e:
+                print("something went wrong: %s" % e)
+                traceback.print_exc()
+                return dict(result="failure", reason="server got an exception")
+        self.doLogEvent({"type": "save", "trees": len(texts)})
+        return dict(result="success", versions=versions)
+
     @cherrypy.expose
     @cherrypy.tools.json_out()
-    def doValidate(self, trees=None, validator=None, shift=None):
+    def doValidate(self, trees=None, validator=None, shift=None, background=None):
+        """
+        Run a validator on the showing trees, or with shift on all of
+        them.  Only trees that changed since they were last validated are
+        given to the validator (see annotald.validationcache), on the
+        worker processes when there are many (see parallel.validate_many).
+        The response holds the HTML of only the trees it changed: a list
+        of their positions, old versions, versions and HTML.  A validator
+        that gives back more or fewer trees than it is given replaces the
+        trees, and the response holds the HTML of all the showing ones.
+
+        With background the validation runs on a thread of its own, and
+        the response holds the id of a job to ask validationProgress
+        about.  Jobs that are done are forgotten once they are asked about,
+        or after VALIDATION_JOB_SECONDS if they are not.
+        """
         cherrypy.response.headers["Content-Type"] = "application/json"
-        tovalidate = self.integrateTrees(trees)
-        self.doLogEvent({"type": "validate", "validator": validator})
-
-        # When showing part of the file, a regular click of the validation
-        # button validates only the showing trees, whereas shift-click does
-        # them all.  This implements that logic.
-        if self.showingPartialFile and not shift:
-            tovalidate = "\n\n".join(
-                self.trees[self.treeIndexStart : self.treeIndexEnd]
-            )
+        validatorFn = self.pythonOptions["validators"][validator]
+        with self.corpus.lock:
+            if trees is not None:
+                self.integrateTrees(trees)
+            self.doLogEvent({"type": "validate", "validator": validator})
+
+            # When showing part of the file, a regular click of the validation
+            # button validates only the showing trees, whereas shift-click does
+            # them all.  This implements that logic.
+            if self.showingPartialFile and shift not in (True, "true"):
+                (start, end) = (self.treeIndexStart, self.treeIndexEnd)
+            else:
+                (start, end) = (0, len(self.corpus))
+            corpus = self.corpus.snapshot()
+
+        job = dict(done=0, total=end - start, response=None, finished=None)
+        if background not in (True, "true"):
+            return self.validate(validatorFn, corpus, start, end, job, validator)
+        jobId = str(next(self.validationJobIds))
+        with self.validationJobsLock:
+            self.expireValidationJobs()
+            self.validationJobs[jobId] = job
+
+        def run():
+            try:
+                self.validate(validatorFn, corpus, start, end, job, validator)
+            finally:
+                job["finished"] = time.time()
+
+        threading.Thread(target=run, daemon=True).start()
+        return dict(result="started", job=jobId, total=job["total"])
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def validationProgress(self, job=None):
+        """
+        How far the background validation job has come, or once it is
+        done what doValidate would have given
+        """
+        cherrypy.response.headers["Content-Type"] = "application/json"
+        with self.validationJobsLock:
+            self.expireValidationJobs()
+            found = self.validationJobs.get(job)
+            if found is None:
+                return dict(result="failure", reason="No such validation")
+            if found["finished"] is None:
+                return dict(result="running", done=found["done"], total=found["total"])
+            del self.validationJobs[job]
+        return found["response"] or dict(result="failure", reason="Validation failed")
+
+    def expireValidationJobs(self):
+        """ Forget jobs done longer ago than VALIDATION_JOB_SECONDS """
+        limit = time.time() - VALIDATION_JOB_SECONDS
+        for jobId in [jobId for (jobId, job) in self.validationJobs.items()
+                      if job["finished"] is not None and job["finished"] < limit]:
+            del self.validationJobs[jobId]
+
+    def validate(self, validatorFn, corpus, start, end, job, name=None):
+        """
+        Validate the trees in positions start:end of corpus, a snapshot,
+        with validatorFn, the validator called name in the settings, and
+        put the results in the corpus.  The corpus is not locked while
+        the validator runs; trees saved meanwhile are kept as saved.
+        """
+        texts = corpus.texts(start, end)
+        oldVersions = corpus.versions(start, end)
+
+        def run(validatorFn, version, toValidate):
+            # Trees found in the cache are done already
+            cached = len(texts) - len(toValidate)
+
+            def progress(done):
+                job["done"] = cached + done
+
+            return parallel.validate_many(validatorFn, version, toValidate,
+                                          self.options.workers, progress, name)
 
         try:
-            validatedTrees = self.pythonOptions["validators"][validator](
-                self.versionCookie, tovalidate
-            ).split("\n\n")
+            validatedTrees = self.validationCache.validate(
+                validatorFn, self.versionCookie, texts, oldVersions, run
+            )
+            restructured = isinstance(validatedTrees, Restructured)
+            if restructured:
+                validatedTrees = validatedTrees.trees
         except Exception as e:
             print("something went wrong with validation: %s, %s" % (type(e), e))
             traceback.print_exc()
-            return dict(result="failure", reason=str(e))
-
-        # What to do with the resultant trees depends on whether they are all
-        # the trees in the file, and on whether we want to show all the trees
-        # in the file.s
-        if self.showingPartialFile:
-            if shift == "true":
-                self.trees = validatedTrees
-                validatedHtml = self.treesToHtml(
-                    self.trees[self.treeIndexStart : self.treeIndexEnd]
+            job["response"] = dict(result="failure", reason=str(e))
+            return job["response"]
+
+        changed = []
+        with self.corpus.lock:
+            currentVersions = self.corpus.versions(start, end)
+            if len(currentVersions) != len(oldVersions) or (
+                restructured and currentVersions != oldVersions
+            ):
+                job["response"] = dict(
+                    result="failure",
+                    reason="The trees were changed while they were validated",
                 )
+                return job["response"]
+            if restructured:
+                self.corpus.replace(start, end, validatedTrees)
+                if (start, end) == (self.treeIndexStart, self.treeIndexEnd):
+                    self.treeIndexEnd = start + len(validatedTrees)
             else:
-                self.integrateTrees(validatedTrees)
-                validatedHtml = self.treesToHtml(validatedTrees)
-        else:
-            self.trees = validatedTrees
-            validatedHtml = self.treesToHtml(validatedTrees)
+                currentTexts = self.corpus.texts(start, end)
+                for (i, (old, new)) in enumerate(zip(texts, validatedTrees)):
+                    if currentVersions[i] != oldVersions[i]:
+                        # Saved while it was validated
+                        validatedTrees[i] = currentTexts[i]
+                    elif old != new:
+                        changed.append(start + i)
+                self.corpus.replace(start, end, validatedTrees)
+            corpus = self.corpus.snapshot()
+            (showStart, showEnd) = (self.treeIndexStart, self.treeIndexEnd)
 
-        return dict(result="success", html=validatedHtml)
+        if restructured:
+            if self.showingPartialFile:
+                html = self.treesToHtml(corpus, showStart, showEnd)
+            else:
+                html = self.treesToHtml(corpus)
+            job["response"] = dict(result="success", html=html)
+            return job["response"]
+        version = util.queryVersionCookie(corpus.version_cookie, "FORMAT")
+        job["response"] = dict(result="success", trees=[
+            dict(
+                position=idx,
+                oldVersion=oldVersions[idx - start],
+                version=corpus.version(idx),
+                html=self.renderCache.get(
+                    corpus.text(idx), version, corpus.version(idx)
+                ),
+            )
+            for idx in changed
+        ])
+        return job["response"]
 
     @cherrypy.expose
     @cherrypy.tools.json_in()
@@ -207,16 +591,15 @@ class Treedraw(object):
         if self.pythonOptions["rewriteIndices"]:
             print("...and rewriting indices sequentially")
         print("Please be patient, this may take some time")
-        util.writeTreesToFile(
-            self.versionCookie,
-            "\n\n".join(self.trees),
-            self.thefile,
-            True,
-            self.pythonOptions["rewriteIndices"],
-        )
+        self.corpus.write()
         print("Done. :)")
 
         self.doLogEvent({"type": "program-exit"})
+        if self.directory is not None:
+            # The server goes on serving the other files; this file is
+            # dropped once this request is done with it
+            self.directory.exit(self)
+            return
         time.sleep(3)  # Wait for log events from server
         if self.eventLog:
             self.eventLog.close()
@@ -227,79 +610,71 @@ class Treedraw(object):
 
     @cherrypy.expose
     def test(self):
-        currentSettings = open(self.options.settings, encoding="utf-8").read()
-        currentTree = self.readTrees(
-            None,
-            text="""
+        currentTree = self.treesToHtml(Corpus.from_text(
+            """
             ( (IP-MAT (NP-SBJ (D This)) (BEP is) (NP-PRD (D a) (N test)))
             (ID test-01))
-            """,
-        )
-        currentTree = self.treesToHtml(currentTree)
+            """
+        ))
 
-        return self.renderIndex(currentTree, currentSettings, True)
+        return self.renderIndex(currentTree, True)
 
     @cherrypy.expose
     @cherrypy.tools.json_out()
     def testLoadTrees(self, trees=None):
         cherrypy.response.headers["Content-Type"] = "application/json"
-        return dict(trees=self.treesToHtml(self.readTrees(None, text=trees)))
+        return dict(trees=self.treesToHtml(Corpus.from_text(trees or "")))
 
-    def readVersionCookie(self, filename):
-        f = codecs.open(filename, "r", "utf-8")
-        currentText = f.read()  # must read the whole thing to avoid reading
-        # half a comment...optimize here, or hope the
-        # disk cache gets used.
-        if self.options.outFile:
-            currentText = util.scrubText(currentText)
+    def close(self):
+        """ Write the journaled trees to the file, before the corpus is dropped """
+        self.corpus.compact()
 
-        trees = currentText.strip().split("\n\n")
-        vc = trees[0]
-        self.versionCookie = ""
-        if vc[0:10] == "( (VERSION":
-            self.versionCookie = vc
+    def isBusy(self):
+        """
+        Whether dropping the corpus would lose work: it has changes that
+        are not saved, or background validations are running on it
+        """
+        with self.validationJobsLock:
+            running = any(job["finished"] is None
+                          for job in self.validationJobs.values())
+        return running or self.corpus.is_dirty()
 
-    def readTrees(self, fname, text=None):
-        if text:
-            currentText = text
-        else:
-            with open(fname, "r", encoding="utf-8") as fh:
-                currentText = fh.read()
-                if self.options.outFile:
-                    currentText = util.scrubText(currentText)
-
-        trees = currentText.strip().split("\n\n")
-        vc = trees[0]
-        self.versionCookie = ""
-        if vc[0:10] == "( (VERSION":
-            self.versionCookie = vc
-            trees = trees[1:]
-
-        return trees
-
-    def treesToHtml(self, trees):
-        version = util.queryVersionCookie(self.versionCookie, "FORMAT")
-        alltrees = '<div class="snode" id="sn0">'
-        for tree in trees:
+    def memoryEstimate(self):
+        """ A rough estimate of the memory the file's corpus takes, in bytes """
+        return self.corpus.memory_estimate() + self.renderCache.memory_estimate()
+
+    def openCorpus(self, filename):
+        if self.options.outFile:
+            # CorpusSearch output is not indexed, only read
+            return Corpus.read(filename)
+        self.treeCache = TreeCache.for_file(filename)
+        return Corpus.open(filename, cache=self.treeCache,
+                           workers=self.options.workers)
+
+    def treesToHtml(self, corpus, start=0, end=None):
+        """ The HTML of the trees of corpus in positions start:end """
+        version = util.queryVersionCookie(corpus.version_cookie, "FORMAT")
+        alltrees = ['<div class="snode" id="sn0">']
+        for (idx, tree) in zip(range(start, len(corpus)), corpus.texts(start, end)):
             tree = tree.strip()
-            tree = tree.replace("<", "&lt;")
-            tree = tree.replace(">", "&gt;")
-            tree = tree.replace(r"\(", HTML_LPAREN)
-            tree = tree.replace(r"\)", HTML_RPAREN)
             if not tree == "":
-                nltk_tree = AnnoTree.fromstring(tree)
-                alltrees = alltrees + self.conversionFn(nltk_tree, version)
-
-        alltrees = alltrees + "</div>"
-        return alltrees
-
-    def renderIndex(self, currentTree, currentSettings, test, annotrees=None):
-        indexTemplate = Template(
-            filename=pkg_resources.resource_filename(
-                "annotald", "/data/html/index.mako"
-            ),
-            strict_undefined=True,
-        )
+                # Trees that were shown before are not parsed or rendered again
+                alltrees.append(
+                    self.renderCache.get(tree, version, corpus.version(idx))
+                )
+
+        alltrees.append("</div>")
+        return "".join(alltrees)
+
+    def treeToHtml(self, tree, version):
+        tree = tree.replace("<", "&lt;")
+        tree = tree.replace(">", "&gt;")
+        tree = tree.replace(r"\(", HTML_LPAREN)
+        tree = tree.replace(r"\)", HTML_RPAREN)
+        return self.conversionFn(AnnoTree.fromstring(tree), version)
+
+    def renderIndex(self, currentTree, test, annotrees=None, page=None):
+        indexTemplate = self.templates.get_template("index.mako")
 
         validators = {}
 
@@ -312,29 +687,75 @@ class Treedraw(object):
         validatorNames = list(validators.keys())
 
         if self.options.oneTree:
-            ti = "1 out of " + str(len(self.trees))
+            ti = "1 out of " + str(len(self.corpus))
         else:
             ti = ""
-        annotrees = [tree.to_json() for tree in annotrees]
+        annotrees = annotrees or []
+        # Picks up edits to settings.js and the other scripts
+        self.assetBundle.refresh()
+        if page is None:
+            page = dict(start=0, total=len(annotrees))
         return indexTemplate.render(
             annotaldVersion=VERSION,
-            currentSettings=currentSettings,
+            scriptBundle=self.assetBundle.script_name,
+            styleBundle=self.assetBundle.style_name,
             shortfile=self.shortfile,
             currentTree=currentTree,
             usetimelog=self.options.timelog,
             usemetadata=self.useMetadata,
             test=test,
             partialFile=self.showingPartialFile,
-            extraScripts=self.pythonOptions["extraJavascripts"],  # noqa
-            colorCSS=self.pythonOptions["colorCSS"],
-            colorPath=self.pythonOptions["colorCSSPath"],  # noqa
             startTime=self.startTime,
-            debugJs=self.pythonOptions["debugJs"],
             useValidator=useValidator,
             validators=validatorNames,
             treeIndexStatement=ti,
             idle="<div style='color:#64C465'>Editing.</div>",  # noqa
             annotrees=json.dumps(annotrees),
+            annotreePage=json.dumps(page),
+        )
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def loadTrees(self, start=None, end=None, tree_id=None):
+        """
+        A window of trees as JSON: those in positions start:end (at most
+        TREES_PER_PAGE from start if end is not given) or the page of
+        TREES_PER_PAGE trees that holds tree_id.
+
+        Responses carry an ETag made of the window, the number of trees,
+        the corpus's generation and the trees' versions, so clients
+        revalidate windows they already have instead of fetching them.
+        """
+        cherrypy.lib.caching.expires(0, force=True)
+        if self.options.outFile:
+            return dict(result="failure", reason="Not available in this mode")
+        corpus = self.corpus.snapshot()
+        total = len(corpus)
+        if tree_id is not None:
+            idx = corpus.position(tree_id)
+            if idx is None:
+                return dict(result="failure", reason="No tree %s" % tree_id)
+            start = idx - idx % TREES_PER_PAGE
+            end = start + TREES_PER_PAGE
+        else:
+            start = max(0, int(start or 0))
+            end = start + TREES_PER_PAGE if end is None else int(end)
+            end = min(end, start + MAX_TREES_PER_REQUEST)
+        end = min(end, total)
+
+        versions = corpus.versions(start, end)
+        etag = tree_digest(" ".join(
+            [str(corpus.generation), str(total), str(start), str(end)] + versions
+        ).encode("ascii"))
+        cherrypy.response.headers["ETag"] = '"%s"' % etag
+        cherrypy.lib.cptools.validate_etags()
+
+        return dict(
+            result="success",
+            start=start,
+            end=end,
+            total=total,
+            trees=corpus.json(start, end),
         )
 
     @cherrypy.expose
@@ -357,17 +778,31 @@ class Treedraw(object):
     @cherrypy.expose(alias=getpass.getuser())
     def inner_index(self):
         cherrypy.lib.caching.expires(0, force=True)
-        currentSettings = open(self.options.settings, encoding="utf-8").read()
-        currentTrees = self.readTrees(self.thefile)
-        self.trees = currentTrees
+        # Reloading the page drops the changes that were not saved
+        with self.corpus.lock:
+            self.corpus.refresh()
+            corpus = self.corpus.snapshot()
+            (start, end) = (self.treeIndexStart, self.treeIndexEnd)
+        currentHtml = self.treesToHtml(corpus, 0, 0)
 
-        # currentHtml = self.treesToHtml(currentTrees)
-        currentHtml = self.treesToHtml("")
-
-        annotrees = AnnoTree.read_from_file(self.thefile)
+        page = None
+        if self.options.outFile:
+            annotrees = corpus.json()
+        elif self.showingPartialFile:
+            annotrees = corpus.json(start, end)
+        else:
+            # Only the first page; the client mounts the trees near its
+            # viewport and fetches them from loadTrees as they are needed
+            end = min(TREES_PER_PAGE, len(corpus))
+            annotrees = corpus.json(0, end)
+            page = dict(
+                start=0,
+                total=len(corpus),
+                virtual=True,
+            )
 
         self.doLogEvent({"type": "page-load", "loc": "inner_index"})
-        return self.renderIndex(currentHtml, currentSettings, False, annotrees=annotrees)
+        return self.renderIndex(currentHtml, False, annotrees=annotrees, page=page)
 
     @cherrypy.expose
     @cherrypy.tools.json_out()
@@ -376,37 +811,77 @@ class Treedraw(object):
         offset = int(offset)
         if not self.showingPartialFile:
             return dict(result="failure", reason="Not in partial-file mode.")
-        else:
-            oldindex = (self.treeIndexStart, self.treeIndexEnd)
+        with self.corpus.lock:
             self.integrateTrees(trees)
-            while True:
-                self.treeIndexStart = (
-                    self.treeIndexStart + offset * self.options.numTrees
-                )  # noqa
-                self.treeIndexEnd = self.treeIndexStart + self.options.numTrees
-                if self.treeIndexEnd >= len(self.trees):
-                    self.treeIndexEnd = len(self.trees)
-                if self.treeIndexStart >= len(self.trees):
-                    self.treeIndexStart, self.treeIndexEnd = oldindex
-                    return dict(result="failure", reason="At end of file.")
-                elif self.treeIndexStart < 0:
-                    self.treeIndexStart, self.treeIndexEnd = oldindex
-                    return dict(result="failure", reason="At beginning of file.")
-                if not find:
-                    # my kingdom for a do...while loop
-                    break
-                if find in "".join(self.trees[self.treeIndexStart : self.treeIndexEnd]):
+            start = self.treeIndexStart + offset * self.options.numTrees
+            if find:
+                # Stepping on until the window holds a tree containing find
+                found = self.findWindow(find, offset)
+                if found is not None:
+                    start = found
+                elif offset < 0:
+                    start = -1
+                else:
+                    start = len(self.corpus)
+            if start >= len(self.corpus):
+                return dict(result="failure", reason="At end of file.")
+            elif start < 0:
+                return dict(result="failure", reason="At beginning of file.")
+            self.treeIndexStart = start
+            self.treeIndexEnd = min(start + self.options.numTrees, len(self.corpus))
+            corpus = self.corpus.snapshot()
+            (start, end) = (self.treeIndexStart, self.treeIndexEnd)
+
+        return dict(
+            result="success",
+            tree=self.treesToHtml(corpus, start, end),
+            treeIndexStart=start,
+            treeIndexEnd=end,
+            totalTrees=len(corpus),
+        )
+
+    def findWindow(self, find, offset):
+        """
+        The start of the first window of trees, stepping offset windows
+        at a time from the one shown, that holds a tree containing find;
+        None if there is none
+        """
+        size = self.options.numTrees
+        step = offset * size
+        start = self.treeIndexStart
+        if step > 0:
+            for idx in self.corpus.search(find, start + step):
+                windows = (idx - start) // step
+                if idx < start + windows * step + size:
+                    return start + windows * step
+        elif step < 0:
+            for idx in reversed(self.corpus.search(find, 0, start + step + size)):
+                windows = -((idx - start) // -step)
+                if start - windows * -step < 0:
                     break
+                if idx < start + windows * step + size:
+                    return start + windows * step
+        return None
 
-            return dict(
-                result="success",
-                tree=self.treesToHtml(
-                    self.trees[self.treeIndexStart : self.treeIndexEnd]
-                ),
-                treeIndexStart=self.treeIndexStart,
-                treeIndexEnd=self.treeIndexEnd,
-                totalTrees=len(self.trees),
-            )
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def findTrees(self, find, start=0):
+        """
+        How many trees contain find, and the position and ID of the first
+        one at or after start (wrapping around to the start of the file)
+        """
+        cherrypy.response.headers["Content-Type"] = "application/json"
+        corpus = self.corpus.snapshot()
+        start = int(start)
+        idx = corpus.find(find, start)
+        if idx is None:
+            idx = corpus.find(find, 0, start)
+        return dict(
+            result="success",
+            count=corpus.count(find),
+            position=idx,
+            tree_id=None if idx is None else corpus.records[idx].tree_id,
+        )
 
     @cherrypy.expose
     @cherrypy.tools.json_in()
@@ -429,6 +904,198 @@ class Treedraw(object):
         )
 
 
+class CorpusDirectory(object):
+    """
+    Serves every .psd file under a directory from one process, each at
+    /<path of the file>/ the way a single file is served at /.
+
+    A file's corpus is loaded when the file is first asked for.  Corpora
+    idle for longer than options.idle minutes are dropped, as are the
+    least recently used ones whenever the loaded corpora take more than
+    options.memory megabytes (by Treedraw.memoryEstimate); a dropped file
+    is loaded again when it is next asked for.
+
+    A corpus is never dropped while requests are using it (they are
+    counted from dispatch to the end of the request), while it is busy
+    (see Treedraw.isBusy) or while it is being loaded.  Its journaled
+    trees are written to the file before it is dropped, and the file is
+    not loaded again until they are.
+    """
+
+    def __init__(self, args):
+        self.directory = os.path.abspath(args.psd[0])
+        self.options = args
+        self.pythonOptions = loadPythonOptions(args)
+        self.assetBundle = pageAssets(args, self.pythonOptions)
+        self.templates = templateLookup()
+        # Loaded files by name, least recently used first
+        self.servers = OrderedDict()
+        self.lastUsed = {}
+        # Requests using each loaded file, by name
+        self.users = {}
+        # Files to unload once no request uses them (see exit)
+        self.exiting = set()
+        self.lock = threading.Lock()
+        # Held while a file is loaded, so that it is loaded only once
+        self.loadLocks = {}
+
+    _cp_config = {
+        "tools.encode.on": True,
+        "tools.encode.encoding": "utf-8",
+        "tools.gzip.on": True,
+        "tools.gzip.mime_types": COMPRESSED_MIME_TYPES,
+    }
+
+    def fileNames(self):
+        """ The .psd files under the directory, as paths relative to it """
+        names = []
+        for (dirpath, dirnames, filenames) in os.walk(self.directory):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if filename.endswith(".psd"):
+                    path = os.path.relpath(os.path.join(dirpath, filename),
+                                           self.directory)
+                    names.append(path.replace(os.sep, "/"))
+        return names
+
+    @cherrypy.expose
+    def index(self):
+        cherrypy.lib.caching.expires(0, force=True)
+        items = "".join(
+            '<li><a href="%s/">%s</a>%s</li>' % (
+                urllib.parse.quote(name), html.escape(name),
+                " (loaded)" if name in self.servers else ""
+            )
+            for name in self.fileNames()
+        )
+        return """
+        <html><head><title>Annotald</title></head><body>
+        <h1>%s</h1><ul>%s</ul></body></html>""" % (
+            html.escape(self.directory),
+            items,
+        )
+
+    def _cp_dispatch(self, vpath):
+        # The file is the longest run of leading segments naming one
+        for length in range(len(vpath), 0, -1):
+            segments = vpath[:length]
+            if any(segment in ("", ".", "..") for segment in segments):
+                continue
+            name = "/".join(segments)
+            if name.endswith(".psd") and os.path.isfile(
+                os.path.join(self.directory, *segments)
+            ):
+                del vpath[:length]
+                server = self.server(name)
+                cherrypy.serving.request.hooks.attach(
+                    "on_end_request", functools.partial(self.release, name),
+                    failsafe=True,
+                )
+                return server
+        return None
+
+    def server(self, name):
+        """
+        The Treedraw of a file, loading the file if it is not loaded.  The
+        caller counts as using it until it calls release(name).
+        """
+        with self.lock:
+            server = self.use(name)
+            if server is not None:
+                return server
+            loadLock = self.loadLocks.setdefault(name, threading.Lock())
+        with loadLock:
+            with self.lock:
+                server = self.use(name)
+            if server is None:
+                args = copy.copy(self.options)
+                args.psd = [os.path.join(self.directory, *name.split("/"))]
+                server = Treedraw(args, os.path.basename(name), directory=self)
+                with self.lock:
+                    self.servers[name] = server
+                    self.use(name)
+        self.evict()
+        return server
+
+    def use(self, name):
+        """ Count a user of the loaded file name, if it is loaded; call with the lock """
+        server = self.servers.get(name)
+        if server is not None:
+            self.servers.move_to_end(name)
+            self.lastUsed[name] = time.time()
+            self.users[name] = self.users.get(name, 0) + 1
+        return server
+
+    def release(self, name):
+        with self.lock:
+            self.users[name] -= 1
+            if self.users[name]:
+                return
+            del self.users[name]
+            if name not in self.exiting:
+                return
+            server = self.servers.get(name)
+        if server is not None:
+            self.unload(name, server)
+
+    def exit(self, server):
+        """
+        Unload the file whose Treedraw is server once the requests using
+        it, such as the one asking to exit, are done
+        """
+        with self.lock:
+            for (name, loaded) in self.servers.items():
+                if loaded is server:
+                    self.exiting.add(name)
+
+    def unload(self, name, server):
+        """
+        Write the journaled trees of the file name, whose Treedraw is
+        server, and drop its corpus, unless it is in use or busy; whether
+        it was dropped
+        """
+        with self.lock:
+            if (self.servers.get(name) is not server or name in self.users
+                    or server.isBusy()):
+                return False
+            # Loading the file again waits until it is written
+            loadLock = self.loadLocks[name]
+            if not loadLock.acquire(blocking=False):
+                return False
+            del self.servers[name]
+            del self.lastUsed[name]
+            self.exiting.discard(name)
+        try:
+            print("Unloading %s" % name)
+            server.close()
+        finally:
+            loadLock.release()
+        return True
+
+    def evict(self, idleSince=None):
+        """
+        Drop the corpora last used before idleSince, and the least
+        recently used ones while the loaded corpora are over budget; the
+        corpus used last, and those that cannot be dropped (see unload),
+        are kept
+        """
+        budget = self.options.memory * 2 ** 20
+        with self.lock:
+            servers = list(self.servers.items())
+            lastUsed = dict(self.lastUsed)
+        estimates = [server.memoryEstimate() for (name, server) in servers]
+        total = sum(estimates)
+        for ((name, server), estimate) in zip(servers[:-1], estimates):
+            idle = idleSince is not None and lastUsed[name] < idleSince
+            if total <= budget and not idle:
+                continue
+            if self.unload(name, server):
+                total -= estimate
+
+    def evictIdle(self):
+        self.evict(idleSince=time.time() - self.options.idle * 60)
+
+
 def main():
     import sys
     argv = sys.argv[1:]
@@ -490,6 +1157,39 @@ def main():
         action="store",
         help="number of trees to show at a time",
     )
+    parser.add_argument(
+        "-j",
+        "--workers",
+        dest="workers",
+        type=int,
+        action="store",
+        help="number of processes for loading and formatting large files \
+              (default: one per CPU)",
+    )
+    parser.add_argument(
+        "-t",
+        "--threads",
+        dest="threads",
+        type=int,
+        action="store",
+        help="number of threads serving requests (default: 10)",
+    )
+    parser.add_argument(
+        "--memory",
+        dest="memory",
+        type=int,
+        action="store",
+        help="when serving a directory, megabytes of corpora to keep loaded \
+              (default: 1024)",
+    )
+    parser.add_argument(
+        "--idle",
+        dest="idle",
+        type=int,
+        action="store",
+        help="when serving a directory, minutes after which an unused file \
+              is unloaded (default: 30)",
+    )
     parser.add_argument(
         "-v",
         "--version",
@@ -497,7 +1197,9 @@ def main():
         version="This is Annotald v." + annotald.__version__,
     )
 
-    parser.add_argument("psd", nargs=1)
+    parser.add_argument(
+        "psd", nargs=1, help="the file to annotate, or a directory of .psd files"
+    )
 
     parser.set_defaults(
         port=8080,
@@ -505,16 +1207,35 @@ def main():
         pythonSettings=None,
         oneTree=False,
         numTrees=1,
+        workers=None,
+        threads=10,
+        memory=1024,
+        idle=30,
     )
     args = parser.parse_args(argv)
 
     # TODO: can we calculate this in __init__?
     shortfile = re.search("^.*?([0-9A-Za-z\-\.]*)$", args.psd[0]).group(1)
 
-    cherrypy.config.update({"server.socket_port": args.port})
+    # Started before any thread that serves requests; see annotald.parallel
+    parallel.start_pool(
+        args.workers, functools.partial(settingsValidators, args.pythonSettings)
+    )
+
+    cherrypy.config.update({
+        "server.socket_port": args.port,
+        "server.thread_pool": args.threads,
+    })
 
-    treedraw = Treedraw(args, shortfile)
-    cherrypy.quickstart(treedraw)
+    if os.path.isdir(args.psd[0]):
+        # Every file under the directory, from this one process
+        root = CorpusDirectory(args)
+        cherrypy.process.plugins.Monitor(
+            cherrypy.engine, root.evictIdle, frequency=60
+        ).subscribe()
+    else:
+        root = Treedraw(args, shortfile)
+    cherrypy.quickstart(root)
 
 
 if __name__ == "__main__":
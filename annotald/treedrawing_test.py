@@ -0,0 +1,49 @@
+import argparse, os, shutil, tempfile, unittest
+
+import pkg_resources
+
+from annotald.treedrawing import CorpusDirectory
+
+TREE = "( (META (ID-LOCAL {0}.psd,.1) (COMMENT )) (S0 (grm a)))\n"
+
+
+class CorpusDirectoryTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        for name in ["a", "b"]:
+            with open(os.path.join(self.dir, name + ".psd"), "w", encoding="utf-8") as fh:
+                fh.write(TREE.format(name))
+        args = argparse.Namespace(
+            psd=[self.dir], pythonSettings=None, outFile=False, timelog=False,
+            settings=pkg_resources.resource_filename("annotald", "settings.js"),
+            oneTree=False, numTrees=1, workers=1, memory=1024, idle=30,
+        )
+        self.directory = CorpusDirectory(args)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_exit_unloads_after_the_request(self):
+        server = self.directory.server("a.psd")
+        self.directory.server("b.psd")
+        server.corpus.save_trees({"a.psd,.1": TREE.format("a").replace("(grm a)", "(grm z)")})
+        server.doExit()
+        # The exit request still uses the file
+        self.assertIn("a.psd", self.directory.servers)
+        self.directory.release("a.psd")
+        self.assertNotIn("a.psd", self.directory.servers)
+        self.assertIn("b.psd", self.directory.servers)
+        with open(os.path.join(self.dir, "a.psd"), encoding="utf-8") as fh:
+            self.assertIn("(grm z)", fh.read())
+        # Asked for again, the file is loaded from what was written
+        server = self.directory.server("a.psd")
+        self.assertIn("(grm z)", server.corpus.text(0))
+
+    def test_files_in_use_are_kept(self):
+        self.directory.options.memory = 0
+        self.directory.server("a.psd")
+        self.directory.server("b.psd")
+        self.assertEqual(sorted(self.directory.servers), ["a.psd", "b.psd"])
+        self.directory.release("a.psd")
+        self.directory.evict()
+        self.assertEqual(list(self.directory.servers), ["b.psd"])
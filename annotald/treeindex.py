@@ -0,0 +1,329 @@
+# This Python file uses the following encoding: utf-8
+
+"""
+A persistent byte-offset index of the trees in a corpus file.
+
+The index is stored next to the corpus in a sidecar file (``foo.psd.idx``)
+and records, for every tree, its byte offset and length in the file, its
+ID-LOCAL and a hash of its bytes.  It lets the server find and parse single
+trees without reading and parsing the whole file.
+
+The sidecar is tied to the size and mtime (in nanoseconds, so that edits
+close together are told apart) of the corpus file.  When either
+changes the index is brought up to date incrementally: entries whose bytes
+are unchanged are kept and only the remainder of the file is scanned.
+"""
+
+from collections import namedtuple
+import hashlib
+import json
+import os
+import re
+
+from annotald.annotree import AnnoTree, escaped_parens_to_html_parens
+
+
+INDEX_SUFFIX = ".idx"
+INDEX_FORMAT = 2
+
+TreeEntry = namedtuple("TreeEntry", "offset, length, tree_id, digest")
+
+# Trees start with an open paren at the beginning of a line after a blank
+# line.  Candidate boundaries are confirmed by counting parens, so blank
+# lines inside a tree do not split it.
+_BOUNDARY_RE = re.compile(rb"\n[ \t\r]*\n(?=[ \t\r\n]*\()")
+_ID_LOCAL_RE = re.compile(
+    rb"\(ID-LOCAL((?:\s+(?:\\[()]|[^\s()])+)*)\s*\)"
+)
+_VERSION_PREFIX = b"( (VERSION"
+
+
+def tree_digest(data):
+    return hashlib.md5(data).hexdigest()
+
+
+def _balance(data):
+    escaped_open = data.count(b"\\(")
+    escaped_close = data.count(b"\\)")
+    return (data.count(b"(") - escaped_open) - (data.count(b")") - escaped_close)
+
+
+_PAREN_RE = re.compile(rb"\\[()]|[()]")
+_NOT_PARENS = bytes(byte for byte in range(256) if byte not in b"()")
+
+
+def _is_one_tree(data):
+    """
+    Whether the balanced bytes data, from an open paren to a close paren,
+    are one tree: the depth does not return to 0 before the end.  The
+    parens inside the outer pair are reduced by removing adjacent pairs,
+    which leaves nothing only if the depth never falls below 1 there.
+    """
+    parens = data.replace(b"\\(", b"").replace(b"\\)", b"").translate(None, _NOT_PARENS)
+    inner = parens[1:-1]
+    while inner:
+        reduced = inner.replace(b"()", b"")
+        if len(reduced) == len(inner):
+            return False
+        inner = reduced
+    return True
+
+
+def _exact_spans(data, start, end):
+    """ Paren-by-paren scan of data[start:end], like tree_spans_from_text """
+    balance = 0
+    tree_start = start
+    for match in _PAREN_RE.finditer(data, start, end):
+        par = match.group()
+        if par == b"(":
+            if balance == 0:
+                tree_start = match.start()
+            balance += 1
+        elif par == b")":
+            balance -= 1
+            if balance == 0:
+                yield (tree_start, match.end() - tree_start)
+
+
+def scan_tree_spans(data, start=0):
+    """
+    Yield (offset, length) of every tree in the bytes data from start on.
+
+    Works on the raw UTF-8 bytes (or an mmap of them).  Blank-line separated chunks are checked
+    for balance, and for holding one tree, with C-level bytes methods;
+    only a chunk that holds more than one tree (two on a line, say, or
+    one starting on a line of its own inside it) is scanned paren by
+    paren.
+    """
+    end = len(data)
+    chunk_start = start
+    balance = 0
+    pos = start
+    while pos < end:
+        match = _BOUNDARY_RE.search(data, pos)
+        chunk_end = match.start() if match else end
+        balance += _balance(data[pos:chunk_end])
+        if balance < 0:
+            raise ValueError("Illegal parentheses")
+        pos = match.end() if match else end
+        if balance != 0:
+            continue
+        tree_start = data.find(b"(", chunk_start, chunk_end)
+        if tree_start != -1:
+            tree_end = data.rfind(b")", tree_start, chunk_end) + 1
+            if (data.find(b"\n(", tree_start, chunk_end) == -1
+                    and _is_one_tree(data[tree_start:tree_end])):
+                yield (tree_start, tree_end - tree_start)
+            else:
+                yield from _exact_spans(data, tree_start, chunk_end)
+        chunk_start = pos
+    if balance != 0:
+        raise ValueError("Unbalanced parentheses at end of input")
+
+
+def tree_id_from_bytes(data):
+    """ Return the ID-LOCAL of a tree, in the form get_metadata returns it """
+    match = _ID_LOCAL_RE.search(data)
+    if not match:
+        return ""
+    leaves = match.group(1).decode("utf-8").split()
+    return escaped_parens_to_html_parens(" ".join(leaves))
+
+
+def _entry(data, offset, length):
+    tree_bytes = data[offset : offset + length]
+    return TreeEntry(offset, length, tree_id_from_bytes(tree_bytes),
+                     tree_digest(tree_bytes))
+
+
+class TreeIndex(object):
+    """
+    The trees of a corpus file, addressed by position or ID-LOCAL.
+
+    A version cookie at the top of the file is not counted as a tree; its
+    span is kept in version_cookie.
+    """
+
+    def __init__(self, filename, entries=(), version_cookie=None,
+                 size=None, mtime=None):
+        self.filename = str(filename)
+        self.entries = list(entries)
+        self.version_cookie = version_cookie
+        self.size = size
+        self.mtime = mtime
+        self._positions = None
+
+    @property
+    def index_filename(self):
+        return self.filename + INDEX_SUFFIX
+
+    @classmethod
+    def for_file(cls, filename, data=None):
+        """
+        Load the sidecar index of filename, updating it if it is stale.
+
+        data may be the contents of the file (bytes or an mmap), in which
+        case the file is not read again.
+        """
+        index = cls.load(filename)
+        if index is None:
+            index = cls(filename)
+        if not index.is_current():
+            index.update(data)
+            index.save()
+        return index
+
+    @classmethod
+    def load(cls, filename):
+        try:
+            with open(str(filename) + INDEX_SUFFIX, "r", encoding="utf-8") as fh:
+                obj = json.load(fh)
+        except (OSError, ValueError):
+            return None
+        if obj.get("format") != INDEX_FORMAT:
+            return None
+        return cls(
+            filename,
+            entries=[TreeEntry(*entry) for entry in obj["entries"]],
+            version_cookie=obj["version_cookie"] and TreeEntry(*obj["version_cookie"]),
+            size=obj["size"],
+            mtime=obj["mtime"],
+        )
+
+    def save(self):
+        obj = {
+            "format": INDEX_FORMAT,
+            "size": self.size,
+            "mtime": self.mtime,
+            "version_cookie": self.version_cookie,
+            "entries": self.entries,
+        }
+        tmp_name = self.index_filename + ".tmp"
+        try:
+            # dumps uses the C encoder, dump would stream in Python
+            text = json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+            with open(tmp_name, "w", encoding="utf-8") as fh:
+                fh.write(text)
+            os.replace(tmp_name, self.index_filename)
+        except OSError:
+            # A read-only corpus directory only costs us the persistence
+            print("Could not write tree index %s" % self.index_filename)
+
+    def is_current(self):
+        try:
+            stat = os.stat(self.filename)
+        except OSError:
+            return False
+        return self.size == stat.st_size and self.mtime == stat.st_mtime_ns
+
+    def update(self, data=None):
+        """
+        Bring the index up to date with the file on disk.
+
+        Entries are kept as long as the bytes at their offsets still hash
+        the same; the file is only scanned from the first changed tree on.
+        """
+        stat = os.stat(self.filename)
+        if data is None:
+            with open(self.filename, "rb") as fh:
+                data = fh.read()
+
+        def unchanged(entry):
+            chunk = data[entry.offset : entry.offset + entry.length]
+            return len(chunk) == entry.length and tree_digest(chunk) == entry.digest
+
+        if self.version_cookie is not None and not unchanged(self.version_cookie):
+            self.version_cookie = None
+            self.entries = []
+        kept = 0
+        for entry in self.entries:
+            if not unchanged(entry):
+                break
+            kept += 1
+        del self.entries[kept:]
+
+        if self.entries:
+            last = self.entries[-1]
+        else:
+            last = self.version_cookie
+        scan_from = last.offset + last.length if last else 0
+        for (offset, length) in scan_tree_spans(data, scan_from):
+            entry = _entry(data, offset, length)
+            if scan_from == 0 and not self.entries and \
+                    data[offset : offset + len(_VERSION_PREFIX)] == _VERSION_PREFIX:
+                self.version_cookie = entry
+            else:
+                self.entries.append(entry)
+
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime_ns
+        self._positions = None
+
+    def splice(self, replacements):
+        """
+        Update the index after the trees at some positions were replaced.
+
+        replacements maps positions to the new bytes of those trees.  The
+        entries after a replaced tree are shifted instead of rescanned.
+        """
+        if not replacements:
+            return
+        shift = 0
+        for idx in range(min(replacements), len(self.entries)):
+            entry = self.entries[idx]
+            data = replacements.get(idx)
+            if data is not None:
+                self.entries[idx] = TreeEntry(entry.offset + shift, len(data),
+                                              tree_id_from_bytes(data),
+                                              tree_digest(data))
+                shift += len(data) - entry.length
+            elif shift:
+                self.entries[idx] = TreeEntry(entry.offset + shift, entry.length,
+                                              entry.tree_id, entry.digest)
+        stat = os.stat(self.filename)
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime_ns
+        self._positions = None
+
+    def corpus_digest(self):
+        """ A hash of the contents of all trees in the file """
+        digest = hashlib.md5()
+        for entry in self.entries:
+            digest.update(entry.digest.encode("ascii"))
+        return digest.hexdigest()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, idx):
+        return self.entries[idx]
+
+    def position(self, tree_id):
+        """ The position of the tree with ID-LOCAL tree_id, or None """
+        if self._positions is None:
+            self._positions = {
+                entry.tree_id: idx for (idx, entry) in enumerate(self.entries)
+            }
+        return self._positions.get(tree_id)
+
+    def read_bytes(self, start, end=None):
+        """ The raw bytes of the trees in positions start:end """
+        entries = self.entries[start : start + 1 if end is None else end]
+        if not entries:
+            return []
+        with open(self.filename, "rb") as fh:
+            ret = []
+            for entry in entries:
+                fh.seek(entry.offset)
+                ret.append(fh.read(entry.length))
+            return ret
+
+    def read_texts(self, start, end=None):
+        return [data.decode("utf-8") for data in self.read_bytes(start, end)]
+
+    def read_trees(self, start, end=None):
+        """ Parse only the trees in positions start:end """
+        return [
+            AnnoTree.fromstring_many(text)[0]
+            for text in self.read_texts(start, end)
+        ]
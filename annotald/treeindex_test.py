@@ -0,0 +1,79 @@
+import os, shutil, tempfile, unittest
+
+from annotald import annotree
+from annotald.treeindex import TreeIndex, scan_tree_spans
+
+TEXT = """( (VERSION (FORMAT dash)))
+
+( (META (ID-CORPUS c.1) (ID-LOCAL t.psd,.1) (URL u) (COMMENT ))
+  (S0 (NP (no_et_nf_kk maður (lemma maður)))))
+
+( (META (ID-CORPUS c.2) (ID-LOCAL t.psd,.2) (URL u) (COMMENT ))
+  (S0 (NP (entity \\(AB\\) (lemma \\(AB\\))))
+
+      (grm .)))
+(S0 (X y))
+"""
+
+
+class TreeIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "t.psd")
+        with open(self.path, "w", encoding="utf-8") as fh:
+            fh.write(TEXT)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def assertScanMatchesTreeSpans(self, text):
+        spans = [(len(text[:s].encode("utf-8")), len(text[s:e].encode("utf-8")))
+                 for (s, e) in annotree.tree_spans_from_text(text)]
+        self.assertEqual(list(scan_tree_spans(text.encode("utf-8"))), spans)
+
+    def test_scan_matches_tree_spans_from_text(self):
+        self.assertScanMatchesTreeSpans(TEXT)
+
+    def test_scan_trees_sharing_a_chunk(self):
+        # Two trees on one line
+        self.assertScanMatchesTreeSpans(
+            "( (S0 (X a) (Y \\(b\\)))) ( (S0 (X c)))\n\n( (S0 (X d)))\n")
+        # A second tree on an indented line
+        self.assertScanMatchesTreeSpans(
+            "( (S0 (X a)\n      (Y b)))\n  ( (S0 (X c)))\n\n( (S0 (X d)))\n")
+        self.assertEqual(len(list(scan_tree_spans(b"(a) ((b))"))), 2)
+
+    def test_index(self):
+        index = TreeIndex.for_file(self.path)
+        self.assertTrue(os.path.exists(self.path + ".idx"))
+        self.assertEqual(len(index), 3)
+        self.assertIsNotNone(index.version_cookie)
+        self.assertEqual(index.position("t.psd,.2"), 1)
+        self.assertEqual(index.read_texts(2), ["(S0 (X y))"])
+        tree = index.read_trees(1)[0]
+        self.assertEqual(tree.get_metadata()["tree_id"], "t.psd,.2")
+
+    def test_edit_within_float_precision_is_seen(self):
+        stamp = 1700000000 * 10 ** 9
+        os.utime(self.path, ns=(stamp, stamp))
+        TreeIndex.for_file(self.path)
+        with open(self.path, "w", encoding="utf-8") as fh:
+            fh.write(TEXT.replace("(X y)", "(X z)"))
+        # The same as before as a float of seconds
+        os.utime(self.path, ns=(stamp, stamp + 1))
+        self.assertEqual(os.stat(self.path).st_mtime, stamp / 10 ** 9)
+        self.assertFalse(TreeIndex.load(self.path).is_current())
+        self.assertEqual(TreeIndex.for_file(self.path).read_texts(2), ["(S0 (X z))"])
+
+    def test_incremental_update(self):
+        index = TreeIndex.for_file(self.path)
+        old_entries = list(index.entries)
+        with open(self.path, "a", encoding="utf-8") as fh:
+            fh.write("\n( (META (ID-LOCAL t.psd,.4)) (S0 (X z)))\n")
+        os.utime(self.path, (0, 0))
+        self.assertFalse(TreeIndex.load(self.path).is_current())
+        index = TreeIndex.for_file(self.path)
+        self.assertEqual(len(index), 4)
+        self.assertEqual(index.entries[:3], old_entries)
+        self.assertEqual(index.position("t.psd,.4"), 3)
+        self.assertTrue(TreeIndex.load(self.path).is_current())
@@ -26,17 +26,13 @@
 # TODO: add a file-saving test that really exercises the unicode fns
 
 # Standard library
-import codecs
 from collections import defaultdict
 from functools import reduce
 import hashlib
 import json
 import os
-import pkg_resources
 import re
-import subprocess
 import sys
-import tempfile
 
 # External libraries
 # from annotald.annotree import AnnoTree
@@ -199,9 +195,39 @@ def deepTreeToHtml(tree, *args):
 
 
 def writeTreesToFile(meta, trees_str, filename, reformat=False, fix_indices=False):
-    with open(filename, "w", encoding="utf-8") as f:
-        print(trees_str)
+    # Write a new file and move it into place rather than truncating the
+    # old one, which may still be memory-mapped by a CorpusFile
+    tmp_name = filename + ".tmp"
+    with open(tmp_name, "w", encoding="utf-8") as f:
         f.write(trees_str)
+        f.flush()
+        os.fsync(f.fileno())
+    replaceFile(tmp_name, filename)
+
+
+def replaceFile(tmp_name, filename):
+    """
+    Atomically move the (already fsynced) file tmp_name over filename.
+
+    The directory is synced as well, so that the rename itself survives a
+    crash; either the old or the new file is found afterwards.
+    """
+    os.replace(tmp_name, filename)
+    fsyncDirectory(os.path.dirname(os.path.abspath(filename)))
+
+
+def fsyncDirectory(dirname):
+    try:
+        fd = os.open(dirname, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        # Not all platforms and filesystems allow syncing a directory
+        pass
+    finally:
+        os.close(fd)
 
 
 def is_leaf(tree):
@@ -225,39 +251,36 @@ def _formatTree(tree, indent=0):
         return "%s%s%s" % (s, leaves, ")")
 
 
-def corpusSearchValidate(queryFile):  # pragma: no cover
-    # TODO: how to test?
-    # TODO: test the unicode part
-    def corpusSearchValidateInner(version, trees):
-        # Should use writetreestofile for unicode thing
-        tf = tempfile.NamedTemporaryFile(delete=False)
-        name = tf.name
-        writer = codecs.getwriter("utf-8")
-        write_handle = writer(tf)
-        write_handle.write(trees)
-        tf.close()
-        # TODO: this will break when merging anton's branch
-        cmdline = (
-            "java -classpath "
-            + pkg_resources.resource_filename("annotald", "CS_Tony_oct19.jar")
-            + " csearch.CorpusSearch "
-            + queryFile
-            + " "
-            + name
-            + " -out "
-            + name
-            + ".out"
-        )
-        subprocess.check_call(cmdline.split(" "))
+def corpusSearchValidate(queryFile):
+    """
+    A validator running the CorpusSearch query file queryFile.  Queries
+    are run in process by annotald.query; files using features it lacks
+    are run by CorpusSearch itself, in a JVM.
+    """
+    from annotald import query
 
-        with open(name + ".out", encoding="utf-8") as f:
-            newtrees = f.read()
-        newtrees = scrubText(newtrees)
-        os.unlink(name)
-        os.unlink(name + ".out")
+    try:
+        query.Query.read(queryFile)
+    except query.QueryError as e:
+        print("Running %s with CorpusSearch: %s" % (queryFile, e))
+        return javaCorpusSearchValidate(queryFile)
+    return query.validator(queryFile)
 
-        return newtrees
 
+def javaCorpusSearchValidate(queryFile):
+    """
+    A validator running the query file queryFile with CorpusSearch, on
+    the pool of CorpusSearch processes of annotald.corpussearch
+    """
+    from annotald import corpussearch
+
+    def corpusSearchValidateInner(version, trees):
+        return scrubText(corpussearch.pool().run(queryFile, trees))
+
+    corpusSearchValidateInner.state = lambda: os.stat(queryFile).st_mtime_ns
+    # Each worker process would start CorpusSearch processes of its own;
+    # the pool runs the searches one per CorpusSearch process already
+    corpusSearchValidateInner.parallel = False
     return corpusSearchValidateInner
 
 
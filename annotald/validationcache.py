@@ -0,0 +1,119 @@
+# This Python file uses the following encoding: utf-8
+
+"""
+An LRU cache of what validators make of trees.
+
+A validator (see settings.py) is given the version cookie and trees, and
+gives back the trees, flagged or otherwise changed.  It handles each
+tree on its own, so what it makes of a tree depends only on the tree's
+text.  Entries are keyed by the validator, the version cookie and the
+md5 of the tree's text (the hash the tree index records).  Validating
+trees sends only those that are not cached to the validator, in one
+call.
+
+A validator whose results are left as they are when it validates them
+again (one that only adds flags a node does not have yet, say) may say
+so with an idempotent attribute set to True.  The trees it gives back
+then count as validated too, so validating them again, unless they are
+edited, gives them back without calling it.
+
+A validator whose results may change while it runs, such as one that
+reads a query file that can be edited, has a state attribute: a function
+whose result changes when its results do.
+"""
+
+from collections import OrderedDict, namedtuple
+import threading
+
+from annotald.treeindex import tree_digest
+
+
+class Restructured(namedtuple("Restructured", "trees")):
+    """
+    What a validator made of trees when it gave back more or fewer trees
+    than it was given: all the trees it gave back, in order
+    """
+
+    __slots__ = ()
+
+
+def split_trees(text):
+    return [tree.strip() for tree in text.split("\n\n") if tree.strip()]
+
+
+def _run(validator, version, texts):
+    return split_trees(validator(version, "\n\n".join(texts)))
+
+
+class ValidationCache(object):
+    def __init__(self, maxsize=65536):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def validate(self, validator, version, texts, digests, run=None):
+        """
+        What validator makes of each of texts, whose md5s are digests, or
+        a Restructured if it does not give back one tree for each tree it
+        is given.  run(validator, version, texts), if given, runs the
+        validator on the trees that are not cached and returns the trees
+        it gives back.
+
+        The validator handles each tree on its own, so when the trees that
+        were not cached are consecutive, the trees it gave back for them
+        go in their place.  Otherwise which tree gave which is not known,
+        and all of texts are validated again.
+        """
+        state = getattr(validator, "state", None)
+        idempotent = getattr(validator, "idempotent", False)
+        key = (validator, state() if state is not None else None, version)
+        results = []
+        missing = []
+        with self._lock:
+            for (idx, digest) in enumerate(digests):
+                result = self._entries.get(key + (digest,))
+                if result is None:
+                    missing.append(idx)
+                else:
+                    self._entries.move_to_end(key + (digest,))
+                results.append(result)
+            self.hits += len(digests) - len(missing)
+            self.misses += len(missing)
+        if not missing:
+            return results
+        # Validated without the lock; validators may take seconds
+        if run is None:
+            run = _run
+        validated = run(validator, version, [texts[idx] for idx in missing])
+        if len(validated) != len(missing):
+            (first, last) = (missing[0], missing[-1])
+            if last - first + 1 != len(missing):
+                return Restructured(run(validator, version, texts))
+            return Restructured(results[:first] + validated + results[last + 1:])
+        with self._lock:
+            for (idx, result) in zip(missing, validated):
+                results[idx] = result
+                self._entries[key + (digests[idx],)] = result
+                if idempotent:
+                    self._entries[key + (tree_digest(result.encode("utf-8")),)] = result
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return results
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,78 @@
+import unittest
+
+from annotald.treeindex import tree_digest
+from annotald.validationcache import Restructured, ValidationCache
+
+
+class ValidationCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+
+        def flag(version, trees):
+            self.calls.append(trees)
+            return "\n\n".join(tree.replace("(NP", "(NP-FLAG")
+                               for tree in trees.split("\n\n")) + "\n"
+
+        self.flag = flag
+        self.cache = ValidationCache()
+
+    def test_only_new_trees_are_validated(self):
+        texts = ["(A (NP a))", "(B b)", "(C (NP c))"]
+        digests = ["a", "b", "c"]
+        self.assertEqual(self.cache.validate(self.flag, "", texts, digests),
+                         ["(A (NP-FLAG a))", "(B b)", "(C (NP-FLAG c))"])
+        texts[1] = "(B (NP b))"
+        digests[1] = "b2"
+        self.assertEqual(self.cache.validate(self.flag, "", texts, digests),
+                         ["(A (NP-FLAG a))", "(B (NP-FLAG b))", "(C (NP-FLAG c))"])
+        self.assertEqual(self.calls, ["(A (NP a))\n\n(B b)\n\n(C (NP c))",
+                                      "(B (NP b))"])
+        self.cache.validate(self.flag, "", texts, digests)
+        self.assertEqual(len(self.calls), 2)
+        self.assertEqual(self.cache.stats()["hits"], 5)
+        # Results are kept per validator and version cookie
+        self.cache.validate(self.flag, "( (VERSION (FORMAT dash)))", texts, digests)
+        self.assertEqual(len(self.calls), 3)
+
+    def validate_result(self):
+        (result,) = self.cache.validate(self.flag, "", ["(A (NP a))"], ["a"])
+        return self.cache.validate(self.flag, "", [result],
+                                   [tree_digest(result.encode("utf-8"))])
+
+    def test_results_are_validated_again(self):
+        # This validator flags its own flags again
+        self.assertEqual(self.validate_result(), ["(A (NP-FLAG-FLAG a))"])
+        self.assertEqual(len(self.calls), 2)
+
+    def test_idempotent_results_count_as_validated(self):
+        self.flag.idempotent = True
+        self.assertEqual(self.validate_result(), ["(A (NP-FLAG a))"])
+        self.assertEqual(len(self.calls), 1)
+
+    def test_state(self):
+        self.flag.state = lambda: len(self.calls) // 2
+        self.cache.validate(self.flag, "", ["(A a)"], ["a"])
+        self.cache.validate(self.flag, "", ["(A a)"], ["a"])
+        self.assertEqual(len(self.calls), 1)
+        self.calls.append(None)
+        self.cache.validate(self.flag, "", ["(A a)"], ["a"])
+        self.assertEqual(len(self.calls), 3)
+
+    def test_restructuring_validator(self):
+        def drop(version, trees):
+            self.calls.append(trees)
+            return "\n\n".join(tree for tree in trees.split("\n\n") if "X" not in tree)
+
+        texts = ["(A a)", "(B b)", "(C c)"]
+        self.assertEqual(self.cache.validate(drop, "", texts, ["a", "b", "c"]), texts)
+        # The trees not cached are consecutive; they are validated once
+        self.assertEqual(
+            self.cache.validate(drop, "", ["(A X)", "(B X)", "(C c)"], ["a2", "b2", "c"]),
+            Restructured(["(C c)"]))
+        self.assertEqual(len(self.calls), 2)
+        # They are not; all the trees are validated again
+        self.assertEqual(
+            self.cache.validate(drop, "", ["(A X)", "(B b)", "(C X)"], ["a2", "b", "c2"]),
+            Restructured(["(B b)"]))
+        self.assertEqual(self.calls[2:], ["(A X)\n\n(C X)", "(A X)\n\n(B b)\n\n(C X)"])
+        self.assertEqual(len(self.cache), 3)
@@ -0,0 +1,656 @@
+# This Python file uses the following encoding: utf-8
+
+"""
+Micro-benchmarks for the corpus handling code paths.
+
+Run from a checkout, with annotald installed (pip install -e .), as
+
+    python bench/bench.py reader [path/to/file.psd]
+
+If no file is given a synthetic corpus in the Greynir/IcePaHC style used by
+annoparse is generated.  Each benchmark prints wall clock times of the old
+and new implementations together with the throughput of the new one.
+"""
+
+import argparse
+import io
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from xml.etree import ElementTree as ET
+
+import nltk.tree
+
+from annotald import annotree
+from annotald.annotree import AnnoTree
+
+
+_TERMINALS = [
+    ("no_et_nf_kk", "maður", "maður"),
+    ("so_1_þf_et_fh_gm_nt_p3", "sér", "sjá"),
+    ("lo_et_kvk_nf_sb_fst", "falleg", "fallegur"),
+    ("fs_þf", "um", "um"),
+    ("pfn_et_nf_p1", "ég", "ég"),
+    ("grm", ",", None),
+    ("entity", "\\(AB\\)", "\\(AB\\)"),
+]
+
+
+def _make_tree(idx, width):
+    leaves = []
+    for num in range(width):
+        (terminal, text, lemma) = _TERMINALS[(idx + num) % len(_TERMINALS)]
+        if lemma is None:
+            leaves.append(AnnoTree(terminal, [text]))
+        else:
+            leaves.append(
+                AnnoTree(terminal, [text, AnnoTree("lemma", [lemma])])
+            )
+    subj = AnnoTree("NP-SUBJ", leaves[: width // 2])
+    pred = AnnoTree("VP", [AnnoTree("NP-OBJ", leaves[width // 2:])])
+    meta = AnnoTree(
+        "META",
+        [
+            AnnoTree("ID-CORPUS", ["bench.{0}".format(idx)]),
+            AnnoTree("ID-LOCAL", ["bench.psd,.{0}".format(idx + 1)]),
+            AnnoTree("URL", ["greynir.is"]),
+            AnnoTree("COMMENT", [""]),
+        ],
+    )
+    return AnnoTree("", [meta, AnnoTree("S0", [AnnoTree("S-MAIN", [subj, pred])])])
+
+
+def make_corpus(num_trees, width=12):
+    """ Return the text of a synthetic corpus with num_trees trees """
+    return "\n\n".join(_make_tree(idx, width).pretty() for idx in range(num_trees))
+
+
+def _timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return (time.perf_counter() - start, result)
+
+
+def _report(name, old_secs, new_secs, num_bytes):
+    print(
+        "{0:<12} old {1:8.3f}s  new {2:8.3f}s  speedup {3:5.2f}x  {4:7.2f} MB/s".format(
+            name,
+            old_secs,
+            new_secs,
+            old_secs / new_secs if new_secs else float("inf"),
+            num_bytes / new_secs / 2 ** 20 if new_secs else float("inf"),
+        )
+    )
+
+
+class _NltkAnnoTree(nltk.tree.Tree):
+    """ The tree representation AnnoTree had when it subclassed nltk """
+
+
+def _old_fromstring_many(text):
+    return [
+        _NltkAnnoTree.fromstring(
+            annotree.escaped_parens_to_html_parens(text[start:end])
+        )
+        for (start, end) in annotree.tree_spans_from_text(text)
+    ]
+
+
+def _recursive_pretty(tree, padding=0):
+    """ AnnoTree.pretty as it was before it was made iterative """
+    left = "({0} ".format(tree.label())
+    def_child_padding = len(left) + padding
+    extra_child_padding = def_child_padding
+    parts = [left]
+    children = tree.expanded()
+    num = len(children)
+
+    first_is_str = None
+    if 0 < num:
+        first_is_str = isinstance(children[0], str)
+    if first_is_str:
+        extra_child_padding = def_child_padding + len(children[0]) + 1
+
+    for (idx, child) in enumerate(children):
+        if idx == 1 and first_is_str:
+            parts.append(" ")
+        elif 0 < idx:
+            parts.append(" " * extra_child_padding)
+
+        if isinstance(child, AnnoTree):
+            if tree.label() != "COMMENT":
+                parts.append(_recursive_pretty(child, padding=def_child_padding))
+            else:
+                parts.extend(["(", child._print_comment_line(), ")"])
+        else:
+            parts.append(child)
+
+        if idx == 0 and first_is_str and 1 < num:
+            pass
+        elif idx < (num - 1):
+            parts.append("\n")
+
+    parts.append(")")
+    return "".join(parts)
+
+
+def _old_split_flat_terminal(term_tok):
+    """ annotree.split_flat_terminal as it was before TerminalCodec """
+    parts = term_tok.split("_")
+    if len(parts) <= 1:
+        pass
+
+    cat = parts[0]
+
+    # Extract valence
+    variants_start = 1
+    data = dict(cat=cat)
+    if cat == "so":
+        first_variant = parts[1]
+        num_control = 0
+        if first_variant in "012":
+            num_control = int(first_variant)
+            variants_start += 1
+            # so_0_þt_vh_p1           færi
+            # so_1_þf_þt_vh_p1        tæki mat
+            # so_2_þgf_þf_þt_vh_p1    gæfi honum mat
+            for idx in range(num_control):
+                var = parts[2 + idx]
+                if var in annotree.VARIANT.CASE:
+                    variants_start += 1
+                    data["obj" + str(idx + 1)] = var
+
+        if "subj" in parts:
+            # so_1_þgf_op_subj_nf_þt_fh_p1_mm | mér gafst ekki tækifæri
+            parts.pop(parts.index("subj"))
+            data["impersonal"] = "subj"
+            subj = [var for var in parts[variants_start:] if var in annotree.VARIANT.CASE]
+            if subj:
+                subj = subj.pop()
+                data["subj"] = subj
+                parts.pop(parts.index(subj))
+            if "op" in parts:
+                parts.pop(parts.index("op"))
+        elif "op" in parts and "es" in parts:
+            # so_0_op_es_nt_fh_p3 | það rignir
+            data["impersonal"] = "es"
+            parts.pop(parts.index("op"))
+            parts.pop(parts.index("es"))
+            pass
+        elif "op" in parts:
+            data["impersonal"] = "none"
+            parts.pop(parts.index("op"))
+            pass
+
+        if "lh" in parts and "þt" in parts:
+            parts.pop(parts.index("lh"))
+            parts.pop(parts.index("þt"))
+            parts.append("lhþt")
+            pass
+        elif "lh" in parts and "nt" in parts:
+            parts.pop(parts.index("lh"))
+            parts.pop(parts.index("nt"))
+            parts.append("lhnt")
+
+    variants = set(parts[variants_start:])
+
+    try:
+        from icecream import ic
+        ic.configureOutput(includeContext=True)
+    except ImportError:  # Graceful fallback if IceCream isn't installed.
+        ic = lambda *a: None if not a else (a[0] if len(a) == 1 else a)  # noqa
+
+    variant_names = (
+        "article",
+        "case",
+        "gender",
+        "number",
+        "person",
+        "tense",
+        "degree",
+        "strength",
+        "voice",
+        "mood",
+        "clitic",
+        "lo_obj",
+        "fs_obj"
+    )
+    data_rest = dict()
+    for variant_name in variant_names:
+        if cat in annotree.CATEGORY_TO_VARIANT and variant_name in annotree.CATEGORY_TO_VARIANT[cat]:
+            all_subvariants = getattr(annotree.VARIANT, variant_name.upper())
+            data_rest[variant_name] = all_subvariants & variants
+
+    for (k, v) in list(data_rest.items()):
+        data_rest[k] = v.pop() if v else None
+
+    data.update(data_rest)
+    for k in list(data.keys()):
+        if not data[k]:
+            del data[k]
+
+    return data
+
+
+class _EtreeHtml(AnnoTree):
+    """ AnnoTree.to_html as it was when it built ElementTree elements """
+
+    __slots__ = ()
+
+    @classmethod
+    def to_html(cls, tree, version, extra_data=None):
+        top_level_nodes = {child.label(): child for child in tree}
+
+        meta_node = top_level_nodes.pop("META", None)
+
+        real_root = next(iter(top_level_nodes.values()))
+        snode = cls.to_html_inner(real_root)
+
+        if meta_node:
+            meta_children = {child.label(): child for child in meta_node}
+            id_node = ET.Element(
+                "span", attrib={"class": " ".join(["wnode", "tree-id-node"])}
+            )
+            id_str = cls.leaf_text(meta_children["ID-LOCAL"])
+            id_node.text = id_str
+            snode.insert(0, id_node)
+
+            snode.attrib["data-tree_id"] = id_str
+            snode.attrib["data-corpus_id"] = cls.leaf_text(meta_children["ID-CORPUS"])
+            snode.attrib["data-comment"] = cls.leaf_text(meta_children["COMMENT"]) or ""
+            snode.attrib["data-url"] = cls.leaf_text(meta_children["URL"])
+
+        result = ET.tostring(snode, encoding="utf8", method="html").decode("utf8")
+
+        return result
+
+    @classmethod
+    def to_html_inner(cls, tree):
+        if cls.is_terminal(tree):
+            return cls.terminal_to_html(tree)
+
+        nonterminal = tree.label()
+
+        parts = nonterminal.split("-")
+        nonterminal_class = "nonterminal-{0}".format(parts[0]).lower()
+
+        attrib = {
+            "class": " ".join(["snode", nonterminal_class]),
+            "data-nonterminal": nonterminal,
+        }
+
+        snode = ET.Element("div", attrib=attrib)
+        snode.text = nonterminal
+        snode.extend(list(cls.to_html_inner(x) for x in tree))
+
+        return snode
+
+    @classmethod
+    def terminal_to_html(cls, tree):
+        flat_terminal = tree.label()
+        token_text = cls.leaf_text(tree)
+        lemma = None
+        seg = None
+        exp_attrib = None
+        terminal_extra = tree.terminal_extras()
+
+        if "lemma" in terminal_extra:
+            lemma = terminal_extra["lemma"]
+        if "exp_abbrev" in terminal_extra:
+            seg = {
+                "type": "exp_abbrev",
+                "text": terminal_extra["exp_abbrev"],
+            }
+            exp_attrib = {"data-abbrev": seg["text"]}
+        elif "exp_seg" in terminal_extra:
+            seg = {"type": "exp_seg", "text": terminal_extra["exp_seg"]}
+            exp_attrib = {"data-seg": seg["text"]}
+
+        info = annotree.terminal_codec.decode(flat_terminal)
+
+        lemma = annotree.html_parens_to_parens(lemma) if lemma else lemma
+        token_text = annotree.html_parens_to_parens(token_text)
+
+        attrib = dict(info.html_attrib)
+        attrib.update(
+            {
+                "class": info.css_class,
+                "data-text": token_text,
+                "data-lemma": lemma if lemma else "",
+                "data-seg": "",
+                "data-abbrev": "",
+                "data-terminal": flat_terminal,
+            }
+        )
+        if exp_attrib is not None:
+            attrib.update(exp_attrib)
+
+        snode = ET.Element("div", attrib=attrib)
+        snode.text = flat_terminal
+
+        wnode = ET.SubElement(snode, "span", attrib={"class": "wnode"})
+        wnode.text = token_text
+
+        if lemma:
+            lemma_node = ET.SubElement(
+                snode, "span", attrib={"class": "wnode lemma-node"}
+            )
+            lemma_node.text = lemma
+
+        if seg:
+            seg_class = (
+                "exp-seg-node" if seg["type"] == "exp_seg" else "exp-abbrev-node"
+            )
+            seg_node = ET.SubElement(
+                snode, "span", attrib={"class": " ".join(["wnode", seg_class])}
+            )
+            seg_node.text = seg["text"]
+
+        return snode
+
+
+def _read(path):
+    with open(path, "r", encoding="utf-8") as handle:
+        return handle.read()
+
+
+def _peak_memory(fn, *args):
+    """ Peak Python heap allocation (in bytes) while running fn """
+    tracemalloc.start()
+    try:
+        fn(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_reader(path):
+    text = _read(path)
+    num_bytes = len(text.encode("utf-8"))
+    (old_secs, old_trees) = _timed(_old_fromstring_many, text)
+    (new_secs, new_trees) = _timed(AnnoTree.fromstring_many, text)
+    if new_trees != old_trees:
+        raise AssertionError("Streaming reader output differs from nltk reader")
+    (stream_secs, _) = _timed(AnnoTree.read_from_file, io.StringIO(text))
+    _report("reader", old_secs, new_secs, num_bytes)
+    _report("reader-io", old_secs, stream_secs, num_bytes)
+
+
+def _old_read_path(path):
+    # What the server used to hold: the version cookie read, the list of
+    # tree strings and the parsed trees of the page
+    with open(path, "r", encoding="utf-8") as handle:
+        cookie_text = handle.read()
+    with open(path, "r", encoding="utf-8") as handle:
+        trees = handle.read().strip().split("\n\n")
+    annotrees = AnnoTree.read_from_file(path)
+    return (cookie_text, trees, annotrees[:10])
+
+
+def _mapped_read_path(path):
+    from annotald.corpus import Corpus
+    from annotald.corpusfile import CorpusFile
+
+    with CorpusFile(path) as corpus_file:
+        corpus = Corpus(path, corpus_file)
+        return (corpus.version_cookie, len(corpus), corpus.trees(0, 10))
+
+
+def bench_mmap(path):
+    index_path = path + ".idx"
+    if os.path.exists(index_path):
+        os.unlink(index_path)
+    old_peak = _peak_memory(_old_read_path, path)
+    new_peak = _peak_memory(_mapped_read_path, path)
+    (old_secs, _) = _timed(_old_read_path, path)
+    (new_secs, _) = _timed(_mapped_read_path, path)
+    print(
+        "mmap         file {0:7.2f} MB  peak heap old {1:7.2f} MB  new {2:7.2f} MB".format(
+            os.path.getsize(path) / 2 ** 20, old_peak / 2 ** 20, new_peak / 2 ** 20
+        )
+    )
+    _report("mmap-open", old_secs, new_secs, os.path.getsize(path))
+
+
+def bench_nodes(path):
+    text = _read(path)
+    num_trees = len(AnnoTree.fromstring_many(text))
+    old_peak = _peak_memory(_old_fromstring_many, text)
+    new_peak = _peak_memory(AnnoTree.fromstring_many, text)
+    (old_secs, _) = _timed(_old_fromstring_many, text)
+    (new_secs, _) = _timed(AnnoTree.fromstring_many, text)
+    print(
+        "nodes        {0} trees  bytes/tree old {1:9.0f}  new {2:9.0f}".format(
+            num_trees, old_peak / num_trees, new_peak / num_trees
+        )
+    )
+    _report("nodes-parse", old_secs, new_secs, len(text.encode("utf-8")))
+
+
+def bench_cache(path):
+    from annotald.corpusfile import CorpusFile
+    from annotald.treecache import TreeCache
+
+    for suffix in (".idx", ".cache"):
+        if os.path.exists(path + suffix):
+            os.unlink(path + suffix)
+
+    def load(cache):
+        with CorpusFile(path, cache=cache) as corpus:
+            return corpus.trees()
+
+    (cold_secs, _) = _timed(load, TreeCache.for_file(path))
+    (warm_secs, _) = _timed(lambda: load(TreeCache.for_file(path)))
+    _report("cache", cold_secs, warm_secs, os.path.getsize(path))
+
+
+def bench_corpus(path):
+    from annotald.corpus import Corpus
+    from annotald.corpusfile import CorpusFile
+
+    # Scrolling back and forth over the first windows of the file, as the
+    # server used to answer it (parsing each window again) and from the
+    # memoized JSON of the corpus records
+    windows = [(start, start + 50) for start in range(0, 500, 50)] * 4
+    with CorpusFile(path) as corpus_file:
+        (old_secs, old_json) = _timed(lambda: [
+            [tree.to_json() for tree in corpus_file.trees(start, end)]
+            for (start, end) in windows
+        ])
+        corpus = Corpus(path, corpus_file)
+        (new_secs, new_json) = _timed(lambda: [
+            corpus.json(start, end) for (start, end) in windows
+        ])
+        num_bytes = sum(len(corpus.text(idx)) for idx in range(min(500, len(corpus))))
+    new_json = [
+        [{key: value for (key, value) in aug_tree.items() if key != "version"}
+         for aug_tree in window]
+        for window in new_json
+    ]
+    if new_json != old_json:
+        raise AssertionError("Corpus JSON differs from the parsed trees'")
+    _report("corpus", old_secs, new_secs, num_bytes * 4)
+
+
+def bench_search(path):
+    from annotald.corpus import Corpus
+
+    # Stepping through the matches of a search one window of trees at a
+    # time, as advanceTree did by joining the window's texts, and from the
+    # corpus's search index (built on the first search)
+    corpus = Corpus.open(path)
+    texts = corpus.texts()
+    needle = corpus.records[-1].tree_id
+    starts = range(0, len(texts), max(1, len(texts) // 20))
+
+    def old_find(start):
+        for idx in range(start, len(texts)):
+            if needle in "".join(texts[idx : idx + 1]):
+                return idx
+        return None
+
+    (old_secs, old_found) = _timed(lambda: [old_find(start) for start in starts])
+    (build_secs, _) = _timed(corpus.find, needle)
+    (new_secs, new_found) = _timed(lambda: [corpus.find(needle, start)
+                                            for start in starts])
+    if new_found != old_found:
+        raise AssertionError("Indexed search finds other trees than scanning")
+    print("search index built in {0:.3f}s".format(build_secs))
+    _report("search", old_secs, new_secs, sum(len(text) for text in texts))
+
+
+def bench_pretty(path):
+    text = _read(path)
+    trees = AnnoTree.fromstring_many(text)
+    (old_secs, old_strs) = _timed(lambda: [_recursive_pretty(tree) for tree in trees])
+    (new_secs, new_strs) = _timed(lambda: [tree.pretty() for tree in trees])
+    if new_strs != old_strs:
+        raise AssertionError("Pretty-printer output differs from the recursive one")
+    _report("pretty", old_secs, new_secs, len(text.encode("utf-8")))
+
+
+def bench_terminals(path):
+    trees = AnnoTree.fromstring_many(_read(path))
+    tags = [
+        node.label()
+        for tree in trees
+        for node in tree.subtrees()
+        if AnnoTree.is_terminal(node)
+    ]
+    codec = annotree.TerminalCodec()
+    (old_secs, old_data) = _timed(lambda: [_old_split_flat_terminal(tag) for tag in tags])
+    (new_secs, new_data) = _timed(lambda: [codec.decode(tag) for tag in tags])
+    if [dict(info.data) for info in new_data] != old_data:
+        raise AssertionError("Terminal codec output differs from split_flat_terminal")
+    stats = codec.stats()
+    print(
+        "terminals    {0} terminals  {1} distinct  hit rate {2:.3f}".format(
+            len(tags), stats["size"], stats["hit_rate"]
+        )
+    )
+    _report("terminals", old_secs, new_secs, sum(len(tag) for tag in tags))
+
+
+def bench_html(path):
+    trees = AnnoTree.fromstring_many(_read(path))
+    num_bytes = os.path.getsize(path)
+    (old_secs, old_html) = _timed(lambda: [_EtreeHtml.to_html(tree, None) for tree in trees])
+    (new_secs, new_html) = _timed(lambda: [AnnoTree.to_html(tree, None) for tree in trees])
+    if new_html != old_html:
+        raise AssertionError("HTML emitter output differs from ElementTree's")
+    _report("html", old_secs, new_secs, num_bytes)
+
+
+def bench_parallel(path, workers=None):
+    from annotald import parallel
+
+    num_bytes = os.path.getsize(path)
+    (old_secs, old_trees) = _timed(AnnoTree.read_from_file, path)
+    (new_secs, new_trees) = _timed(parallel.read_from_file, path, workers)
+    if new_trees != old_trees:
+        raise AssertionError("Parallel reader output differs from serial reader")
+    print("parallel     {0} workers".format(parallel.num_workers(workers)))
+    _report("par-load", old_secs, new_secs, num_bytes)
+    (old_secs, old_strs) = _timed(lambda: [tree.pretty() for tree in old_trees])
+    (new_secs, new_strs) = _timed(parallel.pretty_many, old_trees, workers)
+    if new_strs != old_strs:
+        raise AssertionError("Parallel pretty-printing differs from serial")
+    _report("par-pretty", old_secs, new_secs, num_bytes)
+
+
+def bench_rules(path):
+    from annotald.rules import RuleEngine
+
+    # Validators that each parse and walk the trees, as settings files
+    # define them, against the same checks as rules of one engine
+    def np_without_noun(node, path):
+        return not any(AnnoTree.is_terminal(child) and child.label().startswith("no")
+                       for child in node)
+
+    def verb_without_lemma(node, path):
+        return node.lemma is None
+
+    def empty_node(node, path):
+        return len(node) == 0
+
+    checks = [("NP*", None, np_without_noun), (None, "so", verb_without_lemma),
+              (None, None, empty_node)]
+    text = _read(path)
+    validators = []
+    for (labels, categories, fn) in checks:
+        engine = RuleEngine()
+        engine.add(fn, labels, categories)
+        validators.append(engine.validator())
+    fused = RuleEngine()
+    for (labels, categories, fn) in checks:
+        fused.add(fn, labels, categories)
+
+    def old_validate():
+        validated = text
+        for validator in validators:
+            validated = validator(None, validated)
+        return validated
+
+    (old_secs, old_text) = _timed(old_validate)
+    (new_secs, new_text) = _timed(fused.validator(), None, text)
+    if new_text != old_text:
+        raise AssertionError("Fused rules flag other nodes than the validators")
+    print(fused.report())
+    _report("rules", old_secs, new_secs, len(text.encode("utf-8")))
+
+
+BENCHMARKS = {
+    "cache": bench_cache,
+    "corpus": bench_corpus,
+    "html": bench_html,
+    "mmap": bench_mmap,
+    "nodes": bench_nodes,
+    "parallel": bench_parallel,
+    "pretty": bench_pretty,
+    "reader": bench_reader,
+    "rules": bench_rules,
+    "search": bench_search,
+    "terminals": bench_terminals,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark Annotald corpus handling"
+    )
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("psd", nargs="?", help="corpus file to benchmark on")
+    parser.add_argument(
+        "-n",
+        "--num-trees",
+        dest="numTrees",
+        type=int,
+        default=2000,
+        help="number of trees in the synthetic corpus",
+    )
+    parser.add_argument(
+        "-j",
+        "--workers",
+        dest="workers",
+        type=int,
+        help="number of worker processes for the parallel benchmark",
+    )
+    args = parser.parse_args(argv)
+    run = BENCHMARKS[args.benchmark]
+    if args.benchmark == "parallel":
+        run = lambda path: bench_parallel(path, args.workers)  # noqa
+
+    if args.psd:
+        run(args.psd)
+        return
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "bench.psd")
+        with open(path, "w", encoding="utf-8") as handle:
+            handle.write(make_corpus(args.numTrees))
+        run(path)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -27,9 +27,11 @@ setup_args = {
 setup(
     packages=["annotald"],
     package_data={
-        "annotald": ["data/*/*", "settings.py", "settings.js"]
+        "annotald": ["data/*/*", "data/*.jar", "settings.py", "settings.js"]
     },
-    install_requires=["mako", "cherrypy", "argparse", "nltk", "requests"],
+    install_requires=["mako", "cherrypy", "argparse", "requests"],
+    # The tests and benchmarks compare trees with nltk's
+    extras_require={"minify": ["rjsmin", "rcssmin"], "test": ["nltk"]},
     setup_requires=[],
     provides=["annotald"],
     entry_points={